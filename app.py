@@ -5,17 +5,26 @@ Avito Messenger Web Application
 Backend для работы с API Avito Messenger (Client Credentials Flow)
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, session, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, send_from_directory, session, url_for
 from flask_cors import CORS
 import requests
 import os
+import threading
 from datetime import datetime, timedelta
 import json
+import time
+import avatar_store
+import chat_cache
+import circuit_breaker
+import event_stream
+import http_client
+import metrics
 import telegram_client
 import whatsapp_client
 import database
 import yclients_client
 import notifications
+import scheduler
 
 # Получаем абсолютный путь к директории проекта
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -56,48 +65,133 @@ AVITO_API_URL = "https://api.avito.ru"
 # Хранилище токена
 token_cache = {
     'access_token': None,
-    'expires_at': None
+    'expires_at': None,
+    'refreshing': False,
+    'retry_at': None,
+    'refresh_ahead': 0
 }
+# Обновлять токен одновременно может только один поток, остальные ждут его результат
+token_lock = threading.Lock()
+token_refresh_state_lock = threading.Lock()
+
+# За сколько секунд до expires_at обновлять токен в фоне
+TOKEN_REFRESH_AHEAD = int(os.environ.get('AVITO_TOKEN_REFRESH_AHEAD', '600'))
+# Пауза перед повторной фоновой попыткой после ошибки
+TOKEN_REFRESH_RETRY = 30
+# Фоновое обновление не раньше, чем через столько секунд после получения токена
+TOKEN_REFRESH_MIN_DELAY = 30
+
+# Кэш профиля аккаунта Avito (/core/v1/accounts/self).
+# Живет столько же, сколько токен в token_cache, и сбрасывается при 401.
+account_cache = {
+    'profile': None,
+    'expires_at': None,
+    'refreshing': False
+}
+account_cache_lock = threading.Lock()
 
 
-def get_avito_token():
-    """Получить access token используя client_credentials"""
-    # Проверяем кэш
-    if token_cache['access_token'] and token_cache['expires_at']:
-        if datetime.now() < token_cache['expires_at']:
+def _token_valid_for(seconds):
+    """Проверить, что закэшированный токен действителен еще как минимум seconds секунд"""
+    if not token_cache['access_token'] or not token_cache['expires_at']:
+        return False
+    return (token_cache['expires_at'] - datetime.now()).total_seconds() > seconds
+
+
+def _refresh_avito_token(min_remaining=0):
+    """Получить новый токен (single-flight: один запрос к /token на все потоки)"""
+    with token_lock:
+        # Пока ждали блокировку, токен мог обновить другой поток
+        if _token_valid_for(min_remaining):
             return token_cache['access_token']
-    
-    # Получаем новый токен
-    token_url = f"{AVITO_API_URL}/token"
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": AVITO_CLIENT_ID,
-        "client_secret": AVITO_CLIENT_SECRET
-    }
-    
-    try:
-        response = requests.post(
-            token_url,
-            data=data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        )
         
-        if response.status_code == 200:
-            token_info = response.json()
-            access_token = token_info.get('access_token')
-            expires_in = token_info.get('expires_in', 86400)  # По умолчанию 24 часа
-            
-            # Сохраняем в кэш
-            token_cache['access_token'] = access_token
-            token_cache['expires_at'] = datetime.now() + timedelta(seconds=expires_in - 300)  # -5 минут для безопасности
+        token_url = f"{AVITO_API_URL}/token"
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": AVITO_CLIENT_ID,
+            "client_secret": AVITO_CLIENT_SECRET
+        }
+        
+        started = time.monotonic()
+        try:
+            response = http_client.get_session('avito').post(
+                token_url,
+                data=data,
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
             
-            return access_token
-        else:
-            print(f"Error getting token: {response.status_code} - {response.text}")
+            if response.status_code == 200:
+                token_info = response.json()
+                access_token = token_info.get('access_token')
+                expires_in = token_info.get('expires_in', 86400)  # По умолчанию 24 часа
+                # -5 минут для безопасности, но не больше половины срока жизни короткого токена
+                lifetime = expires_in - min(300, expires_in / 2)
+                
+                # Сохраняем в кэш
+                token_cache['access_token'] = access_token
+                token_cache['expires_at'] = datetime.now() + timedelta(seconds=lifetime)
+                token_cache['retry_at'] = None
+                # Обновляем не раньше середины срока жизни, иначе короткий токен обновлялся бы сразу и по кругу
+                token_cache['refresh_ahead'] = min(TOKEN_REFRESH_AHEAD, lifetime / 2)
+                
+                metrics.incr('avito_token_refresh_total')
+                _schedule_token_refresh()
+                return access_token
+            else:
+                print(f"Error getting token: {response.status_code} - {response.text}")
+                metrics.incr('avito_token_refresh_errors')
+                return None
+        except Exception as e:
+            print(f"Exception getting token: {e}")
+            metrics.incr('avito_token_refresh_errors')
             return None
-    except Exception as e:
-        print(f"Exception getting token: {e}")
-        return None
+        finally:
+            metrics.observe('avito_token_refresh_ms', (time.monotonic() - started) * 1000)
+
+
+def _refresh_avito_token_background():
+    """Фоновое обновление токена до истечения expires_at"""
+    try:
+        if not _refresh_avito_token(min_remaining=token_cache['refresh_ahead']):
+            token_cache['retry_at'] = datetime.now() + timedelta(seconds=TOKEN_REFRESH_RETRY)
+    finally:
+        token_cache['refreshing'] = False
+
+
+def _start_background_token_refresh():
+    """Запустить фоновое обновление токена, если оно еще не идет"""
+    with token_refresh_state_lock:
+        if token_cache['refreshing']:
+            return
+        if token_cache['retry_at'] and datetime.now() < token_cache['retry_at']:
+            return
+        token_cache['refreshing'] = True
+    threading.Thread(target=_refresh_avito_token_background, daemon=True).start()
+
+
+def _schedule_token_refresh():
+    """Запланировать фоновое обновление токена за refresh_ahead секунд до истечения"""
+    delay = (token_cache['expires_at'] - datetime.now()).total_seconds() - token_cache['refresh_ahead']
+    timer = threading.Timer(max(delay, TOKEN_REFRESH_MIN_DELAY), _start_background_token_refresh)
+    timer.daemon = True
+    timer.start()
+
+
+def get_avito_token():
+    """Получить access token используя client_credentials"""
+    # Проверяем кэш
+    access_token = token_cache['access_token']
+    expires_at = token_cache['expires_at']
+    if access_token and expires_at:
+        remaining = (expires_at - datetime.now()).total_seconds()
+        if remaining > 0:
+            # Токен скоро истечет - обновляем в фоне, запрос не ждет
+            if remaining < token_cache['refresh_ahead']:
+                _start_background_token_refresh()
+            return access_token
+    
+    # Токена нет или он истек - ждем обновления (одного на все потоки)
+    return _refresh_avito_token()
 
 
 def make_avito_request(method, endpoint, data=None):
@@ -113,18 +207,24 @@ def make_avito_request(method, endpoint, data=None):
     
     url = f"{AVITO_API_URL}{endpoint}"
     
+    avito_session = http_client.get_session('avito')
+    
     try:
         if method == "GET":
-            response = requests.get(url, headers=headers)
+            response = avito_session.get(url, headers=headers)
         elif method == "POST":
-            response = requests.post(url, headers=headers, json=data)
+            response = avito_session.post(url, headers=headers, json=data)
         elif method == "PUT":
-            response = requests.put(url, headers=headers, json=data)
+            response = avito_session.put(url, headers=headers, json=data)
         else:
             return None, "Unsupported method"
         
         if response.status_code == 200:
             return response.json(), None
+        elif response.status_code == 401:
+            # Токен отозван или истек раньше срока - сбрасываем токен и профиль
+            invalidate_avito_auth()
+            return None, f"API error: {response.status_code} - {response.text}"
         else:
             return None, f"API error: {response.status_code} - {response.text}"
             
@@ -132,6 +232,79 @@ def make_avito_request(method, endpoint, data=None):
         return None, str(e)
 
 
+def invalidate_avito_auth():
+    """Сбросить кэш токена и профиля аккаунта Avito"""
+    token_cache['access_token'] = None
+    token_cache['expires_at'] = None
+    with account_cache_lock:
+        account_cache['profile'] = None
+        account_cache['expires_at'] = None
+
+
+def _fetch_avito_account():
+    """Загрузить профиль аккаунта Avito и сохранить его в кэш"""
+    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    if error:
+        return None, error
+    
+    with account_cache_lock:
+        account_cache['profile'] = profile
+        # Профиль действителен, пока действителен токен, которым он получен
+        account_cache['expires_at'] = token_cache['expires_at']
+    
+    return profile, None
+
+
+def _refresh_avito_account_background():
+    """Фоновое обновление профиля аккаунта Avito"""
+    try:
+        _, error = _fetch_avito_account()
+        if error:
+            print(f"⚠️ Avito account refresh error: {error}")
+    finally:
+        with account_cache_lock:
+            account_cache['refreshing'] = False
+
+
+def get_avito_account():
+    """Получить профиль аккаунта Avito (из кэша, обновляется в фоне вместе с токеном)"""
+    with account_cache_lock:
+        profile = account_cache['profile']
+        expires_at = account_cache['expires_at']
+        start_refresh = False
+        
+        if profile:
+            # Профиль привязан к токену: если токен обновился или профиль истек,
+            # отдаем закэшированный профиль и перезапрашиваем его в фоне
+            token_rotated = token_cache['expires_at'] != expires_at
+            expired = not expires_at or datetime.now() >= expires_at
+            if (token_rotated or expired) and not account_cache['refreshing']:
+                account_cache['refreshing'] = True
+                start_refresh = True
+    
+    if start_refresh:
+        threading.Thread(target=_refresh_avito_account_background, daemon=True).start()
+    
+    if profile:
+        return profile, None
+    
+    return _fetch_avito_account()
+
+
+def get_avito_user_id():
+    """Получить user_id аккаунта Avito"""
+    profile, error = get_avito_account()
+    if error:
+        return None, error
+    
+    user_id = profile.get('id') if profile else None
+    if not user_id:
+        print(f"No user ID in profile: {profile}")
+        return None, "Could not get user ID"
+    
+    return user_id, None
+
+
 @app.route('/')
 def index():
     """Главная страница - сразу показываем сообщения"""
@@ -147,85 +320,101 @@ def messages():
 @app.route('/api/profile', methods=['GET'])
 def get_profile():
     """Получить информацию о профиле"""
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    profile, error = get_avito_account()
     if error:
         return jsonify({"error": error}), 500
     
     return jsonify(profile if profile else {})
 
 
+def fetch_avito_chats():
+    """Загрузить чаты Avito"""
+    user_id, error = get_avito_user_id()
+    if error:
+        raise Exception(error)
+    
+    chats_data, chats_error = make_avito_request("GET", f"/messenger/v2/accounts/{user_id}/chats")
+    if chats_error:
+        print(f"⚠️ Avito error (может требоваться подписка): {chats_error}")
+        raise Exception(chats_error)
+    
+    avito_chats = []
+    if chats_data and isinstance(chats_data, dict) and 'chats' in chats_data:
+        avito_chats = chats_data['chats']
+        # Помечаем как Avito
+        for chat in avito_chats:
+            chat['source'] = 'avito'
+            chat['source_icon'] = 'avito'
+    
+    print(f"Loaded {len(avito_chats)} Avito chats")
+    return avito_chats
+
+
+def fetch_telegram_chats():
+    """Загрузить чаты Telegram"""
+    # Telegram недоступен - ошибка источника (разомкнутая цепь - unavailable),
+    # в списке остаются последние загруженные чаты
+    try:
+        circuit_breaker.before_call('telegram')
+        telegram_chats = telegram_client.get_telegram_chats(limit=100, raise_errors=True)
+    except circuit_breaker.CircuitOpenError as e:
+        raise chat_cache.SourceUnavailable(str(e)) from e
+    print(f"Loaded {len(telegram_chats)} Telegram chats")
+    return telegram_chats
+
+
+def fetch_whatsapp_chats():
+    """Загрузить чаты WhatsApp (статус и чаты одним запросом к микросервису)"""
+    # Ошибка запроса к микросервису - статус источника error с настоящей причиной,
+    # разомкнутая цепь - unavailable (последние загруженные чаты остаются)
+    try:
+        circuit_breaker.before_call('whatsapp')
+        overview = whatsapp_client.get_whatsapp_overview(limit=30, raise_errors=True)
+    except circuit_breaker.CircuitOpenError as e:
+        raise chat_cache.SourceUnavailable(str(e)) from e
+    status = overview['status']
+    if not status.get('ready') or overview['chats'] is None:
+        print(f"⚠️ WhatsApp not ready: {status}")
+        # Ждет сканирования QR - аккаунт не подключен, чаты не показываем
+        raise chat_cache.SourceUnavailable(status.get('error') or 'WhatsApp not ready',
+                                           logged_out=bool(status.get('hasQR')))
+    
+    whatsapp_chats = overview['chats']
+    print(f"Loaded {len(whatsapp_chats)} WhatsApp chats")
+    return whatsapp_chats
+
+
+# Источники чатов и время (сек), которое /api/chats готов ждать их первую загрузку
+chat_cache.register_source('avito', fetch_avito_chats, float(os.environ.get('CHATS_DEADLINE_AVITO', '5')))
+chat_cache.register_source('telegram', fetch_telegram_chats, float(os.environ.get('CHATS_DEADLINE_TELEGRAM', '5')))
+chat_cache.register_source('whatsapp', fetch_whatsapp_chats, float(os.environ.get('CHATS_DEADLINE_WHATSAPP', '3')))
+
+
+def _cached_avito_user_id():
+    """user_id Avito из кэша профиля (без запросов к API)"""
+    profile = account_cache['profile']
+    return profile.get('id') if profile else None
+
+
 @app.route('/api/chats', methods=['GET', 'OPTIONS'])
 def get_chats():
-    """Получить объединенный список чатов из Avito и Telegram"""
-    # Проверяем отложенные задачи и новые записи YClients при запросе чатов
-    check_scheduled_messages()
-    check_new_yclients_records()
+    """
+    Получить объединенный список чатов из Avito, Telegram и WhatsApp
     
+    С параметром since=<cursor> возвращает только чаты, изменившиеся после
+    курсора (delta: true), и id удаленных чатов в removed.
+    """
     try:
-        all_chats = []
-        current_user_id = None
-        
-        # === AVITO ЧАТЫ ===
-        try:
-            profile, error = make_avito_request("GET", "/core/v1/accounts/self")
-            if not error and profile:
-                user_id = profile.get('id')
-                current_user_id = user_id
-                
-                if user_id:
-                    print(f"Got Avito user_id: {user_id}")
-                    chats_data, chats_error = make_avito_request("GET", f"/messenger/v2/accounts/{user_id}/chats")
-                    
-                    if not chats_error and chats_data and isinstance(chats_data, dict) and 'chats' in chats_data:
-                        avito_chats = chats_data['chats']
-                        # Помечаем как Avito
-                        for chat in avito_chats:
-                            chat['source'] = 'avito'
-                            chat['source_icon'] = 'avito'
-                        all_chats.extend(avito_chats)
-                        print(f"Loaded {len(avito_chats)} Avito chats")
-                    elif chats_error:
-                        print(f"⚠️ Avito error (может требоваться подписка): {chats_error}")
-        except Exception as e:
-            print(f"⚠️ Avito chats error (skipping): {e}")
-        
-        # === TELEGRAM ЧАТЫ ===
-        try:
-            telegram_chats = telegram_client.get_telegram_chats(limit=100)
-            if telegram_chats:
-                print(f"Loaded {len(telegram_chats)} Telegram chats")
-                all_chats.extend(telegram_chats)
-        except Exception as e:
-            print(f"Telegram chats error (skipping): {e}")
-        
-        # === WHATSAPP ЧАТЫ ===
-        try:
-            # Сначала проверяем статус
-            status = whatsapp_client.get_whatsapp_status()
-            if status.get('ready'):
-                whatsapp_chats = whatsapp_client.get_whatsapp_chats(limit=30)
-                if whatsapp_chats:
-                    print(f"Loaded {len(whatsapp_chats)} WhatsApp chats")
-                    all_chats.extend(whatsapp_chats)
-            else:
-                print(f"⚠️ WhatsApp not ready: {status}")
-        except Exception as e:
-            print(f"WhatsApp chats error (skipping): {e}")
+        result = chat_cache.get_chats(since=request.args.get('since'))
         
         # Сортируем по времени обновления (новые сверху)
-        all_chats.sort(key=lambda x: x.get('updated', 0), reverse=True)
+        result['chats'].sort(key=lambda x: x.get('updated', 0), reverse=True)
+        result['current_user_id'] = _cached_avito_user_id()
         
-        print(f"Total chats: {len(all_chats)}")
+        if not result['delta']:
+            print(f"Total chats: {len(result['chats'])}")
         
-        return jsonify({
-            "chats": all_chats,
-            "current_user_id": current_user_id,
-            "sources": {
-                "avito": len([c for c in all_chats if c.get('source') == 'avito']),
-                "telegram": len([c for c in all_chats if c.get('source') == 'telegram']),
-                "whatsapp": len([c for c in all_chats if c.get('source') == 'whatsapp'])
-            }
-        })
+        return jsonify(result)
     except Exception as e:
         import traceback
         print(f"Error in get_chats: {e}\n{traceback.format_exc()}")
@@ -233,7 +422,7 @@ def get_chats():
             "error": str(e),
             "chats": [],
             "current_user_id": None,
-            "sources": {"avito": 0, "telegram": 0, "whatsapp": 0}
+            "sources": {name: {"status": "error", "count": 0} for name in chat_cache.source_names()}
         }), 500
 
 
@@ -241,14 +430,10 @@ def get_chats():
 def get_messages():
     """Получить список сообщений"""
     # Получаем user_id из профиля
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     # Получаем чаты
     chats, error = make_avito_request("GET", f"/messenger/v2/accounts/{user_id}/chats")
     if error:
@@ -283,9 +468,17 @@ def get_messages():
     })
 
 
+# Сколько сообщений Telegram отдавать за один запрос
+TELEGRAM_MESSAGES_PAGE = 30
+
+
 @app.route('/api/chats/<chat_id>/messages', methods=['GET'])
 def get_chat_messages(chat_id):
-    """Получить сообщения конкретного чата (Avito, Telegram или WhatsApp)"""
+    """
+    Получить сообщения конкретного чата (Avito, Telegram или WhatsApp)
+
+    Для Telegram: after_id=<id> - только новые сообщения, before_id=<id> - страница истории.
+    """
     print(f"Fetching messages for chat_id: {chat_id}")
     
     # Определяем источник по префиксу ID
@@ -308,11 +501,14 @@ def get_chat_messages(chat_id):
     elif chat_id.startswith('tg_'):
         # === TELEGRAM ===
         try:
-            messages_list = telegram_client.get_telegram_messages(chat_id, limit=30)
+            after_id = request.args.get('after_id', type=int)
+            before_id = request.args.get('before_id', type=int)
+            messages_list = telegram_client.get_telegram_messages(
+                chat_id, limit=TELEGRAM_MESSAGES_PAGE, after_id=after_id, before_id=before_id
+            )
             
-            # Получаем информацию о чате
-            telegram_chats = telegram_client.get_telegram_chats(limit=100)
-            chat_info = next((c for c in telegram_chats if c['id'] == chat_id), None)
+            # Информация о чате из индекса диалогов
+            chat_info = telegram_client.get_telegram_chat_info(chat_id)
             
             # Преобразуем формат сообщений для единого интерфейса
             for msg in messages_list:
@@ -325,7 +521,10 @@ def get_chat_messages(chat_id):
                 "chat_id": chat_id,
                 "chat_info": chat_info,
                 "current_user_id": None,
-                "source": "telegram"
+                "source": "telegram",
+                "after_id": after_id,
+                "before_id": before_id,
+                "limit": TELEGRAM_MESSAGES_PAGE
             })
         except Exception as e:
             print(f"Telegram messages error: {e}")
@@ -333,16 +532,11 @@ def get_chat_messages(chat_id):
     
     else:
         # === AVITO ===
-        profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+        user_id, error = get_avito_user_id()
         if error:
             print(f"Error getting profile: {error}")
             return jsonify({"error": error}), 500
         
-        user_id = profile.get('id')
-        if not user_id:
-            print(f"No user ID in profile: {profile}")
-            return jsonify({"error": "Could not get user ID"}), 500
-        
         # Получаем информацию о чате (для пользователей)
         chats_data, chats_error = make_avito_request("GET", f"/messenger/v2/accounts/{user_id}/chats")
         chat_info = None
@@ -401,6 +595,7 @@ def send_message():
         try:
             result = whatsapp_client.send_whatsapp_message(chat_id, message_text)
             if result and result.get('success'):
+                chat_cache.invalidate('whatsapp')
                 return jsonify({"success": True, "data": result})
             else:
                 return jsonify({"error": result.get('error', 'Unknown error')}), 500
@@ -412,6 +607,7 @@ def send_message():
         try:
             result = telegram_client.send_telegram_message(chat_id, message_text)
             if result and result.get('success'):
+                chat_cache.invalidate('telegram')
                 return jsonify({"success": True, "data": result})
             else:
                 return jsonify({"error": result.get('error', 'Unknown error')}), 500
@@ -420,14 +616,10 @@ def send_message():
     
     else:
         # === AVITO ===
-        profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+        user_id, error = get_avito_user_id()
         if error:
             return jsonify({"error": error}), 500
         
-        user_id = profile.get('id')
-        if not user_id:
-            return jsonify({"error": "Could not get user ID"}), 500
-        
         # Отправляем сообщение
         message_data = {
             "message": {
@@ -445,6 +637,7 @@ def send_message():
         if error:
             return jsonify({"error": error}), 500
         
+        chat_cache.invalidate('avito')
         return jsonify({"success": True, "data": result})
 
 
@@ -458,14 +651,10 @@ def delete_message():
     if not chat_id or not message_id:
         return jsonify({"error": "chat_id and message_id are required"}), 400
     
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     result, error = make_avito_request(
         "POST",
         f"/messenger/v1/accounts/{user_id}/chats/{chat_id}/messages/{message_id}"
@@ -487,6 +676,7 @@ def mark_chat_read(chat_id):
         try:
             result = whatsapp_client.mark_whatsapp_read(chat_id)
             if result and result.get('success'):
+                chat_cache.invalidate('whatsapp')
                 return jsonify({"success": True})
             else:
                 return jsonify({"error": result.get('error', 'Unknown error')}), 500
@@ -498,6 +688,7 @@ def mark_chat_read(chat_id):
         try:
             result = telegram_client.mark_telegram_read(chat_id)
             if result and result.get('success'):
+                chat_cache.invalidate('telegram')
                 return jsonify({"success": True})
             else:
                 return jsonify({"error": result.get('error', 'Unknown error')}), 500
@@ -506,14 +697,10 @@ def mark_chat_read(chat_id):
     
     else:
         # === AVITO ===
-        profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+        user_id, error = get_avito_user_id()
         if error:
             return jsonify({"error": error}), 500
         
-        user_id = profile.get('id')
-        if not user_id:
-            return jsonify({"error": "Could not get user ID"}), 500
-        
         result, error = make_avito_request(
             "POST",
             f"/messenger/v1/accounts/{user_id}/chats/{chat_id}/read"
@@ -522,6 +709,7 @@ def mark_chat_read(chat_id):
         if error:
             return jsonify({"error": error}), 500
         
+        chat_cache.invalidate('avito')
         return jsonify({"success": True, "data": result})
 
 
@@ -535,14 +723,10 @@ def upload_image():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     # Подготовка multipart/form-data запроса
     files = {'uploadfile[]': (file.filename, file.stream, file.content_type)}
     
@@ -555,7 +739,7 @@ def upload_image():
     }
     
     try:
-        response = requests.post(
+        response = http_client.get_session('avito').post(
             f"{AVITO_API_URL}/messenger/v1/accounts/{user_id}/uploadImages",
             files=files,
             headers=headers
@@ -576,14 +760,10 @@ def send_image_message():
     if not chat_id or not image_id:
         return jsonify({"error": "chat_id and image_id are required"}), 400
     
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     image_data = {"image_id": image_id}
     
     result, error = make_avito_request(
@@ -595,6 +775,7 @@ def send_image_message():
     if error:
         return jsonify({"error": error}), 500
     
+    chat_cache.invalidate('avito')
     return jsonify({"success": True, "data": result})
 
 
@@ -606,14 +787,10 @@ def get_voice_messages():
     if not voice_ids:
         return jsonify({"error": "voice_ids parameter is required"}), 400
     
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     # Формируем query string с массивом voice_ids
     query_params = '&'.join([f'voice_ids={vid}' for vid in voice_ids])
     
@@ -637,14 +814,10 @@ def add_to_blacklist():
     if not users:
         return jsonify({"error": "users array is required"}), 400
     
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     blacklist_data = {"users": users}
     
     result, error = make_avito_request(
@@ -659,6 +832,28 @@ def add_to_blacklist():
     return jsonify({"success": True, "data": result})
 
 
+@app.route('/api/webhooks/avito', methods=['POST'])
+def avito_webhook():
+    """Прием webhook уведомлений Avito Messenger (адрес для /api/webhooks/subscribe)"""
+    data = request.get_json(silent=True) or {}
+    payload = data.get('payload') or {}
+    print(f"📥 Avito webhook: {payload.get('type')}")
+    
+    if payload.get('type') == 'message':
+        message = dict(payload.get('value') or {})
+        if message.get('chat_id'):
+            message['source'] = 'avito'
+            event_stream.publish('new-message', {
+                'source': 'avito',
+                'chat_id': message['chat_id'],
+                'message': message
+            })
+    
+    # Список чатов Avito изменился - обновляем кэш в фоне
+    chat_cache.invalidate('avito')
+    return jsonify({"ok": True})
+
+
 @app.route('/api/webhooks/list', methods=['POST'])
 def list_webhooks():
     """Получить список подписок"""
@@ -722,14 +917,10 @@ def unsubscribe_webhook():
 @app.route('/api/chats/<chat_id>/info', methods=['GET'])
 def get_chat_info(chat_id):
     """Получить информацию о конкретном чате"""
-    profile, error = make_avito_request("GET", "/core/v1/accounts/self")
+    user_id, error = get_avito_user_id()
     if error:
         return jsonify({"error": error}), 500
     
-    user_id = profile.get('id')
-    if not user_id:
-        return jsonify({"error": "Could not get user ID"}), 500
-    
     result, error = make_avito_request(
         "GET",
         f"/messenger/v2/accounts/{user_id}/chats/{chat_id}"
@@ -760,15 +951,16 @@ def telegram_auth():
 def telegram_status():
     """Проверить статус авторизации Telegram"""
     try:
-        # Инициализируем клиент
-        telegram_client.run_async(telegram_client.init_telegram_client())
-        if telegram_client.telegram_client and telegram_client.telegram_client.is_connected():
-            is_auth = telegram_client.run_async(telegram_client.telegram_client.is_user_authorized())
-            return jsonify({
-                "connected": True,
-                "authorized": is_auth
-            })
-        return jsonify({"connected": False, "authorized": False})
+        state = telegram_client.get_auth_state()
+        # Подключаемся только если состояние еще не установлено
+        if state == telegram_client.AUTH_DISCONNECTED:
+            telegram_client.run_async(telegram_client.init_telegram_client())
+            state = telegram_client.get_auth_state()
+        return jsonify({
+            "connected": state in (telegram_client.AUTH_UNAUTHORIZED, telegram_client.AUTH_AUTHORIZED),
+            "authorized": state == telegram_client.AUTH_AUTHORIZED,
+            "state": state
+        })
     except Exception as e:
         return jsonify({"connected": False, "authorized": False, "error": str(e)})
 
@@ -808,6 +1000,50 @@ def whatsapp_qr():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/whatsapp/events', methods=['POST'])
+def whatsapp_events():
+    """
+    Прием событий от WhatsApp микросервиса: {"events": [...]} или одно событие.
+
+    Типы: message, ack, read, resync, heartbeat
+    """
+    if not whatsapp_client.check_events_token(request.headers.get('X-Events-Token')):
+        return jsonify({"error": "Forbidden"}), 403
+    
+    data = request.get_json(silent=True) or {}
+    events = data.get('events') if isinstance(data.get('events'), list) else [data]
+    
+    chats_changed = False
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        message = whatsapp_client.apply_event(event)
+        event_type = event.get('type')
+        if event_type == 'message' and message:
+            event_stream.publish('new-message', {
+                'source': 'whatsapp',
+                'chat_id': event['chat_id'],
+                'message': message
+            })
+            chats_changed = True
+        elif event_type in ('ack', 'read') and event.get('chat_id'):
+            event_stream.publish('read-state', {
+                'source': 'whatsapp',
+                'chat_id': event['chat_id'],
+                'message_id': event.get('message_id'),
+                'outbox': event_type == 'ack'
+            })
+            chats_changed = True
+        elif event_type == 'resync':
+            chats_changed = True
+    
+    # Один сброс кэша чатов на пачку событий
+    if chats_changed:
+        chat_cache.invalidate('whatsapp')
+    
+    return jsonify({"success": True, "received": len(events)})
+
+
 @app.route('/api/telegram/avatar/<chat_id>', methods=['GET'])
 def get_telegram_avatar(chat_id):
     """Ленивая загрузка аватарки Telegram чата"""
@@ -821,6 +1057,32 @@ def get_telegram_avatar(chat_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# Сколько аватарок можно запросить за раз
+AVATAR_BATCH_LIMIT = 100
+
+
+@app.route('/api/telegram/avatars', methods=['POST'])
+def get_telegram_avatars():
+    """Загрузить аватарки нескольких Telegram чатов: {"chat_ids": [...]} -> {"avatars": {chat_id: url}}"""
+    data = request.json or {}
+    chat_ids = [chat_id for chat_id in data.get('chat_ids', []) if str(chat_id).startswith('tg_')]
+    
+    try:
+        avatars = telegram_client.download_telegram_avatars(chat_ids[:AVATAR_BATCH_LIMIT])
+        return jsonify({"success": True, "avatars": avatars})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/avatars/<path:filename>')
+def serve_avatar(filename):
+    """Файлы аватарок: имя зависит от фото, поэтому кэшируются браузером навсегда"""
+    avatar_store.touch(filename)
+    response = send_from_directory(avatar_store.AVATAR_DIR, filename, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
 @app.route('/test')
 def test():
     """Тестовая страница"""
@@ -838,6 +1100,41 @@ def test():
     """
 
 
+@app.route('/api/events', methods=['GET'])
+def events():
+    """
+    Поток событий (Server-Sent Events): new-message, read-state, chat-updated
+    
+    Соединение закрывается через event_stream.MAX_STREAM_DURATION секунд,
+    браузер переподключается автоматически. Сверх EVENTS_MAX_SUBSCRIBERS - 503.
+    """
+    if not event_stream.has_capacity():
+        metrics.incr('events_rejected')
+        response = jsonify({"error": "Too many event streams"})
+        response.headers['Retry-After'] = '60'
+        return response, 503
+    
+    response = Response(event_stream.stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """Готовность инстанса для балансировщика: 503, пока идет прогрев"""
+    ready = warmup_state['status'] in ('disabled', 'done')
+    return jsonify(dict(warmup_state, ready=ready)), (200 if ready else 503)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Внутренние метрики процесса"""
+    snapshot = metrics.snapshot()
+    snapshot['circuits'] = circuit_breaker.snapshot()
+    return jsonify(snapshot)
+
+
 # === API для работы с данными клиентов ===
 
 @app.route('/api/customers/<source>/<source_id>', methods=['GET'])
@@ -1268,45 +1565,6 @@ def process_scheduled_messages_endpoint():
         return jsonify({"error": str(e)}), 500
 
 
-# Обрабатываем отложенные задачи при каждом запросе к API (но не слишком часто)
-_last_scheduled_check = None
-
-_last_yclients_check = None
-
-def check_scheduled_messages():
-    """Проверить и обработать отложенные задачи (не чаще раза в 10 секунд - для теста)"""
-    global _last_scheduled_check
-    now = datetime.now()
-    
-    # Проверяем не чаще раза в 10 секунд (для теста)
-    if _last_scheduled_check and (now - _last_scheduled_check).total_seconds() < 10:
-        return
-    
-    _last_scheduled_check = now
-    
-    try:
-        notifications.process_scheduled_messages()
-    except Exception as e:
-        print(f"⚠️ Ошибка обработки отложенных задач: {e}")
-
-
-def check_new_yclients_records():
-    """Проверить новые записи в YClients (не чаще раза в 10 секунд - для теста)"""
-    global _last_yclients_check
-    now = datetime.now()
-    
-    # Проверяем не чаще раза в 10 секунд (для теста)
-    if _last_yclients_check and (now - _last_yclients_check).total_seconds() < 10:
-        return
-    
-    _last_yclients_check = now
-    
-    try:
-        notifications.check_new_yclients_records()
-    except Exception as e:
-        print(f"⚠️ Ошибка проверки новых записей YClients: {e}")
-
-
 # ==================== YClients OAuth Integration ====================
 
 @app.route('/yclients/connect', methods=['GET', 'POST'])
@@ -1433,6 +1691,47 @@ def yclients_webhook():
         }), 500
 
 
+# Индекс каталога аватарок строится один раз при старте
+avatar_store.init()
+
+# Telethon работает в собственном потоке с event loop, запросы Flask отправляют туда корутины
+telegram_client.start_loop()
+
+# Прогрев при старте (TELEGRAM_WARMUP=1): подключение Telegram, загрузка диалогов и кэша чатов
+# в фоне, чтобы первый запрос после деплоя не платил за них. /api/ready отвечает 503 до конца прогрева
+TELEGRAM_WARMUP = os.environ.get('TELEGRAM_WARMUP', '0') == '1'
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '60'))
+warmup_state = {'status': 'pending' if TELEGRAM_WARMUP else 'disabled'}
+
+
+def _run_warmup():
+    """Прогрев: Telegram клиент, затем все источники чатов (диалоги, пользователи, кэш чатов)"""
+    started = time.monotonic()
+    warmup_state['status'] = 'running'
+    try:
+        telegram_client.run_async(telegram_client.init_telegram_client(), timeout=WARMUP_TIMEOUT)
+        warmup_state['telegram'] = telegram_client.get_auth_state()
+    except Exception as e:
+        print(f"⚠️ Прогрев Telegram: {e}")
+        warmup_state['telegram'] = 'error'
+    
+    remaining = max(0, WARMUP_TIMEOUT - (time.monotonic() - started))
+    warmup_state['sources'] = chat_cache.warm(timeout=remaining)
+    
+    warmup_state['elapsed_ms'] = round((time.monotonic() - started) * 1000)
+    warmup_state['status'] = 'done'
+    metrics.observe('warmup_ms', warmup_state['elapsed_ms'])
+    print(f"🔥 Прогрев завершен за {warmup_state['elapsed_ms']} мс: {warmup_state['sources']}")
+
+
+if TELEGRAM_WARMUP:
+    threading.Thread(target=_run_warmup, name='warmup', daemon=True).start()
+
+# Отложенные сообщения и записи YClients обрабатываются в фоне, а не в запросах
+if scheduler.SCHEDULER_MODE == 'thread':
+    scheduler.start()
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Avito Messenger (Client Credentials) запускается...")
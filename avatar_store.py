@@ -0,0 +1,116 @@
+"""
+Avatar Store
+Каталог аватарок с ограничением размера: индекс файлов в памяти,
+давно не использованные файлы удаляются при превышении бюджета
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+AVATAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'avatars')
+# Сколько байт могут занимать аватарки
+AVATAR_CACHE_MAX_BYTES = int(os.environ.get('AVATAR_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+# Как часто обновлять время доступа файла на диске (порядок вытеснения после перезапуска)
+ATIME_UPDATE_INTERVAL = 3600
+
+_index = OrderedDict()  # filename -> {'size', 'atime'}, от давно использованных к недавним
+_total_bytes = 0
+_loaded = False
+_lock = threading.Lock()
+
+
+def _load_locked():
+    """Построить индекс по каталогу одним проходом os.scandir (под _lock)"""
+    global _total_bytes, _loaded
+    if _loaded:
+        return
+    _loaded = True
+
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    files = []
+    with os.scandir(AVATAR_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.tmp'):
+                # Недокачанный файл прошлого процесса
+                _remove(entry.name)
+                continue
+            stat = entry.stat()
+            files.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+
+    for atime, name, size in sorted(files):
+        _index[name] = {'size': size, 'atime': atime}
+        _total_bytes += size
+
+    print(f"🖼️ Avatar store: {len(_index)} files, {_total_bytes // 1024} KB")
+    _evict_locked()
+
+
+def _remove(filename):
+    try:
+        os.remove(os.path.join(AVATAR_DIR, filename))
+    except OSError:
+        pass
+
+
+def _evict_locked():
+    """Удалять давно не использованные файлы, пока не уложимся в бюджет (под _lock)"""
+    global _total_bytes
+    while _total_bytes > AVATAR_CACHE_MAX_BYTES and len(_index) > 1:
+        filename, info = _index.popitem(last=False)
+        _total_bytes -= info['size']
+        _remove(filename)
+        metrics.incr('avatar_store_evictions')
+    metrics.set_gauge('avatar_store_bytes', _total_bytes)
+    metrics.set_gauge('avatar_store_files', len(_index))
+
+
+def init():
+    """Построить индекс заранее (при старте приложения)"""
+    with _lock:
+        _load_locked()
+
+
+def path(filename):
+    """Полный путь к файлу аватарки"""
+    return os.path.join(AVATAR_DIR, filename)
+
+
+def touch(filename):
+    """Отметить использование файла. Возвращает False, если файла нет"""
+    with _lock:
+        _load_locked()
+        info = _index.get(filename)
+        if info is None:
+            return False
+        _index.move_to_end(filename)
+        now = time.time()
+        update_disk = now - info['atime'] > ATIME_UPDATE_INTERVAL
+        info['atime'] = now
+
+    if update_disk:
+        try:
+            stat = os.stat(path(filename))
+            os.utime(path(filename), (now, stat.st_mtime))
+        except OSError:
+            pass
+    return True
+
+
+def add(filename):
+    """Зарегистрировать новый файл в каталоге и освободить место при необходимости"""
+    global _total_bytes
+    size = os.path.getsize(path(filename))
+    with _lock:
+        _load_locked()
+        old = _index.pop(filename, None)
+        if old:
+            _total_bytes -= old['size']
+        _index[filename] = {'size': size, 'atime': time.time()}
+        _total_bytes += size
+        _evict_locked()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк: requests.get (новое соединение на каждый запрос) против
+keep-alive сессии из http_client на локальном stub-сервере.
+
+Запуск:
+    python3 benchmarks/http_pool_benchmark.py
+    python3 benchmarks/http_pool_benchmark.py --tls --requests 500 --threads 8
+"""
+
+import argparse
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client  # noqa: E402
+
+BODY = b'{"chats": []}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Отвечает коротким JSON и держит соединение открытым"""
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело пишутся отдельно - без TCP_NODELAY keep-alive упирается в delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_certificate(directory):
+    """Сгенерировать самоподписанный сертификат через openssl"""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return certfile, keyfile
+
+
+def start_server(tls):
+    """Запустить stub-сервер в фоновом потоке, вернуть (server, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    scheme = 'http'
+    if tls:
+        certfile, keyfile = make_certificate(tempfile.mkdtemp())
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'{scheme}://127.0.0.1:{server.server_address[1]}/chats'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(label, fetch, url, total, threads):
+    """Выполнить total запросов в threads потоков, напечатать p50/p99"""
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        response = fetch(url)
+        response.raise_for_status()
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+
+    # Прогрев (для пула - установка соединений)
+    for _ in range(threads):
+        fetch(url)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    print(f"{label:<28} p50={percentile(latencies, 50):7.2f}ms  "
+          f"p99={percentile(latencies, 99):7.2f}ms  rps={total / wall:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300, help='количество запросов')
+    parser.add_argument('--threads', type=int, default=4, help='количество параллельных потоков')
+    parser.add_argument('--tls', action='store_true', help='использовать HTTPS (нужен openssl)')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore', message='Unverified HTTPS request')
+    server, url = start_server(args.tls)
+    print(f"Stub server: {url}, {args.requests} requests, {args.threads} threads")
+
+    try:
+        run('before: requests.get', lambda u: requests.get(u, verify=False, timeout=10),
+            url, args.requests, args.threads)
+        run('after: http_client session', lambda u: http_client.get_session('benchmark').get(u, verify=False),
+            url, args.requests, args.threads)
+    finally:
+        server.shutdown()
+        http_client.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Unified Chat Cache
+Серверный кэш объединенного списка чатов (stale-while-revalidate)
+
+Список чатов отдается сразу из памяти. Источник, данные которого старше
+TTL (или сброшены вебхуком/событием), обновляется в фоне - не больше одного
+обновления на источник одновременно, сколько бы вкладок ни опрашивали /api/chats.
+Ждать приходится только при первой загрузке источника, и не дольше его дедлайна.
+
+У каждого чата есть версия: глобальный счетчик увеличивается, когда у чата
+меняется время обновления, непрочитанные или последнее сообщение. Курсор
+"<epoch>:<version>" позволяет клиенту получить только изменения.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+
+import event_stream
+import metrics
+
+# Через сколько секунд данные источника считаются устаревшими
+CHAT_CACHE_TTL = float(os.environ.get('CHAT_CACHE_TTL', '10'))
+
+
+class SourceUnavailable(Exception):
+    """Источник чатов сейчас недоступен (не авторизован, не готов)"""
+
+    def __init__(self, message='', logged_out=False):
+        super().__init__(message)
+        # True - аккаунт не авторизован: его чаты больше не показываем
+        self.logged_out = logged_out
+
+
+_sources = {}     # name -> {'fetch', 'deadline', 'ttl'}
+_entries = {}     # name -> последние загруженные чаты и статус источника
+_refreshing = {}  # name -> Future текущего обновления
+_lock = threading.Lock()
+
+# Версии чатов для дельта-запросов (?since=<cursor>)
+_epoch = format(int(time.time() * 1000), 'x')  # курсоры прошлого процесса недействительны
+_version = 0
+_chat_versions = {}    # chat_id -> (fingerprint, version)
+_removed = {}          # chat_id -> version удаления
+_min_delta_version = 0  # более старые курсоры получают полный список
+MAX_REMOVED_TRACKED = 1000
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CHATS_FETCH_WORKERS', '12')),
+    thread_name_prefix='chat-source'
+)
+
+
+def register_source(name, fetch, deadline, ttl=None):
+    """
+    Зарегистрировать источник чатов.
+
+    fetch - функция без аргументов, возвращает список чатов или бросает
+    SourceUnavailable/исключение. deadline - сколько секунд ждать первую загрузку.
+    """
+    if ttl is None:
+        ttl = float(os.environ.get(f'CHAT_CACHE_TTL_{name.upper()}', CHAT_CACHE_TTL))
+    _sources[name] = {'fetch': fetch, 'deadline': deadline, 'ttl': ttl}
+
+
+def source_names():
+    """Имена зарегистрированных источников"""
+    return list(_sources)
+
+
+def _refresh(name):
+    """Загрузить чаты источника и сохранить в кэш (выполняется в пуле)"""
+    source = _sources[name]
+    started_at = time.time()
+    started = time.monotonic()
+    chats = None
+    logged_out = False
+    try:
+        chats = source['fetch']()
+        status, error = 'ok', None
+    except SourceUnavailable as e:
+        status, error = 'unavailable', str(e)
+        logged_out = e.logged_out
+    except Exception as e:
+        print(f"⚠️ {name} chats error: {e}")
+        status, error = 'error', str(e)
+    elapsed_ms = (time.monotonic() - started) * 1000
+
+    metrics.incr(f'chat_cache_refresh_{name}')
+    metrics.observe(f'chat_source_{name}_ms', elapsed_ms)
+
+    changed_ids = []
+    with _lock:
+        entry = _entries.setdefault(name, {'chats': [], 'invalidated_at': 0})
+        if status == 'ok' or logged_out:
+            new_chats = chats if status == 'ok' else []
+            changed_ids = _track_versions_locked(entry['chats'], new_chats)
+            entry['chats'] = new_chats
+        # При ошибке или временной недоступности оставляем последние успешно загруженные чаты
+        entry['stale'] = status != 'ok' and bool(entry['chats'])
+        entry['fetched_at'] = time.time()
+        entry['status'] = status
+        entry['error'] = error
+        entry['elapsed_ms'] = round(elapsed_ms)
+        _refreshing.pop(name, None)
+
+        # Пока шла загрузка, пришло событие - данные могли устареть, обновляем еще раз
+        if entry['invalidated_at'] > started_at:
+            _start_refresh_locked(name)
+        cursor = f"{_epoch}:{_version}"
+
+    if changed_ids:
+        event_stream.publish('chat-updated', {'source': name, 'chat_ids': changed_ids, 'cursor': cursor})
+
+    return entry
+
+
+def _fingerprint(chat):
+    """Поля чата, изменение которых должно попасть в дельту"""
+    last_message = chat.get('last_message') or {}
+    return (
+        chat.get('updated'),
+        chat.get('unread_count'),
+        chat.get('name'),
+        last_message.get('id'),
+        last_message.get('created'),
+        last_message.get('isRead', last_message.get('is_read'))
+    )
+
+
+def _track_versions_locked(old_chats, new_chats):
+    """
+    Присвоить новые версии измененным и удаленным чатам источника (под _lock).
+
+    Возвращает id измененных и удаленных чатов.
+    """
+    global _version, _min_delta_version
+
+    changed_ids = []
+
+    for chat in new_chats:
+        chat_id = chat.get('id')
+        fingerprint = _fingerprint(chat)
+        known = _chat_versions.get(chat_id)
+        if known is None or known[0] != fingerprint:
+            _version += 1
+            _chat_versions[chat_id] = (fingerprint, _version)
+            _removed.pop(chat_id, None)
+            changed_ids.append(chat_id)
+
+    new_ids = {chat.get('id') for chat in new_chats}
+    for chat in old_chats:
+        chat_id = chat.get('id')
+        if chat_id not in new_ids and chat_id in _chat_versions:
+            _version += 1
+            del _chat_versions[chat_id]
+            _removed[chat_id] = _version
+            changed_ids.append(chat_id)
+
+    # Ограничиваем число удаленных; клиенты со старыми курсорами получат полный список
+    while len(_removed) > MAX_REMOVED_TRACKED:
+        oldest = min(_removed, key=_removed.get)
+        _min_delta_version = max(_min_delta_version, _removed.pop(oldest))
+
+    return changed_ids
+
+
+def _parse_cursor(cursor):
+    """Версия из курсора или None, если курсор не подходит для дельты"""
+    try:
+        epoch, version = cursor.split(':', 1)
+        version = int(version)
+    except (AttributeError, ValueError):
+        return None
+    if epoch != _epoch or version < _min_delta_version or version > _version:
+        return None
+    return version
+
+
+def _start_refresh_locked(name):
+    """Запустить обновление источника, если оно еще не идет (под _lock)"""
+    future = _refreshing.get(name)
+    if future is None:
+        future = _executor.submit(_refresh, name)
+        _refreshing[name] = future
+    return future
+
+
+def invalidate(name=None):
+    """Сбросить кэш источника (или всех) и сразу начать фоновое обновление"""
+    names = [name] if name else list(_sources)
+    now = time.time()
+    with _lock:
+        for source_name in names:
+            if source_name not in _sources:
+                continue
+            entry = _entries.get(source_name)
+            if entry is not None:
+                entry['invalidated_at'] = now
+            _start_refresh_locked(source_name)
+
+
+def update_chat(name, chat):
+    """
+    Заменить чат в кэше источника без перезагрузки (по событию).
+
+    Возвращает False, если чата нет в кэше или кэш устарел, - тогда нужен invalidate.
+    """
+    with _lock:
+        entry = _entries.get(name)
+        if entry is None or entry['status'] != 'ok':
+            return False
+        for index, cached in enumerate(entry['chats']):
+            if cached.get('id') == chat.get('id'):
+                break
+        else:
+            return False
+        entry['chats'] = entry['chats'][:index] + [chat] + entry['chats'][index + 1:]
+        changed_ids = _track_versions_locked([], [chat])
+        cursor = f"{_epoch}:{_version}"
+
+    if changed_ids:
+        event_stream.publish('chat-updated', {'source': name, 'chat_ids': changed_ids, 'cursor': cursor})
+    return True
+
+
+def warm(timeout=None):
+    """Загрузить все источники (прогрев при старте). Возвращает {источник: статус}"""
+    with _lock:
+        futures = [_start_refresh_locked(name) for name in _sources]
+    wait(futures, timeout=timeout)
+    with _lock:
+        return {
+            name: (_entries[name]['status'] if name in _entries else 'timeout')
+            for name in _sources
+        }
+
+
+def get_chats(since=None):
+    """
+    Получить чаты всех источников.
+
+    Возвращает словарь:
+    - chats: все чаты или, если передан действующий курсор since, только измененные
+    - removed: id чатов, исчезнувших после since (только для дельты)
+    - delta: True, если chats - дельта
+    - cursor: курсор для следующего запроса
+    - sources: статус каждого источника - status (ok|timeout|unavailable|error),
+      count, elapsed_ms, age_ms, refreshing, stale (показаны чаты последней успешной загрузки)
+    """
+    started = time.monotonic()
+    now = time.time()
+    cold = {}
+
+    with _lock:
+        for name, source in _sources.items():
+            entry = _entries.get(name)
+            if entry is None:
+                # Первая загрузка - ждем ее, но не дольше дедлайна источника
+                cold[name] = _start_refresh_locked(name)
+            elif now - entry['fetched_at'] > source['ttl'] or entry['invalidated_at'] > entry['fetched_at']:
+                _start_refresh_locked(name)
+
+    timed_out = set()
+    for name, future in cold.items():
+        remaining = max(0, started + _sources[name]['deadline'] - time.monotonic())
+        try:
+            future.result(timeout=remaining)
+        except FuturesTimeoutError:
+            print(f"⚠️ {name} chats: deadline {_sources[name]['deadline']}s exceeded")
+            timed_out.add(name)
+
+    all_chats = []
+    sources = {}
+    now = time.time()
+    with _lock:
+        since_version = _parse_cursor(since) if since else None
+
+        for name in _sources:
+            entry = _entries.get(name)
+            if name in timed_out or entry is None:
+                sources[name] = {"status": "timeout", "count": 0}
+                continue
+
+            if since_version is None:
+                all_chats.extend(entry['chats'])
+            else:
+                all_chats.extend(
+                    chat for chat in entry['chats']
+                    if _chat_versions.get(chat.get('id'), (None, 0))[1] > since_version
+                )
+            sources[name] = {
+                "status": entry['status'],
+                "count": len(entry['chats']),
+                "elapsed_ms": entry['elapsed_ms'],
+                "age_ms": round((now - entry['fetched_at']) * 1000),
+                "refreshing": name in _refreshing,
+                "stale": entry['stale']
+            }
+            if entry['error']:
+                sources[name]["error"] = entry['error']
+
+        removed = []
+        if since_version is not None:
+            removed = [chat_id for chat_id, version in _removed.items() if version > since_version]
+
+        return {
+            "chats": all_chats,
+            "removed": removed,
+            "delta": since_version is not None,
+            "cursor": f"{_epoch}:{_version}",
+            "sources": sources
+        }
@@ -0,0 +1,197 @@
+"""
+Circuit Breaker
+Быстрый отказ при недоступности внешнего сервиса (Avito, WhatsApp, YClients, Telegram)
+
+После CIRCUIT_FAILURE_THRESHOLD ошибок подряд (нет соединения, таймаут, 502-504)
+цепь размыкается: вызовы сразу получают CircuitOpenError, не дожидаясь таймаутов.
+Пока цепь разомкнута, фоновый поток раз в CIRCUIT_OPEN_SECONDS проверяет сервис
+его проверкой (half-open) и замыкает цепь, как только проверка прошла.
+Если проверки нет, цепь замыкается по таймеру, и ее проверяет следующий настоящий вызов.
+
+Настройки можно задать для конкретного сервиса: CIRCUIT_<KEY>_<UPSTREAM>.
+"""
+
+import os
+import threading
+import time
+
+import requests
+
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Цепь разомкнута - сервис недоступен, вызов не выполнялся"""
+
+    def __init__(self, upstream):
+        super().__init__(f"{upstream}: сервис недоступен (circuit open)")
+        self.upstream = upstream
+
+
+def _env(upstream, key, default):
+    """Настройка для конкретного сервиса (CIRCUIT_<KEY>_<UPSTREAM>) или общая (CIRCUIT_<KEY>)"""
+    value = os.environ.get(f'CIRCUIT_{key}_{upstream.upper()}')
+    if value is None:
+        value = os.environ.get(f'CIRCUIT_{key}', default)
+    return value
+
+
+_circuits = {}  # upstream -> {'state', 'failures', 'threshold', 'open_seconds', 'probe_at', 'opened_at'}
+_probes = {}    # upstream -> функция проверки: True/ничего - сервис доступен, False/исключение - нет
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_prober = None
+_local = threading.local()
+
+
+def _circuit_locked(upstream):
+    """Состояние цепи сервиса (под _lock)"""
+    circuit = _circuits.get(upstream)
+    if circuit is None:
+        circuit = _circuits[upstream] = {
+            'state': CLOSED,
+            'failures': 0,
+            # 0 - выключить размыкание для сервиса
+            'threshold': int(_env(upstream, 'FAILURE_THRESHOLD', '5')),
+            'open_seconds': float(_env(upstream, 'OPEN_SECONDS', '15')),
+            'probe_at': 0,
+            'opened_at': None
+        }
+    return circuit
+
+
+def register_probe(upstream, probe, default=False):
+    """Задать проверку сервиса для half-open. default - не заменять уже заданную"""
+    with _lock:
+        if default and upstream in _probes:
+            return
+        _probes[upstream] = probe
+
+
+def before_call(upstream):
+    """Проверить цепь перед вызовом: бросает CircuitOpenError, если она разомкнута"""
+    if getattr(_local, 'probing', None) == upstream:
+        return
+    with _lock:
+        circuit = _circuit_locked(upstream)
+        if circuit['state'] == CLOSED:
+            return
+    metrics.incr(f'circuit_{upstream}_rejected')
+    raise CircuitOpenError(upstream)
+
+
+def is_open(upstream):
+    """Цепь разомкнута (вызовы сейчас получат CircuitOpenError)"""
+    with _lock:
+        return _circuit_locked(upstream)['state'] != CLOSED
+
+
+def record_success(upstream):
+    """Вызов прошел - сбрасываем счетчик ошибок"""
+    with _lock:
+        circuit = _circuit_locked(upstream)
+        circuit['failures'] = 0
+        if circuit['state'] != CLOSED:
+            _close_locked(upstream, circuit)
+
+
+def record_failure(upstream):
+    """Вызов не дошел до сервиса - после threshold ошибок подряд размыкаем цепь"""
+    with _lock:
+        circuit = _circuit_locked(upstream)
+        circuit['failures'] += 1
+        if (circuit['state'] == CLOSED and circuit['threshold']
+                and circuit['failures'] >= circuit['threshold']):
+            _open_locked(upstream, circuit)
+
+
+def _open_locked(upstream, circuit):
+    circuit['state'] = OPEN
+    circuit['opened_at'] = time.time()
+    circuit['probe_at'] = time.monotonic() + circuit['open_seconds']
+    print(f"🔌 {upstream}: {circuit['failures']} ошибок подряд, цепь разомкнута на {circuit['open_seconds']:g} с")
+    metrics.incr(f'circuit_{upstream}_opened')
+    metrics.set_gauge(f'circuit_{upstream}_open', 1)
+    _start_prober_locked()
+    _wakeup.notify()
+
+
+def _close_locked(upstream, circuit):
+    print(f"🔌 {upstream}: сервис снова доступен, цепь замкнута")
+    circuit['state'] = CLOSED
+    circuit['opened_at'] = None
+    metrics.set_gauge(f'circuit_{upstream}_open', 0)
+
+
+def _start_prober_locked():
+    global _prober
+    if _prober is None:
+        _prober = threading.Thread(target=_probe_loop, name='circuit-prober', daemon=True)
+        _prober.start()
+
+
+def _probe_loop():
+    """Проверять разомкнутые цепи по мере наступления их времени"""
+    while True:
+        with _lock:
+            now = time.monotonic()
+            due = [name for name, circuit in _circuits.items()
+                   if circuit['state'] == OPEN and circuit['probe_at'] <= now]
+            if not due:
+                waits = [circuit['probe_at'] - now for circuit in _circuits.values() if circuit['state'] == OPEN]
+                _wakeup.wait(min(waits) if waits else None)
+                continue
+            for name in due:
+                _circuits[name]['state'] = HALF_OPEN
+
+        for name in due:
+            _probe(name)
+
+
+def _probe(upstream):
+    """Проверка half-open: успех замыкает цепь, ошибка оставляет разомкнутой еще на open_seconds"""
+    probe = _probes.get(upstream)
+    if probe is None:
+        # Проверять нечем - пропускаем вызовы, первая же ошибка разомкнет цепь снова
+        with _lock:
+            circuit = _circuits[upstream]
+            circuit['failures'] = max(0, circuit['threshold'] - 1)
+            _close_locked(upstream, circuit)
+        return
+
+    _local.probing = upstream
+    try:
+        healthy = probe() is not False
+    except Exception as e:
+        print(f"🔌 {upstream}: проверка не прошла: {e}")
+        healthy = False
+    finally:
+        _local.probing = None
+    metrics.incr(f'circuit_{upstream}_probes')
+
+    with _lock:
+        circuit = _circuits[upstream]
+        if healthy:
+            circuit['failures'] = 0
+            if circuit['state'] != CLOSED:
+                _close_locked(upstream, circuit)
+        elif circuit['state'] == HALF_OPEN:
+            circuit['state'] = OPEN
+            circuit['probe_at'] = time.monotonic() + circuit['open_seconds']
+
+
+def snapshot():
+    """Состояние всех цепей (для /api/metrics)"""
+    with _lock:
+        return {
+            name: {
+                'state': circuit['state'],
+                'failures': circuit['failures'],
+                'opened_at': circuit['opened_at']
+            }
+            for name, circuit in _circuits.items()
+        }
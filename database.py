@@ -4,39 +4,179 @@ Database module for storing customer information
 """
 
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import metrics
+
 # Определяем тип БД
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 if DATABASE_URL:
     # PostgreSQL (Railway)
-    import psycopg2
     from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool, PoolError
     USE_POSTGRES = True
     print("📊 Using PostgreSQL database")
 else:
     # SQLite (локально)
     import sqlite3
     USE_POSTGRES = False
-    DB_PATH = os.path.join(os.path.dirname(__file__), 'customers.db')
+    DB_PATH = os.environ.get('SQLITE_DB_PATH') or os.path.join(os.path.dirname(__file__), 'customers.db')
+    # INSERT ... RETURNING появился в SQLite 3.35
+    SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
     print("📊 Using SQLite database")
 
+# Пул соединений PostgreSQL: сколько держать открытыми и сколько максимум,
+# сколько секунд ждать свободное соединение
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+
+# Поиск клиентов: триграммный индекс помогает только запросам от 3 символов
+SEARCH_MIN_INDEXED_LENGTH = 3
+SEARCH_LIMIT = 50
+# Сколько совпадений ранжировать: частый запрос не перебирает весь индекс
+SEARCH_CANDIDATES = 1000
+# Текст, по которому ищем в PostgreSQL (выражение GIN индекса pg_trgm)
+_SEARCH_DOCUMENT = "coalesce(name, '') || ' ' || coalesce(vin, '') || ' ' || coalesce(phone, '') || ' ' || coalesce(comments, '')"
+_search_index = False  # pg_trgm (PostgreSQL) или FTS5 trigram (SQLite) создан
+
+_pool = None
+_pool_pid = None
+_pool_slots = None  # ThreadedConnectionPool не ждет свободное соединение - ждем сами
+_pool_lock = threading.Lock()
+_local = threading.local()  # соединение текущего потока: SQLite - постоянное, PostgreSQL - на время connection()
+
+
+def _get_pool():
+    """Пул соединений PostgreSQL (свой в каждом процессе gunicorn)"""
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL)
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+        return _pool, _pool_slots
+
+
+def _sqlite_connection():
+    """Постоянное соединение SQLite текущего потока"""
+    conn = getattr(_local, 'sqlite', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        _local.sqlite = conn
+        metrics.incr('db_connections_opened')
+    return conn
+
+
+@contextmanager
+def connection():
+    """
+    Соединение с БД на время блока: коммит при успехе, откат при ошибке.
+
+    PostgreSQL - соединение из пула, SQLite - постоянное соединение потока.
+    Вложенные вызовы в том же потоке получают то же соединение, коммит - во внешнем.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
 
-def get_connection():
-    """Получить подключение к БД"""
     if USE_POSTGRES:
-        return psycopg2.connect(DATABASE_URL)
+        pool, slots = _get_pool()
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            metrics.incr('db_pool_timeouts')
+            raise PoolError(f"нет свободного соединения за {DB_POOL_TIMEOUT} с")
+        try:
+            conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
     else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        conn = _sqlite_connection()
+
+    _local.conn = conn
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        _local.conn = None
+        if USE_POSTGRES:
+            # Разорванное соединение не возвращаем в пул
+            pool.putconn(conn, close=bool(conn.closed))
+            slots.release()
+
+
+def _dict_cursor(conn):
+    """Курсор, строки которого можно превратить в dict"""
+    if USE_POSTGRES:
+        return conn.cursor(cursor_factory=RealDictCursor)
+    return conn.cursor()
 
 
 def init_database():
     """Инициализация базы данных"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    with connection() as conn:
+        _create_tables(conn.cursor())
+    _init_search_index()
+    print("✅ Database initialized")
+
+
+def _init_search_index():
+    """Индекс для search_customers: GIN pg_trgm (PostgreSQL) или FTS5 trigram (SQLite 3.34+)"""
+    global _search_index
+    try:
+        with connection() as conn:
+            cursor = conn.cursor()
+            if USE_POSTGRES:
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                cursor.execute(f'''
+                    CREATE INDEX IF NOT EXISTS idx_customers_search_trgm
+                    ON customers USING GIN (({_SEARCH_DOCUMENT}) gin_trgm_ops)
+                ''')
+            else:
+                # Копия полей клиента, rowid = customers.id; обновляется в save_customer
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts
+                    USING fts5(name, vin, phone, comments, tokenize='trigram')
+                ''')
+                # Сверяем содержимое, а не только количество: клиенты могли измениться
+                # в обход save_customer (ручная правка БД, сбой между записями)
+                cursor.execute('''
+                    SELECT
+                        (SELECT count(*) FROM customers),
+                        (SELECT count(*) FROM customers c
+                         LEFT JOIN customers_fts f ON f.rowid = c.id
+                         WHERE f.rowid IS NULL OR f.name IS NOT c.name OR f.vin IS NOT c.vin
+                            OR f.phone IS NOT c.phone OR f.comments IS NOT c.comments),
+                        (SELECT count(*) FROM customers_fts
+                         WHERE rowid NOT IN (SELECT id FROM customers))
+                ''')
+                customers_count, outdated_count, orphaned_count = cursor.fetchone()
+                if outdated_count or orphaned_count:
+                    cursor.execute('DELETE FROM customers_fts')
+                    cursor.execute('''
+                        INSERT INTO customers_fts (rowid, name, vin, phone, comments)
+                        SELECT id, name, vin, phone, comments FROM customers
+                    ''')
+                    print(f"🔎 Customer search index rebuilt: {customers_count} customers")
+        _search_index = True
+    except Exception as e:
+        print(f"⚠️ Customer search index unavailable, searching without index: {e}")
+
+
+def _create_tables(cursor):
+    """Создать таблицы и индексы"""
     
     if USE_POSTGRES:
         # PostgreSQL синтаксис
@@ -222,142 +362,140 @@ def init_database():
             CREATE INDEX IF NOT EXISTS idx_yclients_integrations_company_id 
             ON yclients_integrations(company_id)
         ''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized")
 
 
 def get_customer(source, source_id):
     """Получить информацию о клиенте"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-    else:
-        cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM customers 
-        WHERE source = %s AND source_id = %s
-    ''' if USE_POSTGRES else '''
-        SELECT * FROM customers 
-        WHERE source = ? AND source_id = ?
-    ''', (source, source_id))
-    
-    row = cursor.fetchone()
-    conn.close()
-    
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        cursor.execute('''
+            SELECT * FROM customers
+            WHERE source = %s AND source_id = %s
+        ''' if USE_POSTGRES else '''
+            SELECT * FROM customers
+            WHERE source = ? AND source_id = ?
+        ''', (source, source_id))
+        row = cursor.fetchone()
+
     if row:
         return dict(row)
     return None
 
 
 def save_customer(source, source_id, name=None, vin=None, phone=None, comments=None):
-    """Сохранить/обновить информацию о клиенте"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Проверяем существует ли клиент
-    existing = get_customer(source, source_id)
-    
-    if existing:
-        # Обновляем существующего
-        update_fields = []
-        params = []
-        
-        if name is not None:
-            update_fields.append('name = %s' if USE_POSTGRES else 'name = ?')
-            params.append(name)
-        if vin is not None:
-            update_fields.append('vin = %s' if USE_POSTGRES else 'vin = ?')
-            params.append(vin)
-        if phone is not None:
-            update_fields.append('phone = %s' if USE_POSTGRES else 'phone = ?')
-            params.append(phone)
-        if comments is not None:
-            update_fields.append('comments = %s' if USE_POSTGRES else 'comments = ?')
-            params.append(comments)
-        
-        update_fields.append('updated_at = %s' if USE_POSTGRES else 'updated_at = ?')
-        params.append(datetime.now())
-        
-        params.extend([source, source_id])
-        
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cursor.execute(f'''
-            UPDATE customers 
-            SET {', '.join(update_fields)}
-            WHERE source = {placeholder} AND source_id = {placeholder}
-        ''', params)
-    else:
-        # Создаем нового
-        placeholder = '%s' if USE_POSTGRES else '?'
-        cursor.execute(f'''
-            INSERT INTO customers (source, source_id, name, vin, phone, comments)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-        ''', (source, source_id, name, vin, phone, comments))
-    
-    conn.commit()
-    conn.close()
-    
-    return get_customer(source, source_id)
+    """
+    Сохранить/обновить информацию о клиенте одним запросом (INSERT ... ON CONFLICT DO UPDATE).
 
+    Поля со значением None не меняются. Возвращает сохраненную запись.
+    """
+    placeholder = '%s' if USE_POSTGRES else '?'
+    upsert = f'''
+        INSERT INTO customers (source, source_id, name, vin, phone, comments)
+        VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ON CONFLICT (source, source_id) DO UPDATE SET
+            name = COALESCE(excluded.name, customers.name),
+            vin = COALESCE(excluded.vin, customers.vin),
+            phone = COALESCE(excluded.phone, customers.phone),
+            comments = COALESCE(excluded.comments, customers.comments),
+            updated_at = {placeholder}
+    '''
+    params = (source, source_id, name, vin, phone, comments, datetime.now())
+
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        if USE_POSTGRES or SQLITE_HAS_RETURNING:
+            cursor.execute(upsert + ' RETURNING *', params)
+            row = cursor.fetchone()
+        else:
+            # SQLite до 3.35 не поддерживает RETURNING - читаем запись в той же транзакции
+            cursor.execute(upsert, params)
+            cursor.execute('''
+                SELECT * FROM customers
+                WHERE source = ? AND source_id = ?
+            ''', (source, source_id))
+            row = cursor.fetchone()
 
-def search_customers(query):
-    """Поиск клиентов по имени, VIN, телефону"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-    else:
-        cursor = conn.cursor()
-    
+        if row and _search_index and not USE_POSTGRES:
+            cursor.execute('''
+                INSERT OR REPLACE INTO customers_fts (rowid, name, vin, phone, comments)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (row['id'], row['name'], row['vin'], row['phone'], row['comments']))
+
+    return dict(row) if row else None
+
+
+def search_customers(query, limit=SEARCH_LIMIT):
+    """
+    Поиск клиентов по имени, VIN, телефону и комментариям.
+
+    По индексу (запрос от 3 символов) результаты отсортированы по релевантности,
+    иначе - перебор LIKE, недавно измененные первыми.
+    """
+    query = query.strip()
     search_pattern = f'%{query}%'
-    
-    if USE_POSTGRES:
-        cursor.execute('''
-            SELECT * FROM customers 
-            WHERE name ILIKE %s OR vin ILIKE %s OR phone ILIKE %s OR comments ILIKE %s
-            ORDER BY updated_at DESC
-            LIMIT 50
-        ''', (search_pattern, search_pattern, search_pattern, search_pattern))
-    else:
-        cursor.execute('''
-            SELECT * FROM customers 
-            WHERE name LIKE ? OR vin LIKE ? OR phone LIKE ? OR comments LIKE ?
-            ORDER BY updated_at DESC
-            LIMIT 50
-        ''', (search_pattern, search_pattern, search_pattern, search_pattern))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
+    indexed = _search_index and len(query) >= SEARCH_MIN_INDEXED_LENGTH
+
+    started = time.monotonic()
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        if USE_POSTGRES and indexed:
+            cursor.execute(f'''
+                SELECT * FROM (
+                    SELECT * FROM customers
+                    WHERE {_SEARCH_DOCUMENT} ILIKE %s
+                    LIMIT %s
+                ) AS found
+                ORDER BY word_similarity(%s, {_SEARCH_DOCUMENT}) DESC, updated_at DESC
+                LIMIT %s
+            ''', (search_pattern, SEARCH_CANDIDATES, query, limit))
+        elif USE_POSTGRES:
+            cursor.execute('''
+                SELECT * FROM customers
+                WHERE name ILIKE %s OR vin ILIKE %s OR phone ILIKE %s OR comments ILIKE %s
+                ORDER BY updated_at DESC
+                LIMIT %s
+            ''', (search_pattern, search_pattern, search_pattern, search_pattern, limit))
+        elif indexed:
+            # Запрос - одна фраза FTS5: подстрока в любом из полей, без учета регистра
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute('''
+                SELECT customers.* FROM (
+                    SELECT rowid, bm25(customers_fts) AS score FROM customers_fts
+                    WHERE customers_fts MATCH ?
+                    LIMIT ?
+                ) AS found
+                JOIN customers ON customers.id = found.rowid
+                ORDER BY found.score, customers.updated_at DESC
+                LIMIT ?
+            ''', (phrase, SEARCH_CANDIDATES, limit))
+        else:
+            cursor.execute('''
+                SELECT * FROM customers
+                WHERE name LIKE ? OR vin LIKE ? OR phone LIKE ? OR comments LIKE ?
+                ORDER BY updated_at DESC
+                LIMIT ?
+            ''', (search_pattern, search_pattern, search_pattern, search_pattern, limit))
+        rows = cursor.fetchall()
+    metrics.observe('customer_search_ms' if indexed else 'customer_search_scan_ms', (time.monotonic() - started) * 1000)
+
     return [dict(row) for row in rows]
 
 
 def get_all_customers(limit=100):
     """Получить всех клиентов"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
         cursor.execute('''
-            SELECT * FROM customers 
+            SELECT * FROM customers
             ORDER BY updated_at DESC
             LIMIT %s
-        ''', (limit,))
-    else:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM customers 
+        ''' if USE_POSTGRES else '''
+            SELECT * FROM customers
             ORDER BY updated_at DESC
             LIMIT ?
         ''', (limit,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
+        rows = cursor.fetchall()
+
     return [dict(row) for row in rows]
 
 
@@ -365,94 +503,73 @@ def get_all_customers(limit=100):
 
 def get_all_templates():
     """Получить все шаблоны сообщений"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('SELECT * FROM message_templates ORDER BY created_at DESC')
-    else:
-        cursor = conn.cursor()
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
         cursor.execute('SELECT * FROM message_templates ORDER BY created_at DESC')
-    
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 
 def get_template(template_id):
     """Получить шаблон по ID"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('SELECT * FROM message_templates WHERE id = %s', (template_id,))
-    else:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM message_templates WHERE id = ?', (template_id,))
-    
-    row = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        if USE_POSTGRES:
+            cursor.execute('SELECT * FROM message_templates WHERE id = %s', (template_id,))
+        else:
+            cursor.execute('SELECT * FROM message_templates WHERE id = ?', (template_id,))
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 
 def get_template_by_type(template_type):
     """Получить активный шаблон по типу"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('''
-            SELECT * FROM message_templates 
-            WHERE type = %s AND is_active = TRUE 
-            ORDER BY created_at DESC 
-            LIMIT 1
-        ''', (template_type,))
-    else:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM message_templates 
-            WHERE type = ? AND is_active = 1 
-            ORDER BY created_at DESC 
-            LIMIT 1
-        ''', (template_type,))
-    
-    row = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        if USE_POSTGRES:
+            cursor.execute('''
+                SELECT * FROM message_templates
+                WHERE type = %s AND is_active = TRUE
+                ORDER BY created_at DESC
+                LIMIT 1
+            ''', (template_type,))
+        else:
+            cursor.execute('''
+                SELECT * FROM message_templates
+                WHERE type = ? AND is_active = 1
+                ORDER BY created_at DESC
+                LIMIT 1
+            ''', (template_type,))
+        row = cursor.fetchone()
     return dict(row) if row else None
 
 
 def create_template(name, template_type, text, is_active=True):
     """Создать новый шаблон"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute('''
-            INSERT INTO message_templates (name, type, text, is_active)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        ''', (name, template_type, text, is_active))
-        template_id = cursor.fetchone()[0]
-    else:
-        cursor.execute('''
-            INSERT INTO message_templates (name, type, text, is_active)
-            VALUES (?, ?, ?, ?)
-        ''', (name, template_type, text, 1 if is_active else 0))
-        template_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
-    return get_template(template_id)
+    with connection() as conn:
+        cursor = conn.cursor()
+        if USE_POSTGRES:
+            cursor.execute('''
+                INSERT INTO message_templates (name, type, text, is_active)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            ''', (name, template_type, text, is_active))
+            template_id = cursor.fetchone()[0]
+        else:
+            cursor.execute('''
+                INSERT INTO message_templates (name, type, text, is_active)
+                VALUES (?, ?, ?, ?)
+            ''', (name, template_type, text, 1 if is_active else 0))
+            template_id = cursor.lastrowid
+
+        return get_template(template_id)
 
 
 def update_template(template_id, name=None, template_type=None, text=None, is_active=None):
     """Обновить шаблон"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     update_fields = []
     params = []
-    
+
     if name is not None:
         update_fields.append('name = %s' if USE_POSTGRES else 'name = ?')
         params.append(name)
@@ -465,155 +582,131 @@ def update_template(template_id, name=None, template_type=None, text=None, is_ac
     if is_active is not None:
         update_fields.append('is_active = %s' if USE_POSTGRES else 'is_active = ?')
         params.append(1 if is_active else 0 if not USE_POSTGRES else is_active)
-    
+
     update_fields.append('updated_at = %s' if USE_POSTGRES else 'updated_at = ?')
     params.append(datetime.now())
     params.append(template_id)
-    
+
     placeholder = '%s' if USE_POSTGRES else '?'
-    cursor.execute(f'''
-        UPDATE message_templates 
-        SET {', '.join(update_fields)}
-        WHERE id = {placeholder}
-    ''', params)
-    
-    conn.commit()
-    conn.close()
-    return get_template(template_id)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            UPDATE message_templates
+            SET {', '.join(update_fields)}
+            WHERE id = {placeholder}
+        ''', params)
+
+        return get_template(template_id)
 
 
 def delete_template(template_id):
     """Удалить шаблон"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute('DELETE FROM message_templates WHERE id = %s', (template_id,))
-    else:
-        cursor.execute('DELETE FROM message_templates WHERE id = ?', (template_id,))
-    
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        if USE_POSTGRES:
+            cursor.execute('DELETE FROM message_templates WHERE id = %s', (template_id,))
+        else:
+            cursor.execute('DELETE FROM message_templates WHERE id = ?', (template_id,))
 
 
 # ==================== Функции для работы с отложенными задачами ====================
 
 def create_scheduled_message(phone, fullname, template_type, message_text, send_at, chat_id=None, source=None):
     """Создать отложенную задачу отправки сообщения"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute('''
-            INSERT INTO scheduled_messages (phone, fullname, template_type, message_text, send_at, chat_id, source)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (phone, fullname, template_type, message_text, send_at, chat_id, source))
-        task_id = cursor.fetchone()[0]
-    else:
-        cursor.execute('''
-            INSERT INTO scheduled_messages (phone, fullname, template_type, message_text, send_at, chat_id, source)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (phone, fullname, template_type, message_text, send_at, chat_id, source))
-        task_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        if USE_POSTGRES:
+            cursor.execute('''
+                INSERT INTO scheduled_messages (phone, fullname, template_type, message_text, send_at, chat_id, source)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (phone, fullname, template_type, message_text, send_at, chat_id, source))
+            task_id = cursor.fetchone()[0]
+        else:
+            cursor.execute('''
+                INSERT INTO scheduled_messages (phone, fullname, template_type, message_text, send_at, chat_id, source)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (phone, fullname, template_type, message_text, send_at, chat_id, source))
+            task_id = cursor.lastrowid
+
     return task_id
 
 
 def get_pending_scheduled_messages():
     """Получить все неотправленные отложенные задачи, время отправки которых наступило"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('''
-            SELECT * FROM scheduled_messages 
-            WHERE sent = FALSE AND send_at <= CURRENT_TIMESTAMP
-            ORDER BY send_at ASC
-        ''')
-    else:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM scheduled_messages 
-            WHERE sent = 0 AND send_at <= datetime('now')
-            ORDER BY send_at ASC
-        ''')
-    
-    rows = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = _dict_cursor(conn)
+        if USE_POSTGRES:
+            cursor.execute('''
+                SELECT * FROM scheduled_messages
+                WHERE sent = FALSE AND send_at <= CURRENT_TIMESTAMP
+                ORDER BY send_at ASC
+            ''')
+        else:
+            cursor.execute('''
+                SELECT * FROM scheduled_messages
+                WHERE sent = 0 AND send_at <= datetime('now')
+                ORDER BY send_at ASC
+            ''')
+        rows = cursor.fetchall()
     return [dict(row) for row in rows]
 
 
 def mark_scheduled_message_sent(task_id, error=None):
     """Пометить отложенную задачу как отправленную"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    if USE_POSTGRES:
-        cursor.execute('''
-            UPDATE scheduled_messages 
-            SET sent = TRUE, sent_at = CURRENT_TIMESTAMP, error = %s
-            WHERE id = %s
-        ''', (error, task_id))
-    else:
-        cursor.execute('''
-            UPDATE scheduled_messages 
-            SET sent = 1, sent_at = datetime('now'), error = ?
-            WHERE id = ?
-        ''', (error, task_id))
-    
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        if USE_POSTGRES:
+            cursor.execute('''
+                UPDATE scheduled_messages
+                SET sent = TRUE, sent_at = CURRENT_TIMESTAMP, error = %s
+                WHERE id = %s
+            ''', (error, task_id))
+        else:
+            cursor.execute('''
+                UPDATE scheduled_messages
+                SET sent = 1, sent_at = datetime('now'), error = ?
+                WHERE id = ?
+            ''', (error, task_id))
 
 
 # ==================== Функции для отслеживания обработанных записей YClients ====================
 
 def mark_record_processed(yclients_record_id, phone, fullname=None, datetime_value=None):
     """Пометить запись YClients как обработанную"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     try:
-        if USE_POSTGRES:
-            cursor.execute('''
-                INSERT INTO processed_yclients_records (yclients_record_id, phone, fullname, datetime)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (yclients_record_id) DO NOTHING
-            ''', (str(yclients_record_id), phone, fullname, datetime_value))
-        else:
-            cursor.execute('''
-                INSERT OR IGNORE INTO processed_yclients_records (yclients_record_id, phone, fullname, datetime)
-                VALUES (?, ?, ?, ?)
-            ''', (str(yclients_record_id), phone, fullname, datetime_value))
-        
-        conn.commit()
+        with connection() as conn:
+            cursor = conn.cursor()
+            if USE_POSTGRES:
+                cursor.execute('''
+                    INSERT INTO processed_yclients_records (yclients_record_id, phone, fullname, datetime)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (yclients_record_id) DO NOTHING
+                ''', (str(yclients_record_id), phone, fullname, datetime_value))
+            else:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO processed_yclients_records (yclients_record_id, phone, fullname, datetime)
+                    VALUES (?, ?, ?, ?)
+                ''', (str(yclients_record_id), phone, fullname, datetime_value))
     except Exception as e:
         print(f"⚠️ Ошибка сохранения обработанной записи: {e}")
-    finally:
-        conn.close()
 
 
 def is_record_processed(yclients_record_id):
     """Проверить, была ли запись уже обработана"""
-    conn = get_connection()
-    
-    if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute('''
-            SELECT * FROM processed_yclients_records 
-            WHERE yclients_record_id = %s
-        ''', (str(yclients_record_id),))
-    else:
+    with connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM processed_yclients_records 
-            WHERE yclients_record_id = ?
-        ''', (str(yclients_record_id),))
-    
-    row = cursor.fetchone()
-    conn.close()
+        if USE_POSTGRES:
+            cursor.execute('''
+                SELECT 1 FROM processed_yclients_records
+                WHERE yclients_record_id = %s
+            ''', (str(yclients_record_id),))
+        else:
+            cursor.execute('''
+                SELECT 1 FROM processed_yclients_records
+                WHERE yclients_record_id = ?
+            ''', (str(yclients_record_id),))
+        row = cursor.fetchone()
     return row is not None
 
 
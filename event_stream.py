@@ -0,0 +1,105 @@
+"""
+Event Stream
+Рассылка событий (new-message, read-state, messages-changed, chat-updated) подписчикам /api/events (SSE)
+"""
+
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+# Сколько событий может накопиться у медленного клиента
+SUBSCRIBER_QUEUE_SIZE = 200
+# Как часто слать комментарий-пинг, чтобы прокси не закрывали соединение
+HEARTBEAT_INTERVAL = 15
+# Через сколько секунд закрывать поток (браузер переподключится сам)
+MAX_STREAM_DURATION = 300
+# Каждый поток занимает поток gunicorn (--threads 16) - сверх лимита отвечаем 503,
+# и вкладка остается на обычном опросе
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', '8'))
+
+_subscribers = set()
+_lock = threading.Lock()
+_event_ids = itertools.count(1)
+
+
+def publish(event_type, data):
+    """Отправить событие всем подписчикам (не блокирует, можно вызывать из любого потока)"""
+    event = {'id': next(_event_ids), 'type': event_type, 'data': data}
+    with _lock:
+        subscribers = list(_subscribers)
+
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # Клиент не успевает читать - сбрасываем очередь и просим перезагрузить данные
+            _drain(subscriber)
+            try:
+                subscriber.put_nowait({'id': event['id'], 'type': 'resync', 'data': {}})
+            except queue.Full:
+                pass
+            metrics.incr('events_overflow')
+
+    metrics.incr('events_published')
+
+
+def _drain(subscriber):
+    try:
+        while True:
+            subscriber.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def has_capacity():
+    """Можно ли открыть еще один поток событий"""
+    with _lock:
+        return len(_subscribers) < EVENTS_MAX_SUBSCRIBERS
+
+
+def subscribe():
+    """Создать очередь подписчика"""
+    subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with _lock:
+        _subscribers.add(subscriber)
+        metrics.set_gauge('events_subscribers', len(_subscribers))
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    """Удалить очередь подписчика"""
+    with _lock:
+        _subscribers.discard(subscriber)
+        metrics.set_gauge('events_subscribers', len(_subscribers))
+
+
+def _format(event):
+    data = json.dumps(event['data'], ensure_ascii=False, default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+def stream():
+    """
+    Генератор кадров Server-Sent Events.
+
+    Подписка создается внутри генератора: если клиент отключится до первого кадра,
+    генератор не запустится и подписки не будет, иначе finally удалит ее.
+    """
+    subscriber = subscribe()
+    deadline = time.monotonic() + MAX_STREAM_DURATION
+    try:
+        yield "retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            try:
+                event = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            yield _format(event)
+    finally:
+        unsubscribe(subscriber)
@@ -0,0 +1,116 @@
+"""
+HTTP Sessions
+Общие keep-alive сессии для внешних сервисов (Avito, WhatsApp, YClients)
+"""
+
+import os
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import circuit_breaker
+
+# Ответы, означающие, что сервис (или прокси перед ним) недоступен
+UNAVAILABLE_STATUSES = (502, 503, 504)
+
+# Таймаут чтения по умолчанию для сервиса (если не задан HTTP_READ_TIMEOUT[_<UPSTREAM>])
+DEFAULT_READ_TIMEOUTS = {'whatsapp': '10', 'yclients': '10'}
+
+
+def _env(upstream, key, default):
+    """Настройка для конкретного сервиса (HTTP_<KEY>_<UPSTREAM>) или общая (HTTP_<KEY>)"""
+    value = os.environ.get(f'HTTP_{key}_{upstream.upper()}')
+    if value is None:
+        value = os.environ.get(f'HTTP_{key}', default)
+    return value
+
+
+class UpstreamSession(requests.Session):
+    """Сессия с таймаутом по умолчанию и размыканием цепи при недоступности сервиса"""
+
+    def __init__(self, upstream, timeout, keep_alive=True):
+        super().__init__()
+        self.upstream = upstream
+        self.default_timeout = timeout
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        circuit_breaker.before_call(self.upstream)
+        _last_urls[self.upstream] = url
+        try:
+            response = super().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            circuit_breaker.record_failure(self.upstream)
+            raise
+        if response.status_code in UNAVAILABLE_STATUSES:
+            circuit_breaker.record_failure(self.upstream)
+        else:
+            circuit_breaker.record_success(self.upstream)
+        return response
+
+
+# Пулы соединений общие для всех потоков, сессии - свои в каждом потоке
+# (urllib3 пул потокобезопасен, а состояние requests.Session - нет)
+_adapters = {}
+_adapters_lock = threading.Lock()
+_local = threading.local()
+_last_urls = {}  # upstream -> последний запрошенный URL (адрес для проверки соединения)
+
+
+def _get_adapter(upstream):
+    """Получить (или создать) общий пул соединений для сервиса"""
+    with _adapters_lock:
+        adapter = _adapters.get(upstream)
+        if adapter is None:
+            adapter = HTTPAdapter(
+                pool_connections=int(_env(upstream, 'POOL_CONNECTIONS', '4')),
+                pool_maxsize=int(_env(upstream, 'POOL_MAXSIZE', '20'))
+            )
+            _adapters[upstream] = adapter
+        return adapter
+
+
+def _probe_connect(upstream):
+    """Проверка по умолчанию: удается ли открыть TCP соединение с сервисом"""
+    url = urlsplit(_last_urls[upstream])
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    timeout = float(_env(upstream, 'CONNECT_TIMEOUT', '5'))
+    socket.create_connection((url.hostname, port), timeout=timeout).close()
+
+
+def get_session(upstream):
+    """Получить keep-alive сессию для сервиса (avito, whatsapp, yclients)"""
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+
+    session = sessions.get(upstream)
+    if session is None:
+        timeout = (
+            float(_env(upstream, 'CONNECT_TIMEOUT', '5')),
+            float(_env(upstream, 'READ_TIMEOUT', DEFAULT_READ_TIMEOUTS.get(upstream, '30')))
+        )
+        keep_alive = _env(upstream, 'KEEP_ALIVE', '1') not in ('0', 'false', 'False')
+        session = UpstreamSession(upstream, timeout, keep_alive=keep_alive)
+        adapter = _get_adapter(upstream)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        sessions[upstream] = session
+        circuit_breaker.register_probe(upstream, lambda: _probe_connect(upstream), default=True)
+
+    return session
+
+
+def close_all():
+    """Закрыть все пулы соединений"""
+    with _adapters_lock:
+        for adapter in _adapters.values():
+            adapter.close()
+        _adapters.clear()
+    _local.sessions = {}
@@ -0,0 +1,50 @@
+"""
+Metrics
+Простые счетчики, значения и замеры времени внутри процесса (отдаются через /api/metrics)
+"""
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    """Увеличить счетчик"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """Установить текущее значение (глубина очереди и т.п.)"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, ms):
+    """Записать замер времени в миллисекундах"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0}
+        timing['count'] += 1
+        timing['total_ms'] += ms
+        timing['last_ms'] = ms
+        if ms > timing['max_ms']:
+            timing['max_ms'] = ms
+
+
+def snapshot():
+    """Получить копию всех метрик"""
+    with _lock:
+        timings = {}
+        for name, timing in _timings.items():
+            timings[name] = dict(timing)
+            timings[name]['avg_ms'] = round(timing['total_ms'] / timing['count'], 2) if timing['count'] else 0
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timings': timings
+        }
@@ -2,12 +2,41 @@
 Модуль для отправки уведомлений клиентам через Telegram/WhatsApp
 """
 
+import os
 import re
+import threading
 import database
+import http_client
 import telegram_client
 import whatsapp_client
 from datetime import datetime, timedelta
 
+# Отдельный процесс задач (python scheduler.py) не открывает свою сессию Telethon:
+# файл сессии и авторизация принадлежат веб-процессу, Telegram отправляется через его API
+WEB_APP_URL = os.environ.get('WEB_APP_URL', f"http://127.0.0.1:{os.environ.get('PORT', '5000')}")
+_telegram_via_web = False
+
+
+def use_web_for_telegram():
+    """Отправлять Telegram через веб-процесс (вызывается в процессе воркера)"""
+    global _telegram_via_web
+    _telegram_via_web = True
+
+
+def _send_telegram_via_web(chat_id, text):
+    """Отправить сообщение Telegram через /api/messages/send веб-процесса"""
+    try:
+        response = http_client.get_session('web').post(
+            f'{WEB_APP_URL}/api/messages/send',
+            json={'chat_id': chat_id, 'message': text}
+        )
+        data = response.json()
+    except Exception as e:
+        return {'success': False, 'error': f'Веб-процесс недоступен: {e}'}
+    if response.status_code == 200 and data.get('success'):
+        return {'success': True}
+    return {'success': False, 'error': data.get('error', f'HTTP {response.status_code}')}
+
 
 def format_template(template_text, variables):
     """Форматировать шаблон, подставляя переменные"""
@@ -37,9 +66,9 @@ def find_chat_by_phone(phone):
     
     normalized_phone = normalize_phone(phone)
     
-    # Пробуем найти в Telegram чатах
+    # Пробуем найти в Telegram чатах (в процессе воркера Telegram не подключен)
     try:
-        telegram_chats = telegram_client.get_telegram_chats(limit=200)
+        telegram_chats = [] if _telegram_via_web else telegram_client.get_telegram_chats(limit=200)
         for chat in telegram_chats:
             # В Telegram номера телефонов не всегда доступны через API
             # Но можно проверить по имени или другим признакам
@@ -92,7 +121,9 @@ def send_notification(phone, fullname, template_type, variables=None):
     
     # Отправляем сообщение
     try:
-        if source == 'telegram':
+        if source == 'telegram' and _telegram_via_web:
+            result = _send_telegram_via_web(chat_id, message_text)
+        elif source == 'telegram':
             result = telegram_client.send_telegram_message(chat_id, message_text)
         elif source == 'whatsapp':
             result = whatsapp_client.send_whatsapp_message(chat_id, message_text)
@@ -171,12 +202,46 @@ def schedule_review_request(phone, fullname, booking_datetime, variables=None):
         return False
 
 
+# Задачи, сообщения которых стоят в очереди Telegram: в БД они остаются неотправленными
+# (после перезапуска отправятся снова), а повторно в очередь не попадают
+_claimed_tasks = set()
+_claimed_lock = threading.Lock()
+
+
+def _claim_task(task_id):
+    """Занять задачу для отправки через очередь. False - она уже в очереди"""
+    with _claimed_lock:
+        if task_id in _claimed_tasks:
+            return False
+        _claimed_tasks.add(task_id)
+        return True
+
+
+def _release_task(task_id):
+    with _claimed_lock:
+        _claimed_tasks.discard(task_id)
+
+
+def _record_telegram_result(task_id, result):
+    """Записать итог отправки из очереди Telegram в отложенную задачу"""
+    try:
+        if result.get('success'):
+            database.mark_scheduled_message_sent(task_id, error=None)
+            print(f"✅ Отложенное сообщение отправлено (задача {task_id})")
+        else:
+            database.mark_scheduled_message_sent(task_id, error=result.get('error', 'Ошибка отправки'))
+    finally:
+        _release_task(task_id)
+
+
 def process_scheduled_messages():
     """Обработать отложенные задачи отправки сообщений"""
     try:
         pending_tasks = database.get_pending_scheduled_messages()
         
         for task in pending_tasks:
+            if task['id'] in _claimed_tasks:
+                continue  # Еще в очереди Telegram
             try:
                 # Пытаемся найти чат
                 chat_id, source = find_chat_by_phone(task['phone'])
@@ -190,8 +255,20 @@ def process_scheduled_messages():
                     continue
                 
                 # Отправляем сообщение
-                if source == 'telegram':
-                    result = telegram_client.send_telegram_message(chat_id, task['message_text'])
+                if source == 'telegram' and _telegram_via_web:
+                    result = _send_telegram_via_web(chat_id, task['message_text'])
+                elif source == 'telegram':
+                    # Не ждем отправки: очередь Telegram разошлет пачку с максимально допустимой
+                    # скоростью. Задача помечается отправленной только в _record_telegram_result
+                    if not _claim_task(task['id']):
+                        continue
+                    result = telegram_client.send_telegram_message(
+                        chat_id, task['message_text'], wait=0,
+                        on_result=lambda send_result, task_id=task['id']: _record_telegram_result(task_id, send_result)
+                    )
+                    if result and result.get('success'):
+                        continue  # Итог запишет _record_telegram_result
+                    _release_task(task['id'])
                 elif source == 'whatsapp':
                     result = whatsapp_client.send_whatsapp_message(chat_id, task['message_text'])
                 else:
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background Scheduler
+Фоновые задачи: отправка отложенных сообщений и проверка новых записей YClients
+
+По умолчанию (SCHEDULER_MODE=thread) задачи работают в потоках веб-процесса.
+Если веб-процессов несколько, задайте им SCHEDULER_MODE=worker и запустите
+задачи отдельным процессом, добавив в Procfile:
+
+    worker: python scheduler.py
+
+Воркер не подключается к Telegram сам (второй клиент с тем же файлом сессии
+мешал бы веб-процессу), а отправляет сообщения через API веб-процесса (WEB_APP_URL).
+"""
+
+import os
+import threading
+import time
+
+import metrics
+import notifications
+
+# thread - в веб-процессе, worker - отдельным процессом (python scheduler.py), off - не запускать
+SCHEDULER_MODE = os.environ.get('SCHEDULER_MODE', 'thread')
+
+# Интервалы задач в секундах
+SCHEDULED_MESSAGES_INTERVAL = float(os.environ.get('SCHEDULED_MESSAGES_INTERVAL', '10'))
+YCLIENTS_CHECK_INTERVAL = float(os.environ.get('YCLIENTS_CHECK_INTERVAL', '10'))
+
+JOBS = [
+    ('scheduled_messages', notifications.process_scheduled_messages, SCHEDULED_MESSAGES_INTERVAL),
+    ('yclients_records', notifications.check_new_yclients_records, YCLIENTS_CHECK_INTERVAL),
+]
+
+_started = False
+_start_lock = threading.Lock()
+_stop = threading.Event()
+
+
+def _run_job(name, job, interval):
+    """Выполнять задачу каждые interval секунд, пока не вызван stop()"""
+    while not _stop.is_set():
+        started = time.monotonic()
+        try:
+            job()
+            metrics.incr(f'scheduler_{name}_runs')
+        except Exception as e:
+            print(f"⚠️ Ошибка фоновой задачи {name}: {e}")
+            metrics.incr(f'scheduler_{name}_errors')
+        elapsed = time.monotonic() - started
+        metrics.observe(f'scheduler_{name}_ms', elapsed * 1000)
+        _stop.wait(max(0, interval - elapsed))
+
+
+def start():
+    """Запустить задачи в фоновых потоках (один раз на процесс)"""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    # У каждой задачи свой поток - медленный YClients не задерживает отложенные сообщения
+    for name, job, interval in JOBS:
+        thread = threading.Thread(target=_run_job, args=(name, job, interval),
+                                  name=f'scheduler-{name}', daemon=True)
+        thread.start()
+    print(f"⏰ Scheduler started: {', '.join(name for name, _, _ in JOBS)}")
+
+
+def stop():
+    """Остановить задачи"""
+    _stop.set()
+
+
+if __name__ == '__main__':
+    # Сессию Telethon держит веб-процесс - Telegram отправляем через него
+    notifications.use_web_for_telegram()
+    start()
+    try:
+        while not _stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stop()
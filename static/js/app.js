@@ -2,10 +2,13 @@
 
 let currentChatId = null;
 let chats = [];
+let chatsCursor = null; // Курсор для получения только изменившихся чатов
 let messages = [];
 let messagesCache = {}; // Кэш сообщений для быстрого переключения
 let currentLoadController = null; // Контроллер для отмены предыдущих запросов
 let loadRequestId = 0; // Счетчик запросов для игнорирования старых
+let historyLoading = false; // Идет загрузка старых сообщений
+let historyExhausted = {}; // Чаты, у которых вся история уже загружена
 
 // DOM Elements
 const chatsList = document.getElementById('chatsList');
@@ -23,6 +26,9 @@ let currentUserId = null;
 
 // Автообновление и уведомления
 let autoRefreshInterval = null;
+let eventSource = null;
+let eventsConnected = false; // Пока поток событий подключен, опрос почти не нужен
+const EVENTS_RETRY_DELAY = 60000; // Через сколько мс снова пробовать поток событий после отказа сервера
 let lastMessageCount = {};
 let receiveSound = null;
 let sendSound = null;
@@ -78,25 +84,95 @@ document.addEventListener('DOMContentLoaded', () => {
     loadChats();
     setupEventListeners();
     checkTelegramStatus();
+    startEventStream();
     startAutoRefresh();
 });
 
+// Поток событий с сервера (SSE): новые сообщения, прочтения, изменения чатов
+function startEventStream() {
+    if (!('EventSource' in window)) {
+        return; // Остаемся на опросе
+    }
+    
+    eventSource = new EventSource('/api/events');
+    
+    eventSource.addEventListener('open', () => {
+        eventsConnected = true;
+        console.log('📡 Event stream connected');
+    });
+    
+    // Браузер переподключится сам, а пока работает обычный опрос.
+    // Если сервер отказал (503 - слишком много потоков), браузер не переподключается - пробуем позже
+    eventSource.addEventListener('error', () => {
+        eventsConnected = false;
+        if (eventSource.readyState === EventSource.CLOSED) {
+            eventSource = null;
+            setTimeout(startEventStream, EVENTS_RETRY_DELAY);
+        }
+    });
+    
+    eventSource.addEventListener('new-message', (e) => {
+        const data = JSON.parse(e.data);
+        refreshChatMessages(data.chat_id, true);
+    });
+    
+    eventSource.addEventListener('read-state', (e) => {
+        const data = JSON.parse(e.data);
+        refreshChatMessages(data.chat_id);
+    });
+    
+    // Сообщения отредактированы или удалены
+    eventSource.addEventListener('messages-changed', (e) => {
+        const data = JSON.parse(e.data);
+        refreshChatMessages(data.chat_id);
+    });
+    
+    eventSource.addEventListener('chat-updated', () => {
+        loadChats(true);
+    });
+    
+    // Сервер пропустил часть событий - перезагружаем все
+    eventSource.addEventListener('resync', () => {
+        messagesCache = {};
+        loadChats(true);
+        if (currentChatId) {
+            loadMessages(currentChatId, true);
+        }
+    });
+}
+
+// Сообщения чата изменились: сбрасываем кэш, открытый чат перезагружаем
+// incremental - догрузить только новые сообщения (Telegram, after_id).
+// Для Telegram кэш не удаляем: последняя страница сольется с загруженной историей
+function refreshChatMessages(chatId, incremental = false) {
+    if (messagesCache[chatId] && chatId.startsWith('tg_')) {
+        messagesCache[chatId].timestamp = 0;
+    } else {
+        delete messagesCache[chatId];
+    }
+    if (chatId === currentChatId) {
+        loadMessages(chatId, true, incremental);
+    }
+}
+
 function startAutoRefresh() {
     // Обновляем ТОЛЬКО текущий открытый чат каждые 3 секунды
     // Список чатов обновляем реже (каждые 10 секунд)
+    // Если подключен поток событий, опрос - только страховка (раз в минуту)
     
     let chatRefreshCounter = 0;
     
     autoRefreshInterval = setInterval(async () => {
         chatRefreshCounter++;
+        const safetyTick = chatRefreshCounter % 20 === 0;
         
         // Обновляем список чатов каждые 10 секунд (каждый 3-й раз)
-        if (chatRefreshCounter % 3 === 0) {
+        if (eventsConnected ? safetyTick : chatRefreshCounter % 3 === 0) {
             await loadChats(true);
         }
         
         // Обновляем сообщения ТОЛЬКО текущего открытого чата
-        if (currentChatId) {
+        if (currentChatId && (!eventsConnected || safetyTick)) {
             await loadMessages(currentChatId, true);
         }
     }, 3000); // 3 секунды
@@ -186,6 +262,11 @@ function setupEventListeners() {
             if (scrollToBottomBtn) {
                 scrollToBottomBtn.style.display = isAtBottom ? 'none' : 'flex';
             }
+            
+            // Долистали до верха - подгружаем историю
+            if (messagesList.scrollTop < 50) {
+                loadOlderMessages();
+            }
         });
     }
 }
@@ -196,7 +277,9 @@ async function loadChats(silent = false) {
     }
     
     try {
-        const response = await fetch('/api/chats');
+        // Фоновое обновление запрашивает только изменения с прошлого ответа
+        const url = (silent && chatsCursor) ? `/api/chats?since=${encodeURIComponent(chatsCursor)}` : '/api/chats';
+        const response = await fetch(url);
         const data = await response.json();
         
         if (data.error) {
@@ -204,7 +287,19 @@ async function loadChats(silent = false) {
             return;
         }
         
-        const newChats = data.chats || [];
+        chatsCursor = data.cursor || null;
+        
+        let newChats;
+        if (data.delta) {
+            const changedChats = data.chats || [];
+            const removedIds = data.removed || [];
+            if (changedChats.length === 0 && removedIds.length === 0) {
+                return; // Ничего не изменилось - не перерисовываем
+            }
+            newChats = mergeChatsDelta(chats, changedChats, removedIds);
+        } else {
+            newChats = data.chats || [];
+        }
         const oldChats = [...chats];
         
         // НЕ делаем никакой предзагрузки - только по требованию!
@@ -268,6 +363,26 @@ async function loadChats(silent = false) {
     }
 }
 
+// Применить дельту списка чатов: заменить измененные, убрать удаленные
+function mergeChatsDelta(currentChats, changedChats, removedIds) {
+    const removed = new Set(removedIds);
+    const byId = new Map();
+    
+    currentChats.forEach(chat => {
+        if (!removed.has(chat.id)) {
+            byId.set(chat.id, chat);
+        }
+    });
+    
+    changedChats.forEach(chat => {
+        const oldChat = byId.get(chat.id);
+        // Сохраняем загруженные на клиенте поля (например, аватарку)
+        byId.set(chat.id, oldChat ? { ...oldChat, ...chat } : chat);
+    });
+    
+    return Array.from(byId.values()).sort((a, b) => (b.updated || 0) - (a.updated || 0));
+}
+
 // Запрашиваем разрешение на уведомления только при первом взаимодействии пользователя
 // Не запрашиваем автоматически, чтобы избежать ошибки "Notification prompting can only be done from a user gesture"
 let notificationPermissionRequested = false;
@@ -285,11 +400,15 @@ function requestNotificationPermission() {
 document.addEventListener('click', requestNotificationPermission, { once: true });
 document.addEventListener('touchstart', requestNotificationPermission, { once: true });
 
-// Ленивая загрузка аватарок Telegram (по одной в фоне)
-let avatarLoadQueue = [];
+// Ленивая загрузка аватарок Telegram (пачками в фоне)
+const AVATAR_BATCH_SIZE = 50;
 let isLoadingAvatars = false;
 
 async function lazyLoadTelegramAvatars() {
+    if (isLoadingAvatars) {
+        return;
+    }
+    
     // Находим все Telegram чаты с аватарками
     const telegramChatsWithPhotos = chats.filter(chat => 
         chat.source === 'telegram' && 
@@ -302,31 +421,35 @@ async function lazyLoadTelegramAvatars() {
     }
     
     console.log(`🖼️ Lazy loading ${telegramChatsWithPhotos.length} Telegram avatars...`);
+    isLoadingAvatars = true;
     
-    // Загружаем по одной с задержкой (не перегружаем сервер)
-    for (let i = 0; i < telegramChatsWithPhotos.length; i++) {
-        const chat = telegramChatsWithPhotos[i];
-        
-        // Небольшая задержка между запросами
-        await new Promise(resolve => setTimeout(resolve, 200));
-        
-        try {
-            const response = await fetch(`/api/telegram/avatar/${chat.id}`);
-            const data = await response.json();
+    try {
+        // Сервер скачивает пачку параллельно, ответ - сразу все URL пачки
+        for (let i = 0; i < telegramChatsWithPhotos.length; i += AVATAR_BATCH_SIZE) {
+            const batch = telegramChatsWithPhotos.slice(i, i + AVATAR_BATCH_SIZE);
             
-            if (data.success && data.avatar) {
-                // Обновляем чат с аватаркой
-                const chatInList = chats.find(c => c.id === chat.id);
-                if (chatInList) {
-                    chatInList.avatar = data.avatar;
-                    // Перерисовываем список чатов
+            try {
+                const response = await fetch('/api/telegram/avatars', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ chat_ids: batch.map(chat => chat.id) })
+                });
+                const data = await response.json();
+                
+                if (data.success && data.avatars) {
+                    chats.forEach(chat => {
+                        if (data.avatars[chat.id]) {
+                            chat.avatar = data.avatars[chat.id];
+                        }
+                    });
                     renderChats();
-                    console.log(`✅ Loaded avatar for ${chat.name}`);
                 }
+            } catch (error) {
+                console.log(`⚠️ Failed to load avatars batch:`, error.message);
             }
-        } catch (error) {
-            console.log(`⚠️ Failed to load avatar for ${chat.name}:`, error.message);
         }
+    } finally {
+        isLoadingAvatars = false;
     }
     
     console.log(`✅ All avatars loaded`);
@@ -550,7 +673,10 @@ async function markChatAsRead(chatId) {
     }
 }
 
-async function loadMessages(chatId, silent = false) {
+// incremental - для Telegram запросить только новые сообщения (after_id);
+// иначе последняя страница заменяет свой диапазон (правки, удаления, прочтения),
+// а более старая история, загруженная через before_id, сохраняется
+async function loadMessages(chatId, silent = false, incremental = false) {
     // Генерируем уникальный ID для этого запроса
     const requestId = ++loadRequestId;
     
@@ -596,10 +722,16 @@ async function loadMessages(chatId, silent = false) {
     }
     currentLoadController = new AbortController();
     
+    // Для Telegram по событию о новом сообщении запрашиваем только новые сообщения
+    const afterId = (incremental && hasCache && chatId.startsWith('tg_'))
+        ? telegramMessageId(messagesCache[chatId].messages, true)
+        : null;
+    const url = afterId ? `/api/chats/${chatId}/messages?after_id=${afterId}` : `/api/chats/${chatId}/messages`;
+    
     // Загружаем данные
     try {
         const fetchStartTime = Date.now();
-        const response = await fetch(`/api/chats/${chatId}/messages`, {
+        const response = await fetch(url, {
             signal: currentLoadController.signal
         });
         const fetchEndTime = Date.now();
@@ -625,7 +757,15 @@ async function loadMessages(chatId, silent = false) {
         }
         
         const oldMessagesCount = messages.length;
-        messages = data.messages || [];
+        const newMessages = data.messages || [];
+        if (afterId && newMessages.length < (data.limit || Infinity)) {
+            // Пришли только новые - добавляем к загруженным
+            messages = mergeMessages(messagesCache[chatId].messages, newMessages);
+        } else if (hasCache && !afterId && chatId.startsWith('tg_')) {
+            messages = mergeLatestPage(messagesCache[chatId].messages, newMessages, data.limit);
+        } else {
+            messages = newMessages;
+        }
         
         // Сортируем сообщения по времени
         messages.sort((a, b) => (a.created || 0) - (b.created || 0));
@@ -664,6 +804,75 @@ async function loadMessages(chatId, silent = false) {
     }
 }
 
+// Наибольший (newest) или наименьший id сообщения Telegram среди загруженных
+function telegramMessageId(list, newest) {
+    const ids = list
+        .filter(m => !m.isPending && Number.isInteger(m.original_id))
+        .map(m => m.original_id);
+    if (ids.length === 0) return null;
+    return newest ? Math.max(...ids) : Math.min(...ids);
+}
+
+// Объединить загруженные сообщения с новыми (без дублей и оптимистичных)
+function mergeMessages(currentMessages, newMessages) {
+    const newIds = new Set(newMessages.map(m => m.id));
+    const kept = currentMessages.filter(m => !m.isPending && !newIds.has(m.id));
+    return kept.concat(newMessages);
+}
+
+// Заменить последнюю страницу сообщений Telegram, сохранив более старую историю
+function mergeLatestPage(currentMessages, pageMessages, limit) {
+    const oldestInPage = telegramMessageId(pageMessages, false);
+    if (oldestInPage === null || pageMessages.length < (limit || Infinity)) {
+        return pageMessages; // Пришла вся история чата
+    }
+    const older = currentMessages.filter(m =>
+        !m.isPending && Number.isInteger(m.original_id) && m.original_id < oldestInPage
+    );
+    return older.concat(pageMessages);
+}
+
+// Подгрузить более старые сообщения Telegram (before_id)
+async function loadOlderMessages() {
+    const chatId = currentChatId;
+    if (!chatId || !chatId.startsWith('tg_') || historyLoading || historyExhausted[chatId]) {
+        return;
+    }
+    
+    const beforeId = telegramMessageId(messages, false);
+    if (!beforeId) return;
+    
+    historyLoading = true;
+    try {
+        const response = await fetch(`/api/chats/${chatId}/messages?before_id=${beforeId}`);
+        const data = await response.json();
+        if (data.error || chatId !== currentChatId) return;
+        
+        const olderMessages = data.messages || [];
+        if (olderMessages.length < (data.limit || 1)) {
+            historyExhausted[chatId] = true;
+        }
+        if (olderMessages.length === 0) return;
+        
+        // Сохраняем позицию прокрутки, чтобы список не прыгал
+        const previousHeight = messagesList.scrollHeight;
+        const loadedIds = new Set(messages.map(m => m.id));
+        messages = olderMessages.filter(m => !loadedIds.has(m.id)).concat(messages);
+        messages.sort((a, b) => (a.created || 0) - (b.created || 0));
+        if (messagesCache[chatId]) {
+            messagesCache[chatId].messages = messages;
+        }
+        renderMessages();
+        messagesList.scrollTop += messagesList.scrollHeight - previousHeight;
+        
+        console.log(`📜 Loaded ${olderMessages.length} older messages for ${chatId}`);
+    } catch (error) {
+        console.log('Ошибка загрузки истории:', error);
+    } finally {
+        historyLoading = false;
+    }
+}
+
 // Показать скелетон загрузки сообщений
 function showMessagesSkeleton() {
     // Показываем заголовок из списка чатов
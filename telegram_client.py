@@ -5,120 +5,703 @@ Telegram Client Integration
 
 import os
 import asyncio
-from telethon import TelegramClient, events
-from telethon.tl.types import User, Chat, Channel
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from telethon import TelegramClient, errors, events, functions, types, utils
+from telethon.tl.types import User, Chat, Channel, InputPeerPhotoFileLocation, InputPeerUser
 from datetime import datetime
+import avatar_store
+import chat_cache
+import circuit_breaker
+import event_stream
+import metrics
 
 # Конфигурация
 TELEGRAM_API_ID = int(os.environ.get('TELEGRAM_API_ID', '39642736'))
 TELEGRAM_API_HASH = os.environ.get('TELEGRAM_API_HASH', 'b635af221c00e27082d0132d6c4a9ab2')
 TELEGRAM_PHONE = os.environ.get('TELEGRAM_PHONE', '+79992556031')
+SESSION_NAME = 'avito_crm_session'
+
+# Сколько секунд ждать результата вызова Telegram из потока Flask
+TELEGRAM_CALL_TIMEOUT = float(os.environ.get('TELEGRAM_CALL_TIMEOUT', '30'))
 
 # Глобальный клиент
 telegram_client = None
 client_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+_init_lock = None  # asyncio.Lock, создается внутри loop
+
+# Состояние авторизации: устанавливается при подключении, входе и ошибках,
+# чтобы не проверять is_user_authorized() перед каждым запросом
+AUTH_DISCONNECTED = 'disconnected'
+AUTH_CONNECTING = 'connecting'
+AUTH_UNAUTHORIZED = 'unauthorized'
+AUTH_AUTHORIZED = 'authorized'
+auth_state = AUTH_DISCONNECTED
 phone_code_hash_storage = {}  # Хранилище для phone_code_hash
 
+# Индекс диалогов: заполняется get_telegram_chats_async, обновляется событиями
+_dialogs = {}  # 'tg_<id>' -> данные чата в формате API
+_dialogs_loaded = False
+_dialogs_lock = threading.Lock()
 
-def get_event_loop():
-    """Получить или создать event loop"""
-    global client_loop
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_closed():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        client_loop = loop
-    except RuntimeError:
+# Хранилище сообщений: последние сообщения открывавшихся чатов, обновляется событиями.
+# synced - в хранилище все сообщения после самого старого сохраненного (сбрасывается при отключении),
+# complete - в хранилище вся история чата
+TELEGRAM_MESSAGE_STORE_LIMIT = int(os.environ.get('TELEGRAM_MESSAGE_STORE_LIMIT', '200'))
+TELEGRAM_MESSAGE_STORE_CHATS = int(os.environ.get('TELEGRAM_MESSAGE_STORE_CHATS', '200'))
+_messages = OrderedDict()  # 'tg_<id>' -> {'messages': {id: message}, 'synced', 'complete'}
+_read_outbox = {}  # 'tg_<id>' -> id последнего исходящего, прочитанного собеседником
+
+# Аватарки: маленькие превью, имя файла - хэш photo_id (новое фото - новый файл)
+AVATAR_URL_PREFIX = '/avatars/'
+TELEGRAM_AVATAR_CONCURRENCY = int(os.environ.get('TELEGRAM_AVATAR_CONCURRENCY', '6'))
+_avatar_semaphore = None  # asyncio.Semaphore, создается внутри loop
+_avatar_downloads = {}    # photo_id -> Task текущей загрузки
+
+# Кэш пользователей (id, access_hash, имя, photo_id) рядом с файлом сессии: после перезапуска
+# пиры и аватарки разрешаются локально, без get_entity
+ENTITY_CACHE_FILE = f'{SESSION_NAME}.entities.json'
+_entities = {}  # user_id -> {'id', 'access_hash', 'name', 'username', 'phone', 'photo_id'}
+_entities_loaded = False
+_entities_lock = threading.Lock()
+
+# Очередь отправки: общий лимит скорости и интервал для одного чата.
+# FloodWait при отправке - лимит аккаунта: приостанавливает отправку во все чаты
+TELEGRAM_SEND_RATE = float(os.environ.get('TELEGRAM_SEND_RATE', '20'))  # сообщений в секунду
+TELEGRAM_SEND_PEER_INTERVAL = float(os.environ.get('TELEGRAM_SEND_PEER_INTERVAL', '1'))  # секунд между сообщениями в чат
+TELEGRAM_SEND_WAIT = float(os.environ.get('TELEGRAM_SEND_WAIT', '10'))  # сколько ждать отправки, потом ответ queued
+_send_queues = OrderedDict()  # 'tg_<id>' -> deque заданий на отправку
+_send_busy = set()            # чаты, в которые сейчас идет отправка
+_peer_next_send = {}          # 'tg_<id>' -> loop.time(), раньше которого в чат не отправляем
+_global_next_send = 0.0
+_send_wakeup = None           # asyncio.Event, создается внутри loop
+_send_worker = None
+_messages_lock = threading.Lock()
+
+
+def start_loop():
+    """
+    Запустить фоновый поток с event loop Telegram (один на процесс).
+
+    Клиент Telethon живет в этом loop постоянно: между запросами он получает
+    обновления, а запросы из разных потоков Flask выполняются параллельно.
+    """
+    global client_loop, _loop_thread
+    with _loop_lock:
+        if _loop_thread and _loop_thread.is_alive():
+            return client_loop
+        
         loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        ready = threading.Event()
+        
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+        
+        thread = threading.Thread(target=run, name='telegram-loop', daemon=True)
+        thread.start()
+        ready.wait()
         client_loop = loop
+        _loop_thread = thread
+        print("Telegram: event loop запущен")
     return client_loop
 
 
-async def init_telegram_client():
-    """Инициализация Telegram клиента"""
-    global telegram_client
+def _create_client():
+    """Создать Telegram клиент и подписать обработчики событий"""
+    client = TelegramClient(SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+    client.add_event_handler(_on_new_message, events.NewMessage())
+    client.add_event_handler(_on_message_edited, events.MessageEdited())
+    client.add_event_handler(_on_message_deleted, events.MessageDeleted())
+    client.add_event_handler(_on_message_read, events.MessageRead(inbox=False))
+    client.add_event_handler(_on_message_read, events.MessageRead(inbox=True))
+    return client
+
+
+def _format_message(msg):
+    """Преобразовать сообщение Telethon в формат API"""
+    message_data = {
+        'id': f'tg_{msg.id}',
+        'original_id': msg.id,
+        'author_id': msg.sender_id,
+        'created': int(msg.date.timestamp()) if msg.date else 0,
+        'text': msg.message or '',
+        'type': 'text',
+        'direction': 'out' if msg.out else 'in'
+    }
     
-    try:
-        # Проверяем существующий клиент
-        if telegram_client:
-            try:
-                if telegram_client.is_connected():
-                    # Проверяем авторизацию
-                    if await telegram_client.is_user_authorized():
-                        return telegram_client
-            except:
-                # Клиент не подключен, пересоздаем
-                telegram_client = None
+    # Медиафайлы
+    if msg.photo:
+        message_data['type'] = 'photo'
+        message_data['has_media'] = True
+    elif msg.video:
+        message_data['type'] = 'video'
+        message_data['has_media'] = True
+    elif msg.document:
+        message_data['type'] = 'document'
+        message_data['has_media'] = True
+    elif msg.voice:
+        message_data['type'] = 'voice'
+        message_data['has_media'] = True
+    
+    return message_data
+
+
+def _store_entry_locked(chat_id, create=False):
+    """Запись хранилища сообщений чата (под _messages_lock), вытесняет давно не открывавшиеся чаты"""
+    entry = _messages.get(chat_id)
+    if entry is None:
+        if not create:
+            return None
+        entry = _messages[chat_id] = {'messages': {}, 'synced': False, 'complete': False}
+        while len(_messages) > TELEGRAM_MESSAGE_STORE_CHATS:
+            _messages.popitem(last=False)
+    _messages.move_to_end(chat_id)
+    return entry
+
+
+def _store_put_locked(chat_id, entry, message):
+    """Сохранить сообщение, оставляя не больше TELEGRAM_MESSAGE_STORE_LIMIT последних"""
+    if message['direction'] == 'out':
+        message['isRead'] = message['original_id'] <= _read_outbox.get(chat_id, 0)
+    entry['messages'][message['original_id']] = message
+    if len(entry['messages']) > TELEGRAM_MESSAGE_STORE_LIMIT:
+        for message_id in sorted(entry['messages'])[:len(entry['messages']) - TELEGRAM_MESSAGE_STORE_LIMIT]:
+            del entry['messages'][message_id]
+        entry['complete'] = False
+
+
+def _store_get(chat_id, limit, after_id=None, before_id=None):
+    """
+    Сообщения из хранилища (новые первыми) или None, если их там нет.
+
+    after_id - только сообщения новее after_id, before_id - страница истории старше before_id.
+    """
+    with _messages_lock:
+        entry = _store_entry_locked(chat_id)
+        if entry is None or not entry['synced']:
+            return None
+        ids = sorted(entry['messages'], reverse=True)
+        oldest = ids[-1] if ids else None
         
-        # Создаем новый клиент
-        telegram_client = TelegramClient(
-            'avito_crm_session',
-            TELEGRAM_API_ID,
-            TELEGRAM_API_HASH
-        )
+        if after_id is not None:
+            # Между after_id и самым старым сохраненным могут быть сообщения, которых нет в хранилище
+            if not entry['complete'] and (oldest is None or oldest > after_id):
+                return None
+            ids = [message_id for message_id in ids if message_id > after_id]
+        elif before_id is not None:
+            ids = [message_id for message_id in ids if message_id < before_id]
+            if len(ids) < limit and not entry['complete']:
+                return None
+        elif len(ids) < limit and not entry['complete']:
+            return None
         
+        return [dict(entry['messages'][message_id]) for message_id in ids[:limit]]
+
+
+def _store_begin_sync(chat_id):
+    """Создать запись перед загрузкой, чтобы события во время загрузки не потерялись"""
+    with _messages_lock:
+        _store_entry_locked(chat_id, create=True)
+
+
+def _store_sync(chat_id, messages, limit):
+    """Заменить сохраненные сообщения загруженными из Telegram"""
+    with _messages_lock:
+        entry = _store_entry_locked(chat_id, create=True)
+        newest_loaded = max((m['original_id'] for m in messages), default=0)
+        # Сообщения, пришедшие событиями во время загрузки, сохраняем
+        arrived = [m for message_id, m in entry['messages'].items() if message_id > newest_loaded]
+        entry['messages'] = {}
+        for message in messages + arrived:
+            _store_put_locked(chat_id, entry, message)
+        entry['synced'] = True
+        entry['complete'] = len(messages) < limit
+
+
+def _store_extend_history(chat_id, before_id, messages, limit):
+    """Добавить загруженную страницу истории, если она примыкает к сохраненным сообщениям"""
+    with _messages_lock:
+        entry = _messages.get(chat_id)
+        if entry is None or not entry['synced'] or not entry['messages']:
+            return
+        if before_id < min(entry['messages']):
+            return  # Между страницей и хранилищем есть разрыв
+        if len(messages) < limit:
+            entry['complete'] = True
+        for message in messages:
+            _store_put_locked(chat_id, entry, message)
+
+
+def _store_add(chat_id, message):
+    """Добавить или заменить сообщение в чате, который есть в хранилище"""
+    with _messages_lock:
+        entry = _messages.get(chat_id)
+        if entry is not None:
+            _store_put_locked(chat_id, entry, message)
+
+
+def _store_replace(chat_id, message):
+    """
+    Заменить сообщение, только если оно уже есть в хранилище (правка).
+
+    Правка старого, не загруженного сообщения оказалась бы ниже непрерывного
+    диапазона хранилища, и запрос after_id молча пропустил бы сообщения между ними.
+    """
+    with _messages_lock:
+        entry = _messages.get(chat_id)
+        if entry is not None and message['original_id'] in entry['messages']:
+            _store_put_locked(chat_id, entry, message)
+
+
+def _store_delete(chat_id, message_ids):
+    """Удалить сообщения; chat_id может быть None (личные чаты) - ищем по всем. Возвращает затронутые чаты"""
+    affected = []
+    with _messages_lock:
+        chat_ids = [chat_id] if chat_id else list(_messages)
+        for store_chat_id in chat_ids:
+            entry = _messages.get(store_chat_id)
+            if entry is None:
+                continue
+            removed = [entry['messages'].pop(message_id, None) for message_id in message_ids]
+            if any(removed):
+                affected.append(store_chat_id)
+    return affected
+
+
+def _store_read_outbox(chat_id, max_id):
+    """Собеседник прочитал наши сообщения до max_id"""
+    with _messages_lock:
+        if max_id <= _read_outbox.get(chat_id, 0):
+            return
+        _read_outbox[chat_id] = max_id
+        entry = _messages.get(chat_id)
+        if entry is None:
+            return
+        for message in entry['messages'].values():
+            if message['direction'] == 'out':
+                message['isRead'] = message['original_id'] <= max_id
+
+
+def _store_unsync_all():
+    """После отключения часть событий могла потеряться - следующий запрос сверится с Telegram"""
+    with _messages_lock:
+        for entry in _messages.values():
+            entry['synced'] = False
+
+
+def _load_entities():
+    """Прочитать кэш пользователей с диска (один раз)"""
+    global _entities_loaded
+    with _entities_lock:
+        if _entities_loaded:
+            return
+        _entities_loaded = True
+        try:
+            with open(ENTITY_CACHE_FILE, encoding='utf-8') as f:
+                for item in json.load(f):
+                    _entities[item['id']] = item
+            print(f"Telegram: кэш пользователей загружен ({len(_entities)})")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Telegram: не удалось прочитать {ENTITY_CACHE_FILE}: {e}")
+
+
+def _remember_entity(entity):
+    """Запомнить пользователя. Возвращает True, если данные изменились"""
+    if not isinstance(entity, User) or entity.access_hash is None:
+        return False
+    item = {
+        'id': entity.id,
+        'access_hash': entity.access_hash,
+        'name': f"{entity.first_name or ''} {entity.last_name or ''}".strip(),
+        'username': entity.username,
+        'phone': entity.phone,
+        'photo_id': getattr(entity.photo, 'photo_id', None),
+        'photo_dc_id': getattr(entity.photo, 'dc_id', None)
+    }
+    _load_entities()
+    with _entities_lock:
+        if _entities.get(entity.id) == item:
+            return False
+        _entities[entity.id] = item
+        return True
+
+
+def _save_entities():
+    """Записать кэш пользователей на диск (атомарно)"""
+    with _entities_lock:
+        data = list(_entities.values())
+    tmp_path = f'{ENTITY_CACHE_FILE}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, ENTITY_CACHE_FILE)
+    except Exception as e:
+        print(f"Telegram: не удалось сохранить {ENTITY_CACHE_FILE}: {e}")
+
+
+def _cached_entity(user_id):
+    _load_entities()
+    with _entities_lock:
+        item = _entities.get(user_id)
+        return dict(item) if item else None
+
+
+def _resolve_peer(chat_id):
+    """Пир для запроса: InputPeerUser из кэша (без обращения к Telegram) или числовой id"""
+    original_id = int(chat_id.replace('tg_', ''))
+    item = _cached_entity(original_id)
+    if item:
+        return InputPeerUser(item['id'], item['access_hash'])
+    return original_id
+
+
+def _update_dialog_from_message(chat_id, msg):
+    """
+    Обновить последнее сообщение и непрочитанные диалога по новому сообщению.
+
+    Возвращает копию диалога или None, если его нет в индексе.
+    """
+    with _dialogs_lock:
+        chat = _dialogs.get(chat_id)
+        if chat is None:
+            return None  # Новый диалог появится в индексе при следующей загрузке чатов
+        created = int(msg.date.timestamp()) if msg.date else 0
+        chat['updated'] = max(chat.get('updated') or 0, created)
+        chat['last_message'] = {
+            'id': msg.id,
+            'text': msg.message or '',
+            'created': created,
+            'from_id': msg.sender_id
+        }
+        if not msg.out:
+            chat['unread_count'] = (chat.get('unread_count') or 0) + 1
+        return dict(chat)
+
+
+def _update_dialog_read(chat_id, max_id):
+    """Сбросить непрочитанные диалога, если прочитано последнее сообщение. Возвращает копию диалога"""
+    with _dialogs_lock:
+        chat = _dialogs.get(chat_id)
+        if chat is None:
+            return None
+        last_id = (chat.get('last_message') or {}).get('id') or 0
+        if max_id >= last_id:
+            chat['unread_count'] = 0
+        return dict(chat)
+
+
+def _update_dialogs_after_delete(message_ids):
+    """
+    Заменить удаленное последнее сообщение диалогов предыдущим из хранилища сообщений.
+
+    Возвращает (обновленные диалоги, True если какой-то диалог обновить не удалось).
+    """
+    deleted = set(message_ids)
+    updated = []
+    unresolved = False
+    with _dialogs_lock:
+        for chat_id, chat in _dialogs.items():
+            if (chat.get('last_message') or {}).get('id') not in deleted:
+                continue
+            with _messages_lock:
+                entry = _messages.get(chat_id)
+                remaining = sorted(entry['messages']) if entry and entry['synced'] else []
+                previous = dict(entry['messages'][remaining[-1]]) if remaining else None
+            if previous is None:
+                unresolved = True
+                continue
+            chat['last_message'] = {
+                'id': previous['original_id'],
+                'text': previous['text'],
+                'created': previous['created'],
+                'from_id': previous['author_id']
+            }
+            updated.append(dict(chat))
+    return updated, unresolved
+
+
+def _publish_dialog(chat):
+    """Обновить диалог в кэше чатов; если его там нет - перезагрузить список"""
+    if chat is None or not chat_cache.update_chat('telegram', chat):
+        chat_cache.invalidate('telegram')
+
+
+def _index_dialogs(chats):
+    """Сохранить загруженные диалоги в индекс"""
+    global _dialogs_loaded
+    with _dialogs_lock:
+        for chat in chats:
+            _dialogs[chat['id']] = dict(chat)
+        _dialogs_loaded = True
+
+
+def get_telegram_chat_info(chat_id):
+    """
+    Информация о диалоге из индекса (без запросов к Telegram).
+
+    Если индекс еще ни разу не заполнялся - загружает список диалогов.
+    """
+    if not _dialogs_loaded and is_authorized():
+        get_telegram_chats()
+    with _dialogs_lock:
+        chat = _dialogs.get(chat_id)
+        return dict(chat) if chat else None
+
+
+async def _on_new_message(event):
+    """Новое сообщение в личном чате - уведомляем подписчиков /api/events"""
+    if not event.is_private:
+        return
+    
+    chat_id = f'tg_{event.chat_id}'
+    message = _format_message(event.message)
+    message['content'] = {'text': message['text']}
+    message['source'] = 'telegram'
+    
+    chat = _update_dialog_from_message(chat_id, event.message)
+    _store_add(chat_id, _format_message(event.message))
+    event_stream.publish('new-message', {'source': 'telegram', 'chat_id': chat_id, 'message': message})
+    _publish_dialog(chat)
+
+
+async def _on_message_read(event):
+    """Сообщения прочитаны (нами - inbox, собеседником - outbox)"""
+    if not event.is_private:
+        return
+    
+    chat = None
+    if event.inbox:
+        chat = _update_dialog_read(f'tg_{event.chat_id}', event.max_id)
+    else:
+        _store_read_outbox(f'tg_{event.chat_id}', event.max_id)
+    event_stream.publish('read-state', {
+        'source': 'telegram',
+        'chat_id': f'tg_{event.chat_id}',
+        'max_id': event.max_id,
+        'outbox': event.outbox
+    })
+    if event.inbox:
+        _publish_dialog(chat)
+
+
+def _set_auth_state(state):
+    """Сменить состояние авторизации"""
+    global auth_state
+    if auth_state != state:
+        print(f"Telegram: {auth_state} -> {state}")
+        auth_state = state
+
+
+def get_auth_state():
+    """Текущее состояние авторизации (без запросов к Telegram)"""
+    return auth_state
+
+
+def is_authorized():
+    """Клиент подключен и авторизован"""
+    return auth_state == AUTH_AUTHORIZED
+
+
+def _is_auth_error(error):
+    """Ошибка означает, что сессия не авторизована или отозвана"""
+    if isinstance(error, errors.UnauthorizedError):
+        return True
+    error_msg = str(error)
+    return 'not registered' in error_msg or 'not authorized' in error_msg.lower()
+
+
+def _handle_error(error):
+    """Обновить состояние по ошибке вызова Telegram"""
+    if _is_auth_error(error):
+        _set_auth_state(AUTH_UNAUTHORIZED)
+
+
+async def _watch_disconnect(client):
+    """Дождаться окончательного отключения клиента (после всех переподключений Telethon)"""
+    try:
+        await client.disconnected
+    except Exception as e:
+        print(f"Telegram: соединение потеряно: {e}")
+    if client is telegram_client:
+        _set_auth_state(AUTH_DISCONNECTED)
+        _store_unsync_all()
+
+
+async def _connect_client():
+    """Создать и подключить новый клиент, следить за его отключением"""
+    global telegram_client
+    _set_auth_state(AUTH_CONNECTING)
+    # Старый клиент держит файл сессии (SQLite) - закрываем его перед созданием нового
+    if telegram_client is not None:
+        try:
+            await telegram_client.disconnect()
+        except Exception:
+            pass
+    telegram_client = _create_client()
+    try:
         await telegram_client.connect()
+    except Exception:
+        circuit_breaker.record_failure('telegram')
+        _set_auth_state(AUTH_DISCONNECTED)
+        try:
+            await telegram_client.disconnect()
+        except Exception:
+            pass
+        raise
+    except BaseException:
+        # В том числе отмена по таймауту run_async - не оставляем полуподключенный клиент
+        _set_auth_state(AUTH_DISCONNECTED)
+        try:
+            await telegram_client.disconnect()
+        except Exception:
+            pass
+        raise
+    circuit_breaker.record_success('telegram')
+    asyncio.ensure_future(_watch_disconnect(telegram_client))
+    return telegram_client
+
+
+def _get_init_lock():
+    """Lock, чтобы параллельные запросы не создавали несколько клиентов"""
+    global _init_lock
+    if _init_lock is None:
+        _init_lock = asyncio.Lock()
+    return _init_lock
+
+
+async def _on_message_edited(event):
+    """Сообщение отредактировано - обновляем хранилище"""
+    if not event.is_private:
+        return
+    
+    chat_id = f'tg_{event.chat_id}'
+    _store_replace(chat_id, _format_message(event.message))
+    event_stream.publish('messages-changed', {'source': 'telegram', 'chat_id': chat_id})
+
+
+async def _on_message_deleted(event):
+    """Сообщения удалены (для личных чатов Telegram не сообщает чат)"""
+    if event.chat_id:
+        return  # Удаление в канале или супергруппе - такие чаты не показываем
+    
+    for affected_chat_id in _store_delete(None, event.deleted_ids):
+        event_stream.publish('messages-changed', {'source': 'telegram', 'chat_id': affected_chat_id})
+    # Список чатов меняется, только если удалено последнее сообщение диалога
+    updated, unresolved = _update_dialogs_after_delete(event.deleted_ids)
+    for chat in updated:
+        _publish_dialog(chat)
+    if unresolved:
+        chat_cache.invalidate('telegram')
+
+
+async def init_telegram_client():
+    """Инициализация Telegram клиента"""
+    async with _get_init_lock():
+        return await _init_telegram_client_locked()
+
+
+async def _init_telegram_client_locked():
+    """Подключить клиент (вызывается под _init_lock)"""
+    try:
+        # Состояние уже известно - без запросов к Telegram
+        if telegram_client and telegram_client.is_connected():
+            if auth_state == AUTH_AUTHORIZED:
+                return telegram_client
+            if auth_state == AUTH_UNAUTHORIZED:
+                return None
+        
+        client = await _connect_client()
         
-        # Проверяем авторизацию
-        if not await telegram_client.is_user_authorized():
+        # Проверяем авторизацию один раз на подключение
+        if not await client.is_user_authorized():
             print(f"Telegram: требуется авторизация для {TELEGRAM_PHONE}")
-            await telegram_client.disconnect()
+            _set_auth_state(AUTH_UNAUTHORIZED)
             return None
         
+        _set_auth_state(AUTH_AUTHORIZED)
         print("Telegram: клиент успешно подключен и авторизован")
-        return telegram_client
+        return client
     except Exception as e:
         print(f"Telegram: ошибка инициализации клиента: {e}")
+        _handle_error(e)
         return None
 
 
-def run_async(coro):
-    """Запуск async функции синхронно"""
-    global client_loop
-    
-    # Переиспользуем существующий loop или создаем новый
-    if not client_loop or client_loop.is_closed():
-        client_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(client_loop)
+def run_async(coro, timeout=None):
+    """
+    Выполнить корутину в loop Telegram и дождаться результата (из любого потока).
+
+    Пока Telegram недоступен (цепь разомкнута), сразу бросает CircuitOpenError.
+    """
+    try:
+        circuit_breaker.before_call('telegram')
+    except circuit_breaker.CircuitOpenError:
+        coro.close()
+        raise
     
-    # НЕ закрываем loop - Telegram клиент использует его для фоновых задач
-    return client_loop.run_until_complete(coro)
+    loop = start_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        result = future.result(timeout or TELEGRAM_CALL_TIMEOUT)
+    except FuturesTimeoutError:
+        future.cancel()
+        circuit_breaker.record_failure('telegram')
+        raise TimeoutError(f"Telegram: нет ответа за {timeout or TELEGRAM_CALL_TIMEOUT} с")
+    if auth_state == AUTH_AUTHORIZED:
+        circuit_breaker.record_success('telegram')
+    return result
+
+
+def _probe_connection():
+    """Проверка для circuit breaker: удается ли подключиться к Telegram"""
+    future = asyncio.run_coroutine_threadsafe(init_telegram_client(), start_loop())
+    try:
+        future.result(TELEGRAM_CALL_TIMEOUT)
+    except FuturesTimeoutError:
+        future.cancel()
+        raise TimeoutError(f"Telegram: нет ответа за {TELEGRAM_CALL_TIMEOUT} с")
+    return auth_state in (AUTH_AUTHORIZED, AUTH_UNAUTHORIZED)
+
+
+circuit_breaker.register_probe('telegram', _probe_connection)
 
 
 async def get_telegram_chats_async(limit=100):
-    """Получить список чатов Telegram"""
+    """
+    Получить список чатов Telegram.
+
+    Не авторизован - SourceUnavailable(logged_out=True), ошибка Telegram - исключение
+    (кэш чатов оставит последний загруженный список).
+    """
     chats = []
     
+    client = await init_telegram_client()
+    if not client:
+        if auth_state == AUTH_UNAUTHORIZED:
+            raise chat_cache.SourceUnavailable('Telegram не авторизован', logged_out=True)
+        raise ConnectionError('Telegram: нет подключения')
+    
     try:
-        client = await init_telegram_client()
-        if not client:
-            print("Telegram: клиент не авторизован, пропускаем загрузку чатов")
-            return []
-        
-        # Проверяем авторизацию еще раз
-        if not await client.is_user_authorized():
-            print("Telegram: пользователь не авторизован")
-            return []
-        
-        try:
-            dialogs = await client.get_dialogs(limit=limit)
-        except Exception as e:
-            error_msg = str(e)
-            if 'not registered' in error_msg or 'not authorized' in error_msg.lower():
-                print("Telegram: требуется авторизация (ключ не зарегистрирован)")
-                return []
-            raise  # Пробрасываем другие ошибки
-        
+        dialogs = await client.get_dialogs(limit=limit)
     except Exception as e:
-        error_msg = str(e)
-        if 'not registered' in error_msg or 'not authorized' in error_msg.lower():
+        _handle_error(e)
+        if _is_auth_error(e):
             print("Telegram: требуется авторизация")
-        else:
-            print(f"Telegram: ошибка при получении чатов: {e}")
-        return []
+            raise chat_cache.SourceUnavailable('Telegram не авторизован', logged_out=True) from e
+        print(f"Telegram: ошибка при получении чатов: {e}")
+        raise
     
+    entities_changed = False
     for dialog in dialogs:
         try:
             entity = dialog.entity
@@ -146,6 +729,8 @@ async def get_telegram_chats_async(limit=100):
                 'is_bot': entity.bot if hasattr(entity, 'bot') else False
             }
             
+            _store_read_outbox(chat_data['id'], dialog.dialog.read_outbox_max_id)
+            
             # Последнее сообщение
             if dialog.message:
                 msg = dialog.message
@@ -157,87 +742,254 @@ async def get_telegram_chats_async(limit=100):
                 }
             
             # Аватарка - помечаем что есть, но не загружаем сейчас (ленивая загрузка)
-            if hasattr(entity, 'photo') and entity.photo:
+            photo_id = getattr(getattr(entity, 'photo', None), 'photo_id', None)
+            if photo_id:
                 chat_data['has_photo'] = True
+                chat_data['photo_id'] = photo_id
                 chat_data['avatar_loading'] = False
+                if avatar_store.touch(_avatar_filename(photo_id)):
+                    chat_data['avatar'] = avatar_url(photo_id)
             else:
                 chat_data['has_photo'] = False
+            if _remember_entity(entity):
+                entities_changed = True
             
             chats.append(chat_data)
         except Exception as e:
             print(f"Ошибка обработки диалога {dialog.id}: {e}")
             continue
     
+    _index_dialogs(chats)
+    if entities_changed:
+        await asyncio.get_running_loop().run_in_executor(None, _save_entities)
     return chats
 
 
-async def get_telegram_messages_async(chat_id, limit=100):
-    """Получить сообщения из Telegram чата"""
+async def get_telegram_messages_async(chat_id, limit=100, after_id=None, before_id=None):
+    """
+    Получить сообщения из Telegram чата (из хранилища, если оно синхронизировано).
+
+    after_id - только сообщения новее (min_id), before_id - история старше (offset_id).
+    """
+    if is_authorized():
+        stored = _store_get(chat_id, limit, after_id, before_id)
+        if stored is not None:
+            metrics.incr('telegram_messages_store_hits')
+            return stored
+    
     client = await init_telegram_client()
     if not client:
         return []
     
-    # Извлекаем оригинальный ID
-    original_id = int(chat_id.replace('tg_', ''))
+    peer = _resolve_peer(chat_id)
     
     try:
-        messages = await client.get_messages(original_id, limit=limit)
+        if after_id is not None:
+            messages = await client.get_messages(peer, limit=limit, min_id=after_id)
+        elif before_id is not None:
+            messages = await client.get_messages(peer, limit=limit, offset_id=before_id)
+        else:
+            _store_begin_sync(chat_id)
+            messages = await client.get_messages(peer, limit=limit)
+        metrics.incr('telegram_messages_store_misses')
         result = []
         
         for msg in messages:
             if not msg:
                 continue
-                
-            message_data = {
-                'id': f'tg_{msg.id}',
-                'original_id': msg.id,
-                'author_id': msg.sender_id,
-                'created': int(msg.date.timestamp()) if msg.date else 0,
-                'text': msg.message or '',
-                'type': 'text',
-                'direction': 'out' if msg.out else 'in'
-            }
-            
-            # Медиафайлы
-            if msg.photo:
-                message_data['type'] = 'photo'
-                message_data['has_media'] = True
-            elif msg.video:
-                message_data['type'] = 'video'
-                message_data['has_media'] = True
-            elif msg.document:
-                message_data['type'] = 'document'
-                message_data['has_media'] = True
-            elif msg.voice:
-                message_data['type'] = 'voice'
-                message_data['has_media'] = True
             
-            result.append(message_data)
+            result.append(_format_message(msg))
         
-        return result
+        if after_id is not None:
+            return result
+        if before_id is not None:
+            _store_extend_history(chat_id, before_id, result, limit)
+            return result
+        
+        _store_sync(chat_id, result, limit)
+        return _store_get(chat_id, limit) or result
     except Exception as e:
+        _handle_error(e)
         print(f"Ошибка получения сообщений Telegram: {e}")
         return []
 
 
-async def send_telegram_message_async(chat_id, text):
-    """Отправить сообщение в Telegram"""
+async def _send_message_no_flood_sleep(client, peer, text):
+    """
+    client.send_message, но FloodWait сразу бросает FloodWaitError, а не спит.
+
+    Порог сна задается только для этого запроса: остальные вызовы клиента
+    (диалоги, сообщения, аватарки) по-прежнему пережидают короткий FloodWait.
+    """
+    input_peer = await client.get_input_entity(peer)
+    message, entities = await client._parse_message_text(text, ())
+    request = functions.messages.SendMessageRequest(peer=input_peer, message=message, entities=entities)
+    result = await client(request, flood_sleep_threshold=0)
+    if isinstance(result, types.UpdateShortSentMessage):
+        # Личные чаты: Telegram возвращает только id и дату - собираем сообщение как send_message
+        message = types.Message(
+            id=result.id,
+            peer_id=utils.get_peer(input_peer),
+            message=message,
+            date=result.date,
+            out=result.out,
+            media=result.media,
+            entities=result.entities,
+            ttl_period=result.ttl_period
+        )
+        message._finish_init(client, {}, input_peer)
+        return message
+    return client._get_response_message(request, result, input_peer)
+
+
+async def _send_now(chat_id, text):
+    """Отправить сообщение сразу. FloodWaitError пробрасывается в очередь"""
     client = await init_telegram_client()
     if not client:
-        return None
+        return {'success': False, 'error': 'Client not initialized'}
     
-    original_id = int(chat_id.replace('tg_', ''))
+    peer = _resolve_peer(chat_id)
     
     try:
-        message = await client.send_message(original_id, text)
-        return {
-            'success': True,
-            'message_id': message.id,
-            'date': int(message.date.timestamp()) if message.date else 0
-        }
+        message = await _send_message_no_flood_sleep(client, peer, text)
+    except errors.FloodWaitError:
+        raise
     except Exception as e:
+        _handle_error(e)
         print(f"Ошибка отправки сообщения Telegram: {e}")
         return {'success': False, 'error': str(e)}
+    
+    _store_add(chat_id, _format_message(message))
+    return {
+        'success': True,
+        'message_id': message.id,
+        'date': int(message.date.timestamp()) if message.date else 0
+    }
+
+
+def _update_send_metrics():
+    metrics.set_gauge('telegram_send_queue_depth', sum(len(jobs) for jobs in _send_queues.values()))
+
+
+def _enqueue_send(chat_id, text, on_result=None):
+    """Поставить сообщение в очередь (в loop Telegram). Возвращает Future с результатом"""
+    global _send_wakeup, _send_worker
+    loop = asyncio.get_running_loop()
+    if _send_wakeup is None:
+        _send_wakeup = asyncio.Event()
+    if _send_worker is None or _send_worker.done():
+        _send_worker = asyncio.ensure_future(_send_worker_loop())
+    
+    job = {
+        'chat_id': chat_id,
+        'text': text,
+        'on_result': on_result,
+        'future': loop.create_future(),
+        'enqueued_at': loop.time(),
+        'not_before': 0.0
+    }
+    _send_queues.setdefault(chat_id, deque()).append(job)
+    _update_send_metrics()
+    _send_wakeup.set()
+    return job['future']
+
+
+async def _send_worker_loop():
+    """Выбирать сообщения из очереди с соблюдением лимитов и запускать отправку"""
+    global _global_next_send
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        _send_wakeup.clear()
+        now = loop.time()
+        
+        # Чат, сообщение в который можно отправить раньше всех
+        chat_id, ready_at = None, None
+        for queued_chat_id, jobs in _send_queues.items():
+            if queued_chat_id in _send_busy:
+                continue  # Сообщения в один чат уходят строго по порядку
+            at = max(jobs[0]['not_before'], _peer_next_send.get(queued_chat_id, 0.0))
+            if ready_at is None or at < ready_at:
+                chat_id, ready_at = queued_chat_id, at
+        
+        if chat_id is None:
+            await _send_wakeup.wait()
+            continue
+        
+        ready_at = max(ready_at, _global_next_send)
+        if ready_at > now:
+            try:
+                await asyncio.wait_for(_send_wakeup.wait(), ready_at - now)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        jobs = _send_queues[chat_id]
+        job = jobs.popleft()
+        if not jobs:
+            del _send_queues[chat_id]
+        
+        _global_next_send = now + 1 / TELEGRAM_SEND_RATE
+        _peer_next_send[chat_id] = now + TELEGRAM_SEND_PEER_INTERVAL
+        if len(_peer_next_send) > 1000:
+            for known_chat_id in [c for c, at in _peer_next_send.items() if at < now]:
+                del _peer_next_send[known_chat_id]
+        
+        _send_busy.add(chat_id)
+        asyncio.ensure_future(_send_job(job))
+        _update_send_metrics()
+
+
+async def _send_job(job):
+    """Отправить сообщение из очереди; при FloodWait вернуть его в начало очереди чата"""
+    global _global_next_send
+    loop = asyncio.get_running_loop()
+    chat_id = job['chat_id']
+    
+    try:
+        metrics.observe('telegram_send_queue_delay_ms', (loop.time() - job['enqueued_at']) * 1000)
+        result = await _send_now(chat_id, job['text'])
+    except errors.FloodWaitError as e:
+        # Telegram просит подождать - откладываем отправку, а не считаем ее неудачной.
+        # Лимит общий для аккаунта, поэтому пауза касается всех чатов
+        print(f"⏳ Telegram FloodWait {e.seconds}s, отправка приостановлена (сообщение в {chat_id} ждет)")
+        metrics.incr('telegram_send_flood_waits')
+        resume_at = loop.time() + e.seconds
+        job['not_before'] = resume_at
+        _global_next_send = max(_global_next_send, resume_at)
+        _send_queues.setdefault(chat_id, deque()).appendleft(job)
+        return
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    finally:
+        _send_busy.discard(chat_id)
+        _update_send_metrics()
+        _send_wakeup.set()
+    
+    metrics.incr('telegram_send_total' if result.get('success') else 'telegram_send_errors')
+    if not job['future'].done():
+        job['future'].set_result(result)
+    if job['on_result']:
+        # Колбэк может ходить в БД - не блокируем loop
+        loop.run_in_executor(None, job['on_result'], result)
+
+
+async def send_telegram_message_async(chat_id, text, wait=None, on_result=None):
+    """
+    Отправить сообщение в Telegram через очередь отправки.
+
+    Ждет отправки не дольше wait секунд (по умолчанию TELEGRAM_SEND_WAIT). Если сообщение
+    еще в очереди (лимиты, FloodWait) - возвращает success и queued=True, а итог
+    отправки передается в on_result(result), если он задан.
+    """
+    if not await init_telegram_client():
+        return None
+    
+    future = _enqueue_send(chat_id, text, on_result)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), TELEGRAM_SEND_WAIT if wait is None else wait)
+    except asyncio.TimeoutError:
+        return {'success': True, 'queued': True, 'message': 'Сообщение поставлено в очередь отправки'}
 
 
 async def mark_telegram_read_async(chat_id):
@@ -246,35 +998,34 @@ async def mark_telegram_read_async(chat_id):
     if not client:
         return {'success': False, 'error': 'Client not initialized'}
     
-    original_id = int(chat_id.replace('tg_', ''))
+    peer = _resolve_peer(chat_id)
     
     try:
         # Помечаем все сообщения в чате как прочитанные
-        await client.send_read_acknowledge(original_id)
+        await client.send_read_acknowledge(peer)
         print(f"Telegram: чат {chat_id} помечен прочитанным")
         return {'success': True}
     except Exception as e:
+        _handle_error(e)
         print(f"Ошибка пометки прочитанным Telegram: {e}")
         return {'success': False, 'error': str(e)}
 
 
 async def authorize_telegram_async(phone, code=None, password=None):
     """Авторизация в Telegram"""
-    global telegram_client, phone_code_hash_storage
+    global phone_code_hash_storage
     
     try:
         # Создаем/переиспользуем клиент
-        if not telegram_client or not telegram_client.is_connected():
-            telegram_client = TelegramClient(
-                'avito_crm_session',
-                TELEGRAM_API_ID,
-                TELEGRAM_API_HASH
-            )
-            await telegram_client.connect()
+        async with _get_init_lock():
+            if not telegram_client or not telegram_client.is_connected():
+                await _connect_client()
         
         # Проверяем, авторизован ли уже
         if await telegram_client.is_user_authorized():
+            _set_auth_state(AUTH_AUTHORIZED)
             return {'status': 'already_authorized', 'message': 'Уже авторизованы'}
+        _set_auth_state(AUTH_UNAUTHORIZED)
         
         if not code:
             # Отправляем код и СОХРАНЯЕМ phone_code_hash
@@ -292,6 +1043,7 @@ async def authorize_telegram_async(phone, code=None, password=None):
                     try:
                         await telegram_client.sign_in(password=password)
                         if await telegram_client.is_user_authorized():
+                            _set_auth_state(AUTH_AUTHORIZED)
                             phone_code_hash_storage.pop(phone, None)
                             print(f"Telegram: авторизация с 2FA успешна для {phone}")
                             return {'status': 'authorized', 'message': 'Авторизация успешна'}
@@ -311,6 +1063,7 @@ async def authorize_telegram_async(phone, code=None, password=None):
                 
                 # Проверяем успешность
                 if await telegram_client.is_user_authorized():
+                    _set_auth_state(AUTH_AUTHORIZED)
                     # Удаляем phone_code_hash из хранилища
                     phone_code_hash_storage.pop(phone, None)
                     print(f"Telegram: авторизация успешна для {phone}")
@@ -331,13 +1084,25 @@ async def authorize_telegram_async(phone, code=None, password=None):
 
 
 async def get_telegram_user_info_async(user_id):
-    """Получить информацию о пользователе Telegram"""
+    """Получить информацию о пользователе Telegram (из кэша пользователей, если он там есть)"""
+    item = _cached_entity(user_id)
+    if item:
+        return {
+            'id': item['id'],
+            'name': item['name'],
+            'username': item['username'],
+            'phone': item['phone'],
+            'has_photo': item['photo_id'] is not None
+        }
+    
     client = await init_telegram_client()
     if not client:
         return None
     
     try:
         entity = await client.get_entity(user_id)
+        if _remember_entity(entity):
+            await asyncio.get_running_loop().run_in_executor(None, _save_entities)
         user_info = {
             'id': entity.id,
             'name': f"{entity.first_name or ''} {entity.last_name or ''}".strip(),
@@ -350,33 +1115,38 @@ async def get_telegram_user_info_async(user_id):
         
         return user_info
     except Exception as e:
+        _handle_error(e)
         print(f"Ошибка получения информации о пользователе: {e}")
         return None
 
 
 # Синхронные обертки для Flask
-def get_telegram_chats(limit=100):
-    """Синхронная обертка для получения чатов"""
+def get_telegram_chats(limit=100, raise_errors=False):
+    """Синхронная обертка для получения чатов (raise_errors=False - при ошибке пустой список)"""
     try:
         return run_async(get_telegram_chats_async(limit))
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Ошибка получения чатов Telegram: {e}")
         return []
 
 
-def get_telegram_messages(chat_id, limit=100):
+def get_telegram_messages(chat_id, limit=100, after_id=None, before_id=None):
     """Синхронная обертка для получения сообщений"""
     try:
-        return run_async(get_telegram_messages_async(chat_id, limit))
+        return run_async(get_telegram_messages_async(chat_id, limit, after_id, before_id))
     except Exception as e:
         print(f"Ошибка получения сообщений Telegram: {e}")
         return []
 
 
-def send_telegram_message(chat_id, text):
+def send_telegram_message(chat_id, text, wait=None, on_result=None):
     """Синхронная обертка для отправки сообщения"""
+    wait = TELEGRAM_SEND_WAIT if wait is None else wait
     try:
-        return run_async(send_telegram_message_async(chat_id, text))
+        return run_async(send_telegram_message_async(chat_id, text, wait, on_result),
+                         timeout=wait + TELEGRAM_CALL_TIMEOUT)
     except Exception as e:
         print(f"Ошибка отправки сообщения Telegram: {e}")
         return {'success': False, 'error': str(e)}
@@ -409,43 +1179,104 @@ def mark_telegram_read(chat_id):
         return {'success': False, 'error': str(e)}
 
 
-async def download_telegram_avatar_async(chat_id):
-    """Загрузить аватарку для конкретного чата (ленивая загрузка)"""
-    client = await init_telegram_client()
-    if not client:
-        return None
+def _avatar_filename(photo_id):
+    return hashlib.sha1(str(photo_id).encode()).hexdigest()[:20] + '.jpg'
+
+
+def avatar_url(photo_id):
+    """URL аватарки (содержимое по этому адресу никогда не меняется)"""
+    return AVATAR_URL_PREFIX + _avatar_filename(photo_id)
+
+
+async def _download_avatar(client, chat_id):
+    """Скачать превью аватарки чата, если его еще нет. Возвращает URL или None"""
+    global _avatar_semaphore
     
     original_id = int(chat_id.replace('tg_', ''))
+    item = _cached_entity(original_id)
+    if item is None:
+        # Пользователя нет в кэше - один раз спрашиваем Telegram
+        entity = await client.get_entity(original_id)
+        if _remember_entity(entity):
+            await asyncio.get_running_loop().run_in_executor(None, _save_entities)
+        item = _cached_entity(original_id)
+        if item is None:
+            return None
     
-    # Проверяем, не загружена ли уже
-    avatar_path = f'static/avatars/tg_{original_id}.jpg'
-    if os.path.exists(avatar_path):
-        return f'/static/avatars/tg_{original_id}.jpg'
+    photo_id = item['photo_id']
+    if not photo_id:
+        return None
     
-    try:
-        # Получаем entity для чата
-        entity = await client.get_entity(original_id)
+    filename = _avatar_filename(photo_id)
+    if avatar_store.touch(filename):
+        return avatar_url(photo_id)
+    
+    # Одно и то же фото не скачиваем параллельно
+    task = _avatar_downloads.get(photo_id)
+    if task is None:
+        if _avatar_semaphore is None:
+            _avatar_semaphore = asyncio.Semaphore(TELEGRAM_AVATAR_CONCURRENCY)
         
-        if hasattr(entity, 'photo') and entity.photo:
-            photo_path = await client.download_profile_photo(
-                entity,
-                file=avatar_path
-            )
-            if photo_path:
-                print(f"✅ Downloaded avatar for chat {chat_id}")
-                return f'/static/avatars/tg_{original_id}.jpg'
+        async def download():
+            async with _avatar_semaphore:
+                path = avatar_store.path(filename)
+                tmp_path = f'{path}.{photo_id}.tmp'
+                started = time.monotonic()
+                # big=False - превью 160x160 вместо полного фото
+                location = InputPeerPhotoFileLocation(
+                    peer=InputPeerUser(item['id'], item['access_hash']),
+                    photo_id=photo_id,
+                    big=False
+                )
+                await client.download_file(location, tmp_path, dc_id=item.get('photo_dc_id'))
+                metrics.observe('telegram_avatar_download_ms', (time.monotonic() - started) * 1000)
+                if not os.path.getsize(tmp_path):
+                    os.remove(tmp_path)
+                    return False
+                os.replace(tmp_path, path)
+                avatar_store.add(filename)
+                return True
         
-        return None
-    except Exception as e:
-        print(f"⚠️ Failed to download avatar for {chat_id}: {e}")
-        return None
+        task = asyncio.ensure_future(download())
+        _avatar_downloads[photo_id] = task
+        task.add_done_callback(lambda _: _avatar_downloads.pop(photo_id, None))
+    
+    if await task:
+        metrics.incr('telegram_avatar_downloads')
+        return avatar_url(photo_id)
+    return None
 
 
-def download_telegram_avatar(chat_id):
-    """Синхронная обертка для загрузки аватарки"""
+async def download_telegram_avatars_async(chat_ids):
+    """Загрузить аватарки нескольких чатов параллельно. Возвращает {chat_id: url}"""
+    client = await init_telegram_client()
+    if not client:
+        return {}
+    
+    results = await asyncio.gather(
+        *(_download_avatar(client, chat_id) for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    
+    avatars = {}
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            _handle_error(result)
+            print(f"⚠️ Failed to download avatar for {chat_id}: {result}")
+        elif result:
+            avatars[chat_id] = result
+    return avatars
+
+
+def download_telegram_avatars(chat_ids):
+    """Синхронная обертка для загрузки аватарок"""
     try:
-        return run_async(download_telegram_avatar_async(chat_id))
+        return run_async(download_telegram_avatars_async(chat_ids), timeout=TELEGRAM_CALL_TIMEOUT * 2)
     except Exception as e:
-        print(f"Ошибка загрузки аватарки: {e}")
-        return None
+        print(f"Ошибка загрузки аватарок: {e}")
+        return {}
+
 
+def download_telegram_avatar(chat_id):
+    """Синхронная обертка для загрузки одной аватарки"""
+    return download_telegram_avatars([chat_id]).get(chat_id)
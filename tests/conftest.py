@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Модули приложения лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Тесты работают с временной SQLite базой, а не с customers.db
+os.environ.pop('DATABASE_URL', None)
+os.environ['SQLITE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'customers.db')
+
+# Импорт app не запускает фоновые задачи
+os.environ['SCHEDULER_MODE'] = 'off'
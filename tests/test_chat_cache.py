@@ -0,0 +1,138 @@
+import pytest
+
+import chat_cache
+import circuit_breaker
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Пустой кэш без зарегистрированных источников"""
+    monkeypatch.setattr(chat_cache, '_sources', {})
+    monkeypatch.setattr(chat_cache, '_entries', {})
+    monkeypatch.setattr(chat_cache, '_refreshing', {})
+    monkeypatch.setattr(chat_cache, '_chat_versions', {})
+    monkeypatch.setattr(chat_cache, '_removed', {})
+    monkeypatch.setattr(chat_cache, '_version', 0)
+    monkeypatch.setattr(chat_cache, '_min_delta_version', 0)
+    return chat_cache
+
+
+def make_source(cache, name, *results):
+    """Источник, который по очереди возвращает results (исключения - бросает)"""
+    results = list(results)
+
+    def fetch():
+        result = results.pop(0) if len(results) > 1 else results[0]
+        if isinstance(result, Exception):
+            raise result
+        if callable(result):
+            return result()
+        return result
+
+    cache.register_source(name, fetch, deadline=5, ttl=60)
+
+
+def chat(chat_id, updated=1, unread=0):
+    return {'id': chat_id, 'updated': updated, 'unread_count': unread}
+
+
+def test_first_request_waits_for_source(cache):
+    make_source(cache, 'avito', [chat('a1'), chat('a2')])
+
+    result = cache.get_chats()
+
+    assert [c['id'] for c in result['chats']] == ['a1', 'a2']
+    assert result['delta'] is False
+    assert result['sources']['avito']['status'] == 'ok'
+    assert result['sources']['avito']['count'] == 2
+
+
+def test_delta_returns_only_changed_and_removed(cache):
+    make_source(cache, 'avito', [chat('a1'), chat('a2'), chat('a3')], [chat('a1'), chat('a2', updated=2)])
+    cursor = cache.get_chats()['cursor']
+
+    cache.warm(timeout=5)
+    result = cache.get_chats(since=cursor)
+
+    assert result['delta'] is True
+    assert [c['id'] for c in result['chats']] == ['a2']
+    assert result['removed'] == ['a3']
+
+
+def test_unknown_cursor_returns_full_list(cache):
+    make_source(cache, 'avito', [chat('a1')])
+    cache.get_chats()
+
+    result = cache.get_chats(since='other-epoch:1')
+
+    assert result['delta'] is False
+    assert [c['id'] for c in result['chats']] == ['a1']
+
+
+def test_error_keeps_previous_chats_as_stale(cache):
+    make_source(cache, 'telegram', [chat('tg_1')], ConnectionError('Telegram: нет подключения'))
+    cache.get_chats()
+
+    cache.warm(timeout=5)
+    result = cache.get_chats()
+
+    assert [c['id'] for c in result['chats']] == ['tg_1']
+    source = result['sources']['telegram']
+    assert source['status'] == 'error'
+    assert source['stale'] is True
+    assert 'нет подключения' in source['error']
+
+
+def test_unavailable_keeps_chats_until_logged_out(cache):
+    make_source(cache, 'whatsapp', [chat('wa_1')],
+                cache.SourceUnavailable('not ready'),
+                cache.SourceUnavailable('QR', logged_out=True))
+    cache.get_chats()
+
+    cache.warm(timeout=5)
+    assert [c['id'] for c in cache.get_chats()['chats']] == ['wa_1']
+
+    cache.warm(timeout=5)
+    result = cache.get_chats()
+    assert result['chats'] == []
+    assert result['sources']['whatsapp']['status'] == 'unavailable'
+    assert result['sources']['whatsapp']['stale'] is False
+
+
+def test_update_chat_replaces_chat_and_bumps_version(cache):
+    make_source(cache, 'telegram', [chat('tg_1'), chat('tg_2')])
+    cursor = cache.get_chats()['cursor']
+
+    assert cache.update_chat('telegram', chat('tg_2', updated=5, unread=1)) is True
+    result = cache.get_chats(since=cursor)
+
+    assert result['chats'] == [chat('tg_2', updated=5, unread=1)]
+
+
+def test_update_chat_unknown_chat_needs_invalidate(cache):
+    make_source(cache, 'telegram', [chat('tg_1')])
+    cache.get_chats()
+
+    assert cache.update_chat('telegram', chat('tg_9')) is False
+    assert cache.update_chat('avito', chat('a1')) is False
+
+
+@pytest.mark.parametrize('source', ['telegram', 'whatsapp'])
+def test_open_circuit_reported_as_unavailable(cache, monkeypatch, source):
+    import app
+
+    def open_circuit(upstream):
+        raise circuit_breaker.CircuitOpenError(upstream)
+
+    monkeypatch.setattr(circuit_breaker, 'before_call', open_circuit)
+    fetch = getattr(app, f'fetch_{source}_chats')
+    make_source(cache, source, [chat('c1')], fetch)
+    cache.get_chats()
+
+    cache.warm(timeout=5)
+    result = cache.get_chats()
+
+    assert [c['id'] for c in result['chats']] == ['c1']
+    assert result['sources'][source]['status'] == 'unavailable'
+    assert result['sources'][source]['stale'] is True
+    assert 'circuit open' in result['sources'][source]['error']
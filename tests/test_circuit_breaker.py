@@ -0,0 +1,116 @@
+import pytest
+import requests
+
+import circuit_breaker
+
+
+@pytest.fixture(autouse=True)
+def circuits(monkeypatch):
+    """Чистое состояние цепей; цепь не закрывается по таймеру во время теста"""
+    monkeypatch.setattr(circuit_breaker, '_circuits', {})
+    monkeypatch.setattr(circuit_breaker, '_probes', {})
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD', '3')
+    monkeypatch.setenv('CIRCUIT_OPEN_SECONDS', '600')
+
+
+def test_opens_after_threshold_failures():
+    for _ in range(2):
+        circuit_breaker.record_failure('avito')
+    circuit_breaker.before_call('avito')
+
+    circuit_breaker.record_failure('avito')
+
+    assert circuit_breaker.is_open('avito')
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        circuit_breaker.before_call('avito')
+
+
+def test_open_error_is_connection_error():
+    # Вызывающий код уже обрабатывает requests.ConnectionError
+    assert issubclass(circuit_breaker.CircuitOpenError, requests.ConnectionError)
+
+
+def test_success_resets_failures():
+    for _ in range(2):
+        circuit_breaker.record_failure('avito')
+    circuit_breaker.record_success('avito')
+    for _ in range(2):
+        circuit_breaker.record_failure('avito')
+
+    assert not circuit_breaker.is_open('avito')
+
+
+def test_per_upstream_threshold(monkeypatch):
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD_YCLIENTS', '0')
+
+    for _ in range(10):
+        circuit_breaker.record_failure('yclients')
+    circuit_breaker.record_failure('whatsapp')
+
+    assert not circuit_breaker.is_open('yclients')
+    assert circuit_breaker.snapshot()['whatsapp']['failures'] == 1
+
+
+def open_circuit(upstream):
+    for _ in range(3):
+        circuit_breaker.record_failure(upstream)
+    assert circuit_breaker.is_open(upstream)
+    circuit_breaker._circuits[upstream]['state'] = circuit_breaker.HALF_OPEN
+
+
+def test_healthy_probe_closes_circuit():
+    circuit_breaker.register_probe('whatsapp', lambda: True)
+    open_circuit('whatsapp')
+
+    circuit_breaker._probe('whatsapp')
+
+    assert not circuit_breaker.is_open('whatsapp')
+    circuit_breaker.before_call('whatsapp')
+
+
+def test_failed_probe_keeps_circuit_open():
+    def probe():
+        raise requests.ConnectionError('refused')
+
+    circuit_breaker.register_probe('whatsapp', probe)
+    open_circuit('whatsapp')
+
+    circuit_breaker._probe('whatsapp')
+
+    assert circuit_breaker.snapshot()['whatsapp']['state'] == circuit_breaker.OPEN
+
+
+def test_probe_calls_bypass_open_circuit():
+    calls = []
+
+    def probe():
+        circuit_breaker.before_call('telegram')
+        calls.append(True)
+
+    circuit_breaker.register_probe('telegram', probe)
+    open_circuit('telegram')
+
+    circuit_breaker._probe('telegram')
+
+    assert calls == [True]
+    assert not circuit_breaker.is_open('telegram')
+
+
+def test_without_probe_next_failure_reopens():
+    open_circuit('yclients')
+
+    circuit_breaker._probe('yclients')
+    assert not circuit_breaker.is_open('yclients')
+
+    circuit_breaker.record_failure('yclients')
+    assert circuit_breaker.is_open('yclients')
+
+
+def test_default_probe_does_not_replace_explicit():
+    circuit_breaker.register_probe('avito', lambda: False)
+    circuit_breaker.register_probe('avito', lambda: True, default=True)
+    open_circuit('avito')
+
+    circuit_breaker._probe('avito')
+
+    assert circuit_breaker.is_open('avito')
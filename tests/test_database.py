@@ -0,0 +1,86 @@
+import pytest
+
+import database
+
+
+@pytest.fixture(autouse=True)
+def empty_customers():
+    with database.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM customers')
+        cursor.execute('DELETE FROM customers_fts')
+
+
+def test_save_customer_creates_record():
+    customer = database.save_customer('avito', '100', name='Иван', phone='+79990001122')
+
+    assert customer['id']
+    assert customer['source'] == 'avito'
+    assert customer['source_id'] == '100'
+    assert customer['name'] == 'Иван'
+    assert customer['phone'] == '+79990001122'
+    assert database.get_customer('avito', '100') == customer
+
+
+def test_save_customer_updates_only_given_fields():
+    created = database.save_customer('avito', '100', name='Иван', vin='XTA210990', comments='масло')
+
+    updated = database.save_customer('avito', '100', phone='+79990001122', comments='фильтр')
+
+    assert updated['id'] == created['id']
+    assert updated['name'] == 'Иван'
+    assert updated['vin'] == 'XTA210990'
+    assert updated['phone'] == '+79990001122'
+    assert updated['comments'] == 'фильтр'
+    assert len(database.get_all_customers()) == 1
+
+
+def test_same_source_id_in_other_source_is_another_customer():
+    database.save_customer('avito', '100', name='Иван')
+    database.save_customer('telegram', '100', name='Петр')
+
+    assert database.get_customer('avito', '100')['name'] == 'Иван'
+    assert database.get_customer('telegram', '100')['name'] == 'Петр'
+
+
+def search_ids(query):
+    return [customer['source_id'] for customer in database.search_customers(query)]
+
+
+def test_search_by_any_field():
+    database.save_customer('avito', '1', name='Иван Петров')
+    database.save_customer('avito', '2', vin='XTA210990Y1234567')
+    database.save_customer('avito', '3', phone='+79990001122')
+    database.save_customer('avito', '4', comments='замена ремня ГРМ')
+
+    assert search_ids('Петров') == ['1']
+    assert search_ids('xta2109') == ['2']
+    assert search_ids('0001122') == ['3']
+    assert search_ids('ремня') == ['4']
+    assert search_ids('нет такого') == []
+
+
+def test_short_query_searches_without_index():
+    database.save_customer('avito', '1', name='Ян')
+    database.save_customer('avito', '2', name='Иван')
+
+    assert search_ids('Ян') == ['1']
+
+
+def test_search_sees_updated_values():
+    database.save_customer('avito', '1', name='Иван Петров')
+    database.save_customer('avito', '1', name='Сергей Петров')
+
+    assert search_ids('Сергей') == ['1']
+    assert search_ids('Иван') == []
+
+
+def test_search_index_rebuilt_when_content_drifts():
+    database.save_customer('avito', '1', name='Иван Петров')
+    with database.connection() as conn:
+        conn.cursor().execute("UPDATE customers SET name = 'Сергей Петров'")
+
+    database._init_search_index()
+
+    assert search_ids('Сергей') == ['1']
+    assert search_ids('Иван') == []
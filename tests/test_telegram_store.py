@@ -0,0 +1,73 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import telegram_client
+
+CHAT_ID = 'tg_42'
+
+
+def make_message(message_id, text='текст'):
+    return SimpleNamespace(
+        id=message_id, sender_id=42, date=datetime(2026, 1, 1), message=text, out=False,
+        photo=None, video=None, document=None, voice=None
+    )
+
+
+class FakeClient:
+    """Клиент, запоминающий запросы сообщений"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def get_messages(self, peer, **kwargs):
+        self.requests.append(kwargs)
+        return []
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Хранилище с синхронизированной последней страницей чата: сообщения 51-60 из более длинной истории"""
+    monkeypatch.setattr(telegram_client, '_messages', OrderedDict())
+    monkeypatch.setattr(telegram_client, '_read_outbox', {})
+    monkeypatch.setattr(telegram_client, 'is_authorized', lambda: True)
+    monkeypatch.setattr(telegram_client.event_stream, 'publish', lambda *args: None)
+    fake = FakeClient()
+
+    async def init_client():
+        return fake
+
+    monkeypatch.setattr(telegram_client, 'init_telegram_client', init_client)
+    page = [telegram_client._format_message(make_message(i)) for i in range(60, 50, -1)]
+    telegram_client._store_sync(CHAT_ID, page, limit=10)
+    return fake
+
+
+def edit_event(message):
+    return SimpleNamespace(is_private=True, chat_id=42, message=message)
+
+
+def test_edit_replaces_cached_message(client):
+    asyncio.run(telegram_client._on_message_edited(edit_event(make_message(55, 'исправлено'))))
+
+    stored = telegram_client._store_get(CHAT_ID, 10)
+    assert [m['text'] for m in stored if m['original_id'] == 55] == ['исправлено']
+
+
+def test_edit_of_uncached_message_is_ignored(client):
+    asyncio.run(telegram_client._on_message_edited(edit_event(make_message(5, 'старое'))))
+
+    # Между 10 и 51 сообщения не загружались - их нельзя отдавать из хранилища
+    assert telegram_client._store_get(CHAT_ID, 10, after_id=10) is None
+    asyncio.run(telegram_client.get_telegram_messages_async(CHAT_ID, limit=10, after_id=10))
+    assert client.requests == [{'limit': 10, 'min_id': 10}]
+
+
+def test_after_id_inside_cached_range_uses_store(client):
+    messages = asyncio.run(telegram_client.get_telegram_messages_async(CHAT_ID, limit=10, after_id=57))
+
+    assert [m['original_id'] for m in messages] == [60, 59, 58]
+    assert client.requests == []
@@ -18,12 +18,282 @@ console.log(`🟢 WhatsApp будет доступен на портах: ${PORT
 app.use(cors());
 app.use(express.json());
 
+// Куда отправлять события (Python приложение), например http://web:5000/api/whatsapp/events
+const PYTHON_EVENTS_URL = process.env.PYTHON_EVENTS_URL || '';
+const WHATSAPP_EVENTS_TOKEN = process.env.WHATSAPP_EVENTS_TOKEN || '';
+if (PYTHON_EVENTS_URL && !WHATSAPP_EVENTS_TOKEN) {
+    console.log('⚠️ WHATSAPP_EVENTS_TOKEN не задан: Python приложение не примет события, отправка выключена');
+}
+
 // WhatsApp клиент
 let client = null;
 let qrCodeData = null;
 let isReady = false;
 let isAuthenticating = false;
 
+// Сообщение в формате API
+function serializeMessage(msg) {
+    return {
+        id: `wa_${msg.id._serialized}`,
+        original_id: msg.id._serialized,
+        author_id: msg.from,
+        created: msg.timestamp,
+        text: msg.body || '',
+        type: msg.type === 'chat' ? 'text' : msg.type,
+        direction: msg.fromMe ? 'out' : 'in',
+        isRead: msg.fromMe ? msg.ack >= 3 : true
+    };
+}
+
+// ==================== События для Python приложения ====================
+// События копятся и отправляются пачками; при ошибке пачка повторяется с растущей паузой.
+// heartbeat сообщает Python, что поток событий жив и его кэшу сообщений можно доверять.
+
+const EVENTS_BATCH_DELAY_MS = parseInt(process.env.EVENTS_BATCH_DELAY_MS) || 200;
+const EVENTS_MAX_BATCH = 100;
+const EVENTS_MAX_PENDING = 5000;
+const EVENTS_MAX_RETRY_DELAY_MS = 30000;
+const EVENTS_HEARTBEAT_MS = 30000;
+
+let pendingEvents = [];
+let flushTimer = null;
+let flushing = false;
+let retryDelay = 0;
+
+// Поставить событие в очередь на отправку
+function forwardEvent(event) {
+    if (!PYTHON_EVENTS_URL || !WHATSAPP_EVENTS_TOKEN) {
+        return;
+    }
+
+    pendingEvents.push(event);
+    if (pendingEvents.length > EVENTS_MAX_PENDING) {
+        // Python долго недоступен - старые события отбрасываем, он перезагрузит данные
+        pendingEvents = pendingEvents.slice(-EVENTS_MAX_PENDING);
+        pendingEvents.unshift({ type: 'resync' });
+    }
+    scheduleFlush(retryDelay || EVENTS_BATCH_DELAY_MS);
+}
+
+function scheduleFlush(delay) {
+    if (!flushTimer && !flushing) {
+        flushTimer = setTimeout(flushEvents, delay);
+    }
+}
+
+async function flushEvents() {
+    flushTimer = null;
+    if (pendingEvents.length === 0) {
+        return;
+    }
+
+    flushing = true;
+    const batch = pendingEvents.slice(0, EVENTS_MAX_BATCH);
+    try {
+        const response = await fetch(PYTHON_EVENTS_URL, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Events-Token': WHATSAPP_EVENTS_TOKEN
+            },
+            body: JSON.stringify({ events: batch })
+        });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        pendingEvents.splice(0, batch.length);
+        retryDelay = 0;
+    } catch (error) {
+        retryDelay = Math.min(retryDelay ? retryDelay * 2 : 1000, EVENTS_MAX_RETRY_DELAY_MS);
+        console.log(`⚠️ Не удалось отправить события (${batch.length}), повтор через ${retryDelay} мс:`, error.message);
+    } finally {
+        flushing = false;
+    }
+
+    if (pendingEvents.length > 0) {
+        scheduleFlush(retryDelay);
+    }
+}
+
+setInterval(() => {
+    if (isReady) {
+        forwardEvent({ type: 'heartbeat' });
+    }
+}, EVENTS_HEARTBEAT_MS);
+
+// ==================== Кэш чатов ====================
+// Сводка каждого личного чата хранится в памяти и обновляется событиями клиента,
+// поэтому GET /chats не перебирает все чаты через puppeteer.
+// У каждой сводки есть версия; курсор "<epoch>:<version>" позволяет получить только изменения.
+
+const CHATS_EPOCH = Date.now().toString(16); // курсоры прошлого процесса недействительны
+const MAX_REMOVED_TRACKED = 1000;
+const chatSummaries = new Map(); // serialized id -> сводка чата (формат API) и version
+const removedChats = new Map(); // serialized id -> version удаления
+let chatsVersion = 0;
+let minDeltaVersion = 0;
+let chatsLoading = null; // Promise полной загрузки (одна после каждого ready)
+let sortedChats = null; // Отсортированный список, сбрасывается при изменениях
+
+function isPrivateChatId(chatId) {
+    return !chatId.endsWith('@g.us') && chatId !== 'status@broadcast';
+}
+
+// Сводка чата в формате API
+function summarizeChat(chat) {
+    const lastMessage = chat.lastMessage;
+
+    const chatData = {
+        id: `wa_${chat.id._serialized}`,
+        source: 'whatsapp',
+        original_id: chat.id._serialized,
+        name: chat.name || 'WhatsApp User',
+        unread_count: chat.unreadCount || 0,
+        created: lastMessage ? lastMessage.timestamp : 0,
+        updated: lastMessage ? lastMessage.timestamp : 0,
+        type: 'private',
+        has_photo: false
+    };
+
+    // Последнее сообщение
+    if (lastMessage) {
+        chatData.last_message = summarizeLastMessage(lastMessage);
+    }
+
+    return chatData;
+}
+
+function summarizeLastMessage(msg) {
+    return {
+        id: msg.id._serialized,
+        text: msg.body || '',
+        created: msg.timestamp,
+        from_id: msg.from,
+        direction: msg.fromMe ? 'out' : 'in',
+        isRead: msg.fromMe ? msg.ack >= 3 : undefined
+    };
+}
+
+function putChatSummary(summary) {
+    summary.version = ++chatsVersion;
+    chatSummaries.set(summary.original_id, summary);
+    removedChats.delete(summary.original_id);
+    sortedChats = null;
+}
+
+function removeChatSummary(chatId) {
+    if (!chatSummaries.delete(chatId)) {
+        return;
+    }
+    removedChats.set(chatId, ++chatsVersion);
+    sortedChats = null;
+
+    // Ограничиваем число удаленных; клиенты со старыми курсорами получат полный список
+    while (removedChats.size > MAX_REMOVED_TRACKED) {
+        const [oldestId, oldestVersion] = removedChats.entries().next().value;
+        removedChats.delete(oldestId);
+        minDeltaVersion = Math.max(minDeltaVersion, oldestVersion);
+    }
+}
+
+// Полная загрузка чатов (после ready) - единственный раз, когда перебираем все чаты
+function ensureChatsLoaded() {
+    if (!chatsLoading) {
+        chatsLoading = (async () => {
+            const chats = await client.getChats();
+            const seen = new Set();
+            for (const chat of chats) {
+                if (chat.isGroup || !isPrivateChatId(chat.id._serialized)) {
+                    continue;
+                }
+                try {
+                    putChatSummary(summarizeChat(chat));
+                    seen.add(chat.id._serialized);
+                } catch (error) {
+                    console.log(`⚠️ Ошибка обработки чата ${chat.id._serialized}:`, error.message);
+                }
+            }
+            // Чаты, удаленные, пока клиент был отключен
+            for (const chatId of Array.from(chatSummaries.keys())) {
+                if (!seen.has(chatId)) {
+                    removeChatSummary(chatId);
+                }
+            }
+            console.log(`✅ Кэш чатов загружен: ${chatSummaries.size}`);
+        })().catch((error) => {
+            chatsLoading = null;
+            throw error;
+        });
+    }
+    return chatsLoading;
+}
+
+// Обновить сводку одного чата из WhatsApp (новый чат или изменение, которое не вывести из события)
+async function refreshChatSummary(chatId) {
+    if (!isPrivateChatId(chatId)) {
+        return;
+    }
+    try {
+        const chat = await client.getChatById(chatId);
+        if (!chat.isGroup) {
+            putChatSummary(summarizeChat(chat));
+        }
+    } catch (error) {
+        console.log(`⚠️ Не удалось обновить чат ${chatId}:`, error.message);
+    }
+}
+
+// Новое сообщение (входящее или исходящее) - обновляем последнее сообщение и непрочитанные
+function applyMessageToChat(msg) {
+    const chatId = msg.fromMe ? msg.to : msg.from;
+    if (!chatId || !isPrivateChatId(chatId)) {
+        return;
+    }
+
+    const existing = chatSummaries.get(chatId);
+    if (!existing) {
+        refreshChatSummary(chatId);
+        return;
+    }
+
+    putChatSummary({
+        ...existing,
+        updated: Math.max(existing.updated || 0, msg.timestamp),
+        unread_count: msg.fromMe ? existing.unread_count : (existing.unread_count || 0) + 1,
+        last_message: summarizeLastMessage(msg)
+    });
+}
+
+// Статус доставки изменился - обновляем, если это последнее сообщение чата
+function applyAckToChat(msg, ack) {
+    const existing = chatSummaries.get(msg.to);
+    if (!existing || !existing.last_message || existing.last_message.id !== msg.id._serialized) {
+        return;
+    }
+    putChatSummary({
+        ...existing,
+        last_message: { ...existing.last_message, isRead: ack >= 3 }
+    });
+}
+
+// Все сводки, новые чаты первыми
+function getSortedChats() {
+    if (!sortedChats) {
+        sortedChats = Array.from(chatSummaries.values()).sort((a, b) => (b.updated || 0) - (a.updated || 0));
+    }
+    return sortedChats;
+}
+
+// Версия из курсора или null, если курсор не подходит для дельты
+function parseChatsCursor(cursor) {
+    const [epoch, version] = String(cursor || '').split(':');
+    const parsed = parseInt(version);
+    if (epoch !== CHATS_EPOCH || isNaN(parsed) || parsed < minDeltaVersion || parsed > chatsVersion) {
+        return null;
+    }
+    return parsed;
+}
+
 // Инициализация WhatsApp клиента
 function initWhatsAppClient() {
     if (client) {
@@ -76,6 +346,10 @@ function initWhatsAppClient() {
         isReady = true;
         isAuthenticating = false;
         qrCodeData = null;
+        chatsLoading = null;
+        ensureChatsLoaded().catch((error) => console.error('Ошибка загрузки чатов:', error));
+        // События, пришедшие пока клиент был отключен, потеряны
+        forwardEvent({ type: 'resync' });
     });
 
     // Авторизация успешна
@@ -96,11 +370,50 @@ function initWhatsAppClient() {
         console.log('⚠️ WhatsApp отключен:', reason);
         isReady = false;
         isAuthenticating = false;
+        // Пока клиент отключен, события теряются - после ready загрузим чаты заново
+        chatsLoading = null;
+    });
+
+    // Любое сообщение, в том числе отправленное с телефона или через API
+    client.on('message_create', (message) => {
+        applyMessageToChat(message);
+
+        const chatId = message.fromMe ? message.to : message.from;
+        if (chatId && isPrivateChatId(chatId)) {
+            forwardEvent({
+                type: 'message',
+                chat_id: `wa_${chatId}`,
+                message: serializeMessage(message)
+            });
+        }
+    });
+
+    client.on('message_ack', (message, ack) => {
+        applyAckToChat(message, ack);
+
+        if (message.fromMe && isPrivateChatId(message.to)) {
+            forwardEvent({
+                type: 'ack',
+                chat_id: `wa_${message.to}`,
+                message_id: `wa_${message.id._serialized}`,
+                ack
+            });
+        }
     });
 
-    // Новое сообщение (для webhook в будущем)
-    client.on('message', async (message) => {
-        console.log('📨 Новое сообщение:', message.from);
+    client.on('chat_removed', (chat) => {
+        removeChatSummary(chat.id._serialized);
+    });
+
+    // Изменилось число непрочитанных (например, чат прочитан на телефоне)
+    client.on('unread_count', (chat) => {
+        const existing = chatSummaries.get(chat.id._serialized);
+        if (existing && existing.unread_count !== chat.unreadCount) {
+            putChatSummary({ ...existing, unread_count: chat.unreadCount || 0 });
+        }
+        if (!chat.unreadCount && isPrivateChatId(chat.id._serialized)) {
+            forwardEvent({ type: 'read', chat_id: `wa_${chat.id._serialized}` });
+        }
     });
 
     // Запуск клиента
@@ -109,13 +422,17 @@ function initWhatsAppClient() {
 
 // API Endpoints
 
-// Статус клиента
-app.get('/status', (req, res) => {
-    res.json({
+function getStatus() {
+    return {
         ready: isReady,
         authenticating: isAuthenticating,
         hasQR: qrCodeData !== null
-    });
+    };
+}
+
+// Статус клиента
+app.get('/status', (req, res) => {
+    res.json(getStatus());
 });
 
 // Получить QR код
@@ -126,59 +443,89 @@ app.get('/qr', (req, res) => {
     res.json({ qr: qrCodeData });
 });
 
-// Получить список чатов
+// Получить список чатов (из кэша в памяти)
+// Без since - массив чатов, как раньше. С since=<cursor> - { delta, chats, removed, cursor }:
+// только чаты, изменившиеся после курсора (или полный список, если курсор устарел)
 app.get('/chats', async (req, res) => {
     if (!isReady) {
         return res.status(503).json({ error: 'WhatsApp не готов' });
     }
 
     try {
+        await ensureChatsLoaded();
         const limit = parseInt(req.query.limit) || 30;
-        const chats = await client.getChats();
-        
-        // Фильтруем только личные чаты (не группы)
-        const privateChats = chats
-            .filter(chat => !chat.isGroup)
-            .slice(0, limit);
 
-        const result = [];
+        if (req.query.since === undefined) {
+            return res.json(getSortedChats().slice(0, limit));
+        }
 
-        for (const chat of privateChats) {
-            try {
-                const lastMessage = chat.lastMessage;
-
-                const chatData = {
-                    id: `wa_${chat.id._serialized}`,
-                    source: 'whatsapp',
-                    original_id: chat.id._serialized,
-                    name: chat.name || 'WhatsApp User',
-                    unread_count: chat.unreadCount || 0,
-                    created: lastMessage ? lastMessage.timestamp : 0,
-                    updated: lastMessage ? lastMessage.timestamp : 0,
-                    type: 'private',
-                    has_photo: false
-                };
-
-                // Последнее сообщение
-                if (lastMessage) {
-                    chatData.last_message = {
-                        id: lastMessage.id._serialized,
-                        text: lastMessage.body || '',
-                        created: lastMessage.timestamp,
-                        from_id: lastMessage.from
-                    };
-                }
+        res.json(getChatsDelta(req.query.since, limit));
+    } catch (error) {
+        console.error('Ошибка получения чатов:', error);
+        res.status(500).json({ error: error.message });
+    }
+});
+
+function getChatsDelta(since, limit) {
+    const sinceVersion = parseChatsCursor(since);
+    const cursor = `${CHATS_EPOCH}:${chatsVersion}`;
 
-                result.push(chatData);
+    if (sinceVersion === null) {
+        return { delta: false, chats: getSortedChats().slice(0, limit), removed: [], cursor };
+    }
+
+    return {
+        delta: true,
+        chats: getSortedChats().filter(chat => chat.version > sinceVersion),
+        removed: Array.from(removedChats.entries())
+            .filter(([, version]) => version > sinceVersion)
+            .map(([chatId]) => `wa_${chatId}`),
+        cursor
+    };
+}
+
+// Последние сообщения чата в формате API
+async function fetchChatMessages(chatId, limit) {
+    const chat = await client.getChatById(chatId.replace('wa_', ''));
+    const messages = await chat.fetchMessages({ limit });
+    return messages.map(serializeMessage);
+}
+
+// Сколько чатов можно запросить в /overview за раз
+const OVERVIEW_MAX_MESSAGE_CHATS = 20;
+
+// Статус, список чатов и последние сообщения нескольких чатов одним запросом.
+// Параметры: limit, since (как в /chats), messages=wa_1,wa_2 и messages_limit.
+// Отвечает 200 и когда клиент не готов: status.ready = false, chats = null.
+app.get('/overview', async (req, res) => {
+    const result = { status: getStatus(), chats: null, messages: {} };
+    if (!isReady) {
+        return res.json(result);
+    }
+
+    try {
+        await ensureChatsLoaded();
+        const limit = parseInt(req.query.limit) || 30;
+        result.chats = getChatsDelta(req.query.since, limit);
+
+        const messagesLimit = parseInt(req.query.messages_limit) || 30;
+        const chatIds = String(req.query.messages || '')
+            .split(',')
+            .filter(Boolean)
+            .slice(0, OVERVIEW_MAX_MESSAGE_CHATS);
+
+        // Ошибка одного чата не должна ломать весь ответ
+        await Promise.all(chatIds.map(async (chatId) => {
+            try {
+                result.messages[chatId] = await fetchChatMessages(chatId, messagesLimit);
             } catch (error) {
-                console.log(`⚠️ Ошибка обработки чата ${chat.id._serialized}:`, error.message);
-                continue;
+                result.messages[chatId] = { error: error.message };
             }
-        }
+        }));
 
         res.json(result);
     } catch (error) {
-        console.error('Ошибка получения чатов:', error);
+        console.error('Ошибка получения обзора:', error);
         res.status(500).json({ error: error.message });
     }
 });
@@ -190,24 +537,8 @@ app.get('/chats/:chatId/messages', async (req, res) => {
     }
 
     try {
-        const chatId = req.params.chatId.replace('wa_', '');
         const limit = parseInt(req.query.limit) || 30;
-        
-        const chat = await client.getChatById(chatId);
-        const messages = await chat.fetchMessages({ limit });
-
-        const result = messages.map(msg => ({
-            id: `wa_${msg.id._serialized}`,
-            original_id: msg.id._serialized,
-            author_id: msg.from,
-            created: msg.timestamp,
-            text: msg.body || '',
-            type: msg.type === 'chat' ? 'text' : msg.type,
-            direction: msg.fromMe ? 'out' : 'in',
-            isRead: msg.fromMe ? true : !msg.id.fromMe
-        }));
-
-        res.json(result);
+        res.json(await fetchChatMessages(req.params.chatId, limit));
     } catch (error) {
         console.error('Ошибка получения сообщений:', error);
         res.status(500).json({ error: error.message });
@@ -4,7 +4,14 @@ WhatsApp Client Integration
 """
 
 import os
-import requests
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+import circuit_breaker
+import http_client
+import metrics
 
 # URL микросервиса WhatsApp
 WHATSAPP_SERVICE_URL = os.environ.get('WHATSAPP_SERVICE_URL', 'http://localhost:3001')
@@ -19,21 +26,59 @@ if 'railway.app' in WHATSAPP_SERVICE_URL and ':3001' in WHATSAPP_SERVICE_URL:
     
 print(f"WhatsApp Service URL: {WHATSAPP_SERVICE_URL}")
 
+# Общий секрет для событий, которые микросервис отправляет в /api/whatsapp/events
+WHATSAPP_EVENTS_TOKEN = os.environ.get('WHATSAPP_EVENTS_TOKEN', '')
+if not WHATSAPP_EVENTS_TOKEN:
+    print("⚠️ WHATSAPP_EVENTS_TOKEN не задан: события WhatsApp (/api/whatsapp/events) не принимаются")
+
+
+# Хранилище сообщений: заполняется событиями микросервиса (/api/whatsapp/events).
+# Отдаем из него, только пока поток событий жив (микросервис шлет heartbeat)
+WHATSAPP_MESSAGE_STORE_LIMIT = int(os.environ.get('WHATSAPP_MESSAGE_STORE_LIMIT', '200'))
+WHATSAPP_MESSAGE_STORE_CHATS = int(os.environ.get('WHATSAPP_MESSAGE_STORE_CHATS', '200'))
+EVENTS_STALE_AFTER = 90  # секунд без событий - перестаем доверять хранилищу
+_messages = OrderedDict()  # 'wa_<id>' -> {'messages': {id: message}, 'synced', 'complete'}
+_messages_lock = threading.Lock()
+_events_seen_at = 0.0
+
+# Копия списка чатов микросервиса: /overview отдает только изменения после _chats_cursor
+_chats = {}  # 'wa_<id>' -> чат
+_chats_cursor = None
+_chats_lock = threading.Lock()
+# Сколько несинхронизированных чатов из начала списка подгружать в хранилище вместе со списком
+WHATSAPP_PREFETCH_CHATS = int(os.environ.get('WHATSAPP_PREFETCH_CHATS', '5'))
+
+
+def check_events_token(token):
+    """Проверить токен входящих событий. Без настроенного токена события не принимаются"""
+    if not WHATSAPP_EVENTS_TOKEN:
+        return False
+    return hmac.compare_digest(token or '', WHATSAPP_EVENTS_TOKEN)
+
 
 def get_whatsapp_status():
     """Проверить статус WhatsApp клиента"""
     try:
-        response = requests.get(f'{WHATSAPP_SERVICE_URL}/status', timeout=5)
+        response = http_client.get_session('whatsapp').get(f'{WHATSAPP_SERVICE_URL}/status')
         return response.json()
     except Exception as e:
         print(f"WhatsApp: ошибка проверки статуса: {e}")
         return {'ready': False, 'authenticating': False, 'error': str(e)}
 
 
+def _probe_service():
+    """Проверка для circuit breaker: микросервис отвечает на /status"""
+    response = http_client.get_session('whatsapp').get(f'{WHATSAPP_SERVICE_URL}/status')
+    return response.status_code == 200
+
+
+circuit_breaker.register_probe('whatsapp', _probe_service)
+
+
 def get_whatsapp_qr():
     """Получить QR код для авторизации"""
     try:
-        response = requests.get(f'{WHATSAPP_SERVICE_URL}/qr', timeout=5)
+        response = http_client.get_session('whatsapp').get(f'{WHATSAPP_SERVICE_URL}/qr')
         if response.status_code == 200:
             return response.json()
         return None
@@ -44,39 +89,223 @@ def get_whatsapp_qr():
 
 def get_whatsapp_chats(limit=30):
     """Получить список чатов WhatsApp"""
+    chats = get_whatsapp_overview(limit=limit)['chats']
+    return chats if chats is not None else []
+
+
+def _prepare_message(message):
+    """Привести сообщение к единому формату интерфейса"""
+    if 'content' not in message:
+        message['content'] = {'text': message.get('text', '')}
+    message['source'] = 'whatsapp'
+    return message
+
+
+def _store_entry_locked(chat_id, create=False):
+    """Запись хранилища чата (под _messages_lock), вытесняет давно не открывавшиеся чаты"""
+    entry = _messages.get(chat_id)
+    if entry is None:
+        if not create:
+            return None
+        entry = _messages[chat_id] = {'messages': {}, 'synced': False, 'complete': False}
+        while len(_messages) > WHATSAPP_MESSAGE_STORE_CHATS:
+            _messages.popitem(last=False)
+    _messages.move_to_end(chat_id)
+    return entry
+
+
+def _store_put_locked(entry, message):
+    """Сохранить сообщение, оставляя не больше WHATSAPP_MESSAGE_STORE_LIMIT последних"""
+    entry['messages'][message['id']] = message
+    if len(entry['messages']) > WHATSAPP_MESSAGE_STORE_LIMIT:
+        ordered = sorted(entry['messages'].values(), key=lambda m: m.get('created') or 0)
+        for old in ordered[:len(entry['messages']) - WHATSAPP_MESSAGE_STORE_LIMIT]:
+            del entry['messages'][old['id']]
+        entry['complete'] = False
+
+
+def _events_alive():
+    return time.time() - _events_seen_at < EVENTS_STALE_AFTER
+
+
+def _store_get(chat_id, limit):
+    """Последние limit сообщений (старые первыми) или None, если хранилищу нельзя доверять"""
+    if not _events_alive():
+        return None
+    with _messages_lock:
+        entry = _store_entry_locked(chat_id)
+        if entry is None or not entry['synced']:
+            return None
+        if len(entry['messages']) < limit and not entry['complete']:
+            return None
+        ordered = sorted(entry['messages'].values(), key=lambda m: m.get('created') or 0)
+        return [dict(message) for message in ordered[-limit:]]
+
+
+def _store_sync(chat_id, messages, limit, started_at):
+    """Заменить сохраненные сообщения загруженными; пришедшие событиями во время загрузки сохраняем"""
+    with _messages_lock:
+        entry = _store_entry_locked(chat_id, create=True)
+        arrived = [m for m in entry['messages'].values() if m.get('_stored_at', 0) >= started_at]
+        entry['messages'] = {}
+        for message in messages + arrived:
+            _store_put_locked(entry, message)
+        entry['synced'] = True
+        entry['complete'] = len(messages) < limit
+
+
+def apply_event(event):
+    """
+    Применить событие микросервиса к хранилищу сообщений.
+
+    Типы: message, ack, read, resync, heartbeat. Возвращает подготовленное сообщение для message.
+    """
+    global _events_seen_at
+    _events_seen_at = time.time()
+    event_type = event.get('type')
+    chat_id = event.get('chat_id')
+    metrics.incr('whatsapp_events_received')
+
+    if event_type == 'resync':
+        # Микросервис мог пропустить события - сверимся с ним при следующем запросе
+        with _messages_lock:
+            for entry in _messages.values():
+                entry['synced'] = False
+        return None
+
+    if not chat_id:
+        return None
+
+    if event_type == 'message':
+        message = _prepare_message(dict(event.get('message') or {}))
+        if not message.get('id'):
+            return None
+        with _messages_lock:
+            entry = _messages.get(chat_id)
+            if entry is not None:
+                _store_put_locked(entry, dict(message, _stored_at=time.time()))
+        return message
+
+    if event_type == 'ack':
+        with _messages_lock:
+            entry = _messages.get(chat_id)
+            message = entry['messages'].get(event.get('message_id')) if entry else None
+            if message is not None:
+                message['isRead'] = (event.get('ack') or 0) >= 3
+    return None
+
+
+def _apply_chats_locked(data, limit):
+    """Применить список или дельту чатов из /overview (под _chats_lock), вернуть первые limit"""
+    global _chats, _chats_cursor
+    if data.get('delta'):
+        for chat in data.get('chats') or []:
+            _chats[chat['id']] = chat
+        for chat_id in data.get('removed') or []:
+            _chats.pop(chat_id, None)
+        # На место удаленного мог встать чат, которого у нас нет - в следующий раз берем весь список
+        _chats_cursor = None if data.get('removed') else data.get('cursor')
+    else:
+        _chats = {chat['id']: chat for chat in data.get('chats') or []}
+        _chats_cursor = data.get('cursor')
+
+    ordered = sorted(_chats.values(), key=lambda chat: chat.get('updated') or 0, reverse=True)
+    return ordered[:limit]
+
+
+def _prefetch_candidates():
+    """Первые чаты списка, чьи сообщения еще не в хранилище"""
+    if WHATSAPP_PREFETCH_CHATS <= 0 or not _events_alive():
+        return []
+    with _chats_lock:
+        ordered = sorted(_chats.values(), key=lambda chat: chat.get('updated') or 0, reverse=True)
+    with _messages_lock:
+        return [
+            chat['id'] for chat in ordered[:WHATSAPP_PREFETCH_CHATS]
+            if not (_messages.get(chat['id']) or {}).get('synced')
+        ]
+
+
+def get_whatsapp_overview(limit=30, message_chat_ids=None, messages_limit=30, raise_errors=False):
+    """
+    Статус, чаты и последние сообщения нескольких чатов одним запросом к микросервису.
+
+    Чаты запрашиваются дельтой от прошлого ответа. Без message_chat_ids подгружаются
+    несинхронизированные чаты из начала списка (если поток событий жив), полученные
+    сообщения попадают в хранилище.
+    Возвращает {'status', 'chats' (None, если клиент не готов), 'messages': {chat_id: [...]}}.
+    Если микросервис не ответил: raise_errors=True - исключение, иначе status с error.
+    """
+    if message_chat_ids is None:
+        message_chat_ids = _prefetch_candidates()
+
+    started_at = time.time()
+    with _messages_lock:
+        for chat_id in message_chat_ids:
+            _store_entry_locked(chat_id, create=True)
+    with _chats_lock:
+        cursor = _chats_cursor
+
+    params = {'limit': limit}
+    if cursor:
+        params['since'] = cursor
+    if message_chat_ids:
+        params['messages'] = ','.join(message_chat_ids)
+        params['messages_limit'] = messages_limit
+
     try:
-        response = requests.get(
-            f'{WHATSAPP_SERVICE_URL}/chats',
-            params={'limit': limit},
-            timeout=10
+        response = http_client.get_session('whatsapp').get(
+            f'{WHATSAPP_SERVICE_URL}/overview',
+            params=params
         )
-        if response.status_code == 200:
-            chats = response.json()
-            print(f"WhatsApp: загружено {len(chats)} чатов")
-            return chats
-        else:
-            print(f"WhatsApp: ошибка {response.status_code}")
-            return []
+        response.raise_for_status()
+        data = response.json()
     except Exception as e:
         print(f"WhatsApp: ошибка получения чатов: {e}")
-        return []
+        if raise_errors:
+            raise
+        return {'status': {'ready': False, 'authenticating': False, 'error': str(e)}, 'chats': None, 'messages': {}}
+
+    chats = None
+    if data.get('chats') is not None:
+        with _chats_lock:
+            chats = _apply_chats_locked(data['chats'], limit)
+        print(f"WhatsApp: загружено {len(chats)} чатов")
+
+    messages = {}
+    for chat_id, chat_messages in (data.get('messages') or {}).items():
+        if not isinstance(chat_messages, list):
+            print(f"WhatsApp: ошибка получения сообщений {chat_id}: {chat_messages.get('error')}")
+            continue
+        messages[chat_id] = [_prepare_message(msg) for msg in chat_messages]
+        _store_sync(chat_id, [dict(msg) for msg in messages[chat_id]], messages_limit, started_at)
+    if messages:
+        metrics.incr('whatsapp_messages_prefetched', len(messages))
+
+    return {'status': data.get('status') or {}, 'chats': chats, 'messages': messages}
 
 
 def get_whatsapp_messages(chat_id, limit=30):
-    """Получить сообщения из WhatsApp чата"""
+    """Получить сообщения из WhatsApp чата (из хранилища, если поток событий жив)"""
+    stored = _store_get(chat_id, limit)
+    if stored is not None:
+        metrics.incr('whatsapp_messages_store_hits')
+        for message in stored:
+            message.pop('_stored_at', None)
+        return stored
+    
+    started_at = time.time()
+    with _messages_lock:
+        _store_entry_locked(chat_id, create=True)
     try:
-        response = requests.get(
+        response = http_client.get_session('whatsapp').get(
             f'{WHATSAPP_SERVICE_URL}/chats/{chat_id}/messages',
-            params={'limit': limit},
-            timeout=10
+            params={'limit': limit}
         )
         if response.status_code == 200:
-            messages = response.json()
-            # Преобразуем формат для единого интерфейса
-            for msg in messages:
-                if 'content' not in msg:
-                    msg['content'] = {'text': msg.get('text', '')}
-                msg['source'] = 'whatsapp'
+            messages = [_prepare_message(msg) for msg in response.json()]
+            metrics.incr('whatsapp_messages_store_misses')
+            _store_sync(chat_id, [dict(msg) for msg in messages], limit, started_at)
             return messages
         else:
             print(f"WhatsApp: ошибка получения сообщений {response.status_code}")
@@ -89,10 +318,9 @@ def get_whatsapp_messages(chat_id, limit=30):
 def send_whatsapp_message(chat_id, text):
     """Отправить сообщение в WhatsApp"""
     try:
-        response = requests.post(
+        response = http_client.get_session('whatsapp').post(
             f'{WHATSAPP_SERVICE_URL}/messages/send',
-            json={'chat_id': chat_id, 'message': text},
-            timeout=10
+            json={'chat_id': chat_id, 'message': text}
         )
         if response.status_code == 200:
             return response.json()
@@ -106,9 +334,8 @@ def send_whatsapp_message(chat_id, text):
 def mark_whatsapp_read(chat_id):
     """Пометить WhatsApp чат как прочитанный"""
     try:
-        response = requests.post(
-            f'{WHATSAPP_SERVICE_URL}/chats/{chat_id}/read',
-            timeout=5
+        response = http_client.get_session('whatsapp').post(
+            f'{WHATSAPP_SERVICE_URL}/chats/{chat_id}/read'
         )
         if response.status_code == 200:
             return {'success': True}
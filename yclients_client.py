@@ -6,6 +6,7 @@ import os
 import requests
 import logging
 import json
+import http_client
 
 log = logging.getLogger(__name__)
 
@@ -36,7 +37,7 @@ def _get(path, params=None):
     """Внутренний GET запрос"""
     url = API + path
     try:
-        response = requests.get(url, headers=HEADERS, params=params or {}, timeout=10)
+        response = http_client.get_session('yclients').get(url, headers=HEADERS, params=params or {})
         response.raise_for_status()
         result = response.json()
         return result.get('data', result)
@@ -61,7 +62,7 @@ def _post(path, json_data):
     print(f"📤 Payload: {json.dumps(json_data, indent=2, ensure_ascii=False)}")
     
     try:
-        response = requests.post(url, headers=HEADERS, json=json_data, timeout=10)
+        response = http_client.get_session('yclients').post(url, headers=HEADERS, json=json_data)
         
         # ВСЕГДА логируем ответ для отладки (даже успешный, но особенно ошибки)
         print(f"📥 YClients response status: {response.status_code}")
@@ -348,7 +349,7 @@ def get_records(company_id=None, date_from=None, date_to=None, limit=100):
         url = API + f"/records/{cid}"
         
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=10)
+            response = http_client.get_session('yclients').get(url, headers=headers, params=params)
             response.raise_for_status()
             result = response.json()
             